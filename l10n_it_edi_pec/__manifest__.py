@@ -3,7 +3,7 @@
 
 {
     "name": "Italy - EDI PEC (FatturaPA)",
-    "version": "18.0.1.0.0",
+    "version": "18.0.1.1.0",
     "category": "Accounting/Localizations/EDI",
     "summary": "Send and receive Italian e-invoices (FatturaPA) via PEC",
     "author": "Odoo Community Association (OCA)",
@@ -23,6 +23,7 @@
         "views/ir_mail_server.xml",
         "views/account_move_view.xml",
         "views/fetchmail_view.xml",
+        "views/fetchmail_pec_spool_view.xml",
     ],
     "installable": True,
     "auto_install": False,
@@ -0,0 +1,86 @@
+# Copyright 2025 Your Company
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+
+from psycopg2.extras import execute_values
+
+from odoo.addons.l10n_it_edi_pec.models.mail_thread import pec_filename_key
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+FETCH_CRON_CODE = "model._cron_fetch_pec_mail()"
+OLD_FETCH_CRON_CODE = (
+    "env['fetchmail.server'].browse(env['res.company'].search("
+    "[('l10n_it_edi_use_pec','=',True),('l10n_it_edi_pec_server_id','!=',False)])"
+    ".mapped('l10n_it_edi_pec_server_id').ids).fetch_mail()"
+)
+
+
+def migrate(cr, version):
+    """Update the PEC fetch cron and backfill ``account.move.l10n_it_edi_pec_key``
+    from the e-invoice files"""
+    if not version:
+        return
+
+    # The cron is noupdate data: move it to its entry point unless edited
+    cr.execute(
+        """
+        UPDATE ir_act_server action
+           SET code = %s
+          FROM ir_cron cron
+          JOIN ir_model_data data
+            ON data.model = 'ir.cron'
+           AND data.res_id = cron.id
+         WHERE data.module = 'l10n_it_edi_pec'
+           AND data.name = 'ir_cron_fetchmail_pec'
+           AND action.id = cron.ir_actions_server_id
+           AND action.code = %s
+        """,
+        (FETCH_CRON_CODE, OLD_FETCH_CRON_CODE),
+    )
+
+    last_id = 0
+    filled = 0
+    while True:
+        cr.execute(
+            """
+            SELECT DISTINCT ON (move.id) move.id, attachment.name
+              FROM account_move move
+              JOIN ir_attachment attachment
+                ON attachment.res_model = 'account.move'
+               AND attachment.res_field = 'l10n_it_edi_attachment_file'
+               AND attachment.res_id = move.id
+             WHERE move.id > %s
+               AND move.move_type IN ('out_invoice', 'out_refund', 'out_receipt')
+               AND move.l10n_it_edi_pec_key IS NULL
+          ORDER BY move.id, attachment.id DESC
+             LIMIT %s
+            """,
+            (last_id, BATCH_SIZE),
+        )
+        rows = cr.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        keys = []
+        for move_id, name in rows:
+            filename_key = pec_filename_key(name)
+            if filename_key:
+                keys.append((move_id, filename_key.invoice_key))
+        if keys:
+            execute_values(
+                cr._obj,
+                """
+                UPDATE account_move move
+                   SET l10n_it_edi_pec_key = data.key
+                  FROM (VALUES %s) AS data(id, key)
+                 WHERE move.id = data.id
+                """,
+                keys,
+            )
+            filled += len(keys)
+
+    _logger.info("Filled the e-invoice key of %s invoices", filled)
@@ -1,5 +1,6 @@
 from . import account_move
 from . import fetchmail_server
+from . import fetchmail_pec_spool
 from . import mail_thread
 from . import res_company
 from . import ir_mail_server
@@ -2,25 +2,166 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 import base64
+import bisect
+import io
 import logging
 import re
 import secrets
 import string
+from collections import namedtuple
 from email.message import EmailMessage
 
 from lxml import etree
+from markupsafe import Markup
 
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools import email_split
+
+from .mail_thread import (
+    SDI_NOTIFICATION_TYPES,
+    SDI_TRANSMISSION_NOTIFICATION_TYPES,
+    pec_attachments,
+    pec_filename_key,
+    pec_message_id,
+    pec_post_attachments,
+    sdi_notification,
+)
 
 _logger = logging.getLogger(__name__)
 
-INVOICE_KEY_REGEX = r"(?:IT[a-zA-Z0-9]{11,16}|(?!IT)[A-Z]{2}[a-zA-Z0-9]{2,28})_[a-zA-Z0-9]{1,5}"
-RESPONSE_MAIL_REGEX = (
-    r"^" + INVOICE_KEY_REGEX + r"_[A-Z]{2}_[a-zA-Z0-9]{0,3}\.(xml|XML|Xml)(\.(p7m|P7M|P7m))?$"
+# First ProgressivoInvio of the document, the one of DatiTrasmissione
+PROGRESSIVO_INVIO_REGEX = re.compile(
+    rb"(<(?:[\w.-]+:)?ProgressivoInvio\b[^>]*>)[^<]*(</(?:[\w.-]+:)?ProgressivoInvio\s*>)"
 )
 
 
+def fatturapa_transmission_header(source):
+    """Return ``(IdPaese, IdCodice, ProgressivoInvio)`` of a FatturaPA file.
+
+    ``source`` is a binary file object, read in chunks by ``iterparse``:
+    parsing stops at the end of ``DatiTrasmissione``, or at the first
+    ``FatturaElettronicaBody``, so the lines and embedded attachments of
+    the invoice are never loaded. Missing values are empty strings.
+    """
+    values = {}
+    parents = []
+    for event, element in etree.iterparse(
+        source, events=("start", "end"), resolve_entities=False
+    ):
+        name = etree.QName(element).localname
+        if event == "start":
+            if name == "FatturaElettronicaBody":
+                break
+            parents.append(name)
+            continue
+        parents.pop()
+        parent = parents[-1] if parents else ""
+        if (parent, name) in (
+            ("IdTrasmittente", "IdPaese"),
+            ("IdTrasmittente", "IdCodice"),
+            ("DatiTrasmissione", "ProgressivoInvio"),
+        ):
+            values.setdefault(name, (element.text or "").strip())
+        elif name == "DatiTrasmissione":
+            break
+    return (
+        values.get("IdPaese", ""),
+        values.get("IdCodice", ""),
+        values.get("ProgressivoInvio", ""),
+    )
+
+
+# Stage of the SdI exchange each state belongs to: a notification never
+# brings an invoice back to an earlier stage, and within a stage the latest
+# notification wins
+SDI_STATE_PRECEDENCE = {
+    "being_sent": 0,
+    "processing": 0,
+    "forwarded": 1,
+    "forward_failed": 1,
+    "rejected": 1,
+    "accepted_by_pa_partner": 2,
+    "rejected_by_pa_partner": 2,
+    "accepted_by_pa_partner_after_expiry": 2,
+}
+PEC_STATE_PRECEDENCE = {"sent": 0, "delivered": 1, "error": 1}
+PEC_STATE_BY_SDI_STATE = {
+    "being_sent": "sent",
+    "processing": "sent",
+    "forwarded": "delivered",
+    "accepted_by_pa_partner": "delivered",
+    "accepted_by_pa_partner_after_expiry": "delivered",
+    "forward_failed": "error",
+    "rejected": "error",
+    "rejected_by_pa_partner": "error",
+}
+
+PecMoveUpdate = namedtuple("PecMoveUpdate", "move_id edi_state pec_state body attachments")
+
+
+class PecMoveUpdates:
+    """State changes and chatter entries of the invoices touched by a run.
+
+    During a spool run the SdI notifications and PEC receipts queue their
+    effect here, through the ``pec_move_updates`` context key; ``flush``
+    applies them with ``account.move._l10n_it_edi_pec_apply_updates``, once
+    per invoice. ``mark`` starts the updates of a source, such as the spool
+    entry being routed, and ``discard`` drops them when its routing failed.
+    """
+
+    __slots__ = ("updates", "sources")
+
+    def __init__(self):
+        self.updates = []
+        # (index of the first update, source), by index
+        self.sources = []
+
+    def mark(self, source=None):
+        mark = len(self.updates)
+        self.sources.append((mark, source))
+        return mark
+
+    def discard(self, mark):
+        del self.updates[mark:]
+        self.sources = [item for item in self.sources if item[0] < mark]
+
+    def flush(self, env):
+        """Apply the queued updates; return the error message of the
+        sources whose updates could not be applied, by source.
+
+        When the updates fail together, they are applied invoice by invoice
+        so only the sources of the failing invoices are reported.
+        """
+        updates, self.updates = self.updates, []
+        sources, self.sources = self.sources, []
+        if not updates:
+            return {}
+        Move = env["account.move"].sudo()
+        try:
+            with env.cr.savepoint():
+                Move._l10n_it_edi_pec_apply_updates(updates)
+            return {}
+        except Exception:
+            _logger.exception("PEC invoice updates failed together, applying them one by one")
+
+        starts = [start for start, source in sources]
+        failures = {}
+        for move_id in dict.fromkeys(update.move_id for update in updates):
+            indexes = [i for i, update in enumerate(updates) if update.move_id == move_id]
+            try:
+                with env.cr.savepoint():
+                    Move._l10n_it_edi_pec_apply_updates([updates[i] for i in indexes])
+            except Exception as e:
+                _logger.exception("PEC updates of invoice %s not applied", move_id)
+                for index in indexes:
+                    position = bisect.bisect_right(starts, index) - 1
+                    if position >= 0:
+                        failures.setdefault(sources[position][1], str(e))
+        failures.pop(None, None)
+        return failures
+
+
 class AccountMove(models.Model):
     _inherit = "account.move"
 
@@ -83,16 +224,14 @@ class AccountMove(models.Model):
         progressivo = self._l10n_it_edi_pec_get_or_create_progressivo()
         raw = vals.get("raw") or b""
 
-        try:
-            root = etree.fromstring(raw)
-        except Exception:
+        # The header comes first: only its ProgressivoInvio is rewritten,
+        # without building the tree of the whole invoice
+        raw, count = PROGRESSIVO_INVIO_REGEX.subn(
+            rb"\g<1>" + progressivo.encode() + rb"\g<2>", raw, count=1
+        )
+        if not count:
             return vals
 
-        nodes = root.xpath('//*[local-name()="ProgressivoInvio"][1]')
-        if nodes:
-            nodes[0].text = progressivo
-        raw = etree.tostring(root, xml_declaration=True, encoding="UTF-8")
-
         company = self.company_id._l10n_it_get_edi_company()
         country_code = company.country_id.code
         codice = company.partner_id._l10n_it_edi_normalized_codice_fiscale()
@@ -101,39 +240,26 @@ class AccountMove(models.Model):
         vals["raw"] = raw
         return vals
 
-    def _l10n_it_edi_pec_xml_text(self, root, node_name, default=""):
-        try:
-            return (root.xpath(f'string(//*[local-name()="{node_name}"][1])') or "").strip() or default
-        except Exception:
-            return default
-
     def _l10n_it_edi_pec_filename_from_attachment_xml(self, attachment):
         self.ensure_one()
 
         if not attachment:
             return None
 
-        raw = attachment.raw
-        if not raw and attachment.datas:
-            try:
-                raw = base64.b64decode(attachment.datas)
-            except Exception:
-                raw = b""
-        if not raw:
-            return None
-
+        attachment = attachment.sudo()
         try:
-            root = etree.fromstring(raw)
-        except Exception:
+            if attachment.store_fname:
+                with open(attachment._full_path(attachment.store_fname), "rb") as source:
+                    id_paese, id_codice, progressive = fatturapa_transmission_header(source)
+            elif attachment.raw:
+                id_paese, id_codice, progressive = fatturapa_transmission_header(
+                    io.BytesIO(attachment.raw)
+                )
+            else:
+                return None
+        except (OSError, etree.LxmlError):
             return None
 
-        id_paese = (root.xpath('string(//*[local-name()="IdTrasmittente"]/*[local-name()="IdPaese"][1])') or "").strip()
-        id_codice = (root.xpath('string(//*[local-name()="IdTrasmittente"]/*[local-name()="IdCodice"][1])') or "").strip()
-        progressive = (
-            root.xpath('string(//*[local-name()="DatiTrasmissione"]/*[local-name()="ProgressivoInvio"][1])')
-            or ""
-        ).strip()
-
         if not (id_paese and id_codice and progressive):
             return None
 
@@ -147,8 +273,17 @@ class AccountMove(models.Model):
         desired = self._l10n_it_edi_pec_filename_from_attachment_xml(attachment)
         if desired and attachment.name != desired:
             attachment.sudo().write({"name": desired})
+        self._l10n_it_edi_pec_set_key(attachment.name)
         return attachment
 
+    def _l10n_it_edi_pec_set_key(self, filename):
+        """Store the normalized key of the e-invoice file ``filename``"""
+        self.ensure_one()
+        filename_key = pec_filename_key(filename)
+        key = filename_key.invoice_key if filename_key else False
+        if self.l10n_it_edi_pec_key != key:
+            self.sudo().l10n_it_edi_pec_key = key
+
     l10n_it_edi_pec_state = fields.Selection(
         selection=[
             ("to_send", "To Send via PEC"),
@@ -160,6 +295,30 @@ class AccountMove(models.Model):
         copy=False,
         help="Technical field to track PEC sending state",
     )
+    l10n_it_edi_pec_key = fields.Char(
+        string="E-invoice Key",
+        index=True,
+        copy=False,
+        readonly=True,
+        help="Sender id and progressive of the e-invoice file, lower-cased: "
+        "SdI notifications are matched on it",
+    )
+    l10n_it_edi_pec_sdi_id = fields.Char(
+        string="SdI Identifier",
+        index=True,
+        copy=False,
+        readonly=True,
+        help="IdentificativoSdI of the last transmission: the later SdI "
+        "notifications are matched on it",
+    )
+    l10n_it_edi_pec_message_id = fields.Char(
+        string="PEC Message-Id",
+        index=True,
+        copy=False,
+        readonly=True,
+        help="Message-Id of the last PEC sending: the acceptance and delivery "
+        "receipts of the PEC provider are matched on it",
+    )
     l10n_it_edi_pec_force_state = fields.Boolean(
         string="Force PEC State",
         help="Allow to force the supplier e-bill PEC export state",
@@ -263,7 +422,8 @@ class AccountMove(models.Model):
         server = company.l10n_it_edi_pec_server_id
         if company.l10n_it_edi_use_pec and server:
             try:
-                server.sudo().fetch_mail()
+                server.sudo().with_context(pec_breaker_force=True).fetch_mail()
+                self.env["fetchmail.pec.spool"].sudo()._cron_process(server_ids=server.ids)
                 return {
                     "type": "ir.actions.client",
                     "tag": "display_notification",
@@ -339,8 +499,12 @@ class AccountMove(models.Model):
         if other_moves:
             results.update(super(AccountMove, other_moves)._l10n_it_edi_send(attachments_vals))
 
+        sdi_emails = {}
         for move in pec_moves:
             move.l10n_it_edi_header = False
+            if move.company_id not in sdi_emails:
+                sdi_emails[move.company_id] = move.company_id._l10n_it_edi_pec_sdi_address()
+            sdi_email = sdi_emails[move.company_id]
             attachment_vals = attachments_vals[move]
 
             attachment = move.l10n_it_edi_attachment_id
@@ -380,18 +544,12 @@ class AccountMove(models.Model):
             filename = attachment.name
 
             try:
-                move._send_einvoice_via_pec(attachment)
+                move._send_einvoice_via_pec(attachment, sdi_email=sdi_email)
                 move.l10n_it_edi_state = "processing"
                 move.l10n_it_edi_transaction = False
                 move.l10n_it_edi_pec_state = "sent"
                 move.is_move_sent = True
 
-                sdi_email = (
-                    move.company_id.l10n_it_edi_pec_sdi_email
-                    or self.env["ir.config_parameter"].sudo().get_param(
-                        "l10n_it_edi_pec.sdi_email", default="sdi01@pec.fatturapa.it"
-                    )
-                )
                 message = _(
                     "La fattura elettronica %s è stata inviata allo SdI per l'elaborazione via PEC (%s)."
                 ) % (filename, sdi_email)
@@ -412,8 +570,12 @@ class AccountMove(models.Model):
 
         return results
 
-    def _send_einvoice_via_pec(self, attachment):
-        """Send XML file via PEC to SdI"""
+    def _send_einvoice_via_pec(self, attachment, sdi_email=None):
+        """Send XML file via PEC to SdI.
+
+        ``sdi_email`` is the SdI address of the company, when the caller
+        already resolved it.
+        """
         self.ensure_one()
 
         smtp_server = self.company_id.l10n_it_edi_pec_smtp_server_id.sudo()
@@ -422,14 +584,13 @@ class AccountMove(models.Model):
 
         msg = EmailMessage()
         msg["From"] = smtp_server.smtp_user or self.company_id.email
-        sdi_email = (
-            self.company_id.l10n_it_edi_pec_sdi_email
-            or self.env["ir.config_parameter"].sudo().get_param(
-                "l10n_it_edi_pec.sdi_email", default="sdi01@pec.fatturapa.it"
-            )
-        )
-        msg["To"] = sdi_email
+        msg["To"] = sdi_email or self.company_id._l10n_it_edi_pec_sdi_address()
         msg["Subject"] = attachment.name
+        from_addresses = email_split(msg["From"])
+        message_id = pec_message_id(
+            from_addresses[0].rpartition("@")[2] if from_addresses else None
+        )
+        msg["Message-Id"] = message_id
 
         raw = attachment.raw
         if not raw and attachment.datas:
@@ -443,6 +604,7 @@ class AccountMove(models.Model):
         )
 
         self.env["ir.mail_server"].sudo().send_email(msg, mail_server_id=smtp_server.id)
+        self.sudo().l10n_it_edi_pec_message_id = message_id
 
         _logger.info(
             "E-invoice %s sent via PEC from company %s",
@@ -452,84 +614,40 @@ class AccountMove(models.Model):
 
     def _l10n_it_edi_parse_pec_notification(self, message_dict):
         """Parse PEC notification from SdI"""
-        notification_tokens = ("_RC_", "_NS_", "_MC_", "_NE_", "_DT_", "_AT_", "_MT_")
-
-        def _iter_attachments(msg):
-            for att in (msg or {}).get("attachments", []) or []:
-                fname = getattr(att, "fname", "")
-                content = getattr(att, "content", None)
-                if not fname and isinstance(att, dict):
-                    fname = att.get("fname") or att.get("name") or ""
-                    content = att.get("content")
-                if not fname and isinstance(att, (tuple, list)) and att:
-                    fname = att[0] or ""
-                    content = att[1] if len(att) > 1 else None
-                yield fname or "", content
-
-        def _payload_bytes(raw):
-            if raw is None:
-                return b""
-            if isinstance(raw, str):
-                raw = raw.encode()
-            elif isinstance(raw, (bytes, bytearray)):
-                raw = bytes(raw)
-            else:
-                raw = str(raw or "").encode()
-
-            try:
-                decoded = base64.b64decode(raw, validate=True)
-            except Exception:
-                try:
-                    decoded = base64.b64decode(raw)
-                except Exception:
-                    decoded = b""
-
-            if decoded:
-                head = decoded[:200].lstrip()
-                if head.startswith(b"<") or b"<" in head:
-                    return decoded
-            return raw
-
-        def _type_from_filename(fname):
-            upper = (fname or "").upper()
-            for token in notification_tokens:
-                if token in upper:
-                    return token.strip("_")
-            return "UNKNOWN"
-
         notifications = []
-        for fname, content in _iter_attachments(message_dict):
-            upper = fname.upper()
-            if not any(tok in upper for tok in notification_tokens):
+        for attachment in pec_attachments((message_dict or {}).get("attachments")):
+            filename_key = attachment.filename_key
+            if not filename_key or filename_key.notification_type not in SDI_NOTIFICATION_TYPES:
                 continue
-            if not fname.lower().endswith((".xml", ".xml.p7m", ".p7m")):
+            if filename_key.extension not in ("xml", "p7m"):
                 continue
-            notifications.append((fname, content))
+            notifications.append(attachment)
 
         if not notifications:
             return None
 
         # Parse notification XML
         notification_data = {}
-        for fname, content in notifications:
+        for attachment in notifications:
+            fname = attachment.fname
             try:
-                xml_bytes = _payload_bytes(content)
+                xml_bytes = attachment.payload
                 msg_attachments = [(fname, xml_bytes)] if xml_bytes else []
 
-                root = etree.fromstring(xml_bytes)
-                notification_type = self._detect_notification_type(root)
+                root, notification = attachment.parse_notification()
                 notification_data = {
-                    "type": notification_type,
+                    "type": notification.type,
                     "filename": fname,
                     "xml": root,
+                    "notification": notification,
                     "msg_attachments": msg_attachments,
                 }
 
                 self._process_sdi_notification(notification_data)
                 
             except Exception as e:
-                raw = _payload_bytes(content)
-                notification_type = _type_from_filename(fname)
+                raw = attachment.payload
+                notification_type = attachment.filename_key.notification_type
 
                 self._process_sdi_notification_fallback(
                     notification_type,
@@ -553,6 +671,81 @@ class AccountMove(models.Model):
 
         return notification_data
 
+    def _l10n_it_edi_pec_update(self, edi_state=None, pec_state=None, body="", attachments=None):
+        """Apply the effect of a SdI notification or PEC receipt.
+
+        In a spool run it is queued in the ``pec_move_updates`` of the
+        context instead, and applied with the others of the invoice.
+        """
+        self.ensure_one()
+        update = PecMoveUpdate(
+            self.id, edi_state, pec_state, body, pec_post_attachments(attachments)
+        )
+        move_updates = self.env.context.get("pec_move_updates")
+        if move_updates is not None:
+            move_updates.updates.append(update)
+        else:
+            self._l10n_it_edi_pec_apply_updates([update])
+
+    @api.model
+    def _l10n_it_edi_pec_apply_updates(self, updates):
+        """Apply ``updates`` (``PecMoveUpdate``) in bulk.
+
+        Each invoice gets the states that win by SdI precedence, written
+        once, and a single chatter entry logging all its updates, without
+        notifying the followers. The PEC state follows the SdI state once
+        the SdI answered, otherwise the PEC receipts.
+        """
+        updates_by_move = {}
+        for update in updates:
+            updates_by_move.setdefault(update.move_id, []).append(update)
+        moves = self.browse(list(updates_by_move)).exists()
+
+        moves_by_vals = {}
+        attachment_vals_list = []
+        logs = []
+        for move in moves:
+            move_updates = updates_by_move[move.id]
+            edi_state = move.l10n_it_edi_state
+            pec_state = move.l10n_it_edi_pec_state
+            for update in move_updates:
+                if update.edi_state and SDI_STATE_PRECEDENCE.get(
+                    update.edi_state, 0
+                ) >= SDI_STATE_PRECEDENCE.get(edi_state, -1):
+                    edi_state = update.edi_state
+                if update.pec_state and PEC_STATE_PRECEDENCE.get(
+                    update.pec_state, 0
+                ) >= PEC_STATE_PRECEDENCE.get(pec_state, -1):
+                    pec_state = update.pec_state
+            if SDI_STATE_PRECEDENCE.get(edi_state, 0) > 0:
+                pec_state = PEC_STATE_BY_SDI_STATE.get(edi_state, pec_state)
+
+            vals = {}
+            if edi_state != move.l10n_it_edi_state:
+                vals["l10n_it_edi_state"] = edi_state
+            if pec_state != move.l10n_it_edi_pec_state:
+                vals["l10n_it_edi_pec_state"] = pec_state
+            if vals:
+                moves_by_vals.setdefault(tuple(sorted(vals.items())), []).append(move.id)
+
+            attachments = {}
+            for update in move_updates:
+                for name, payload in update.attachments:
+                    attachments.setdefault(name.lower(), (name, payload))
+            first_attachment = len(attachment_vals_list)
+            attachment_vals_list += [
+                {"name": name, "raw": payload, "res_model": self._name, "res_id": move.id}
+                for name, payload in attachments.values()
+            ]
+            body = Markup("<br/>").join(update.body for update in move_updates if update.body)
+            logs.append((move, body, first_attachment, len(attachment_vals_list)))
+
+        for vals, move_ids in moves_by_vals.items():
+            self.browse(move_ids).write(dict(vals))
+        attachment_ids = self.env["ir.attachment"].create(attachment_vals_list).ids
+        for move, body, start, stop in logs:
+            move._message_log(body=body, attachment_ids=attachment_ids[start:stop])
+
     def _process_sdi_notification_fallback(self, notification_type, filename, msg_attachments=None, error=None):
         self.ensure_one()
 
@@ -567,13 +760,6 @@ class AccountMove(models.Model):
             "UNKNOWN": "processing",
         }
         new_state = state_mapping.get(notification_type or "UNKNOWN", "processing")
-        self.l10n_it_edi_state = new_state
-        if new_state in {"processing", "being_sent"}:
-            self.l10n_it_edi_pec_state = "sent"
-        elif new_state in {"forwarded", "accepted_by_pa_partner", "accepted_by_pa_partner_after_expiry"}:
-            self.l10n_it_edi_pec_state = "delivered"
-        elif new_state in {"forward_failed", "rejected", "rejected_by_pa_partner"}:
-            self.l10n_it_edi_pec_state = "error"
 
         extra = f" - {error}" if error else ""
         msg = _("Risposta SdI %s: stato %s (file: %s)%s") % (
@@ -582,14 +768,31 @@ class AccountMove(models.Model):
             filename,
             extra,
         )
-        self.message_post(body=msg, attachments=msg_attachments or [])
+        self._l10n_it_edi_pec_update(
+            new_state, PEC_STATE_BY_SDI_STATE.get(new_state), msg, msg_attachments
+        )
+
+    def _l10n_it_edi_apply_pec_receipt(self, message_dict, receipt=None):
+        """Apply a PEC provider receipt to the invoice.
 
-    def _l10n_it_edi_apply_pec_receipt(self, message_dict):
+        The type of ``receipt`` (a ``PecReceipt``) comes from the receipt
+        headers or its ``daticert.xml``; without it the subject is parsed.
+        """
         self.ensure_one()
         subject = (message_dict or {}).get("subject") or ""
         subject_upper = subject.upper()
+        receipt_states = {
+            "accettazione": ("sent", _("Accettazione PEC")),
+            "presa-in-carico": ("sent", _("Presa in carico PEC")),
+            "non-accettazione": ("error", _("Mancata accettazione PEC")),
+            "avvenuta-consegna": ("delivered", _("Consegna PEC")),
+            "errore-consegna": ("error", _("Mancata consegna PEC")),
+            "preavviso-errore-consegna": ("error", _("Mancata consegna PEC")),
+        }
 
-        if "MANCATA CONSEGNA" in subject_upper:
+        if receipt and receipt.type in receipt_states:
+            pec_state, label = receipt_states[receipt.type]
+        elif "MANCATA CONSEGNA" in subject_upper:
             pec_state = "error"
             label = _("Mancata consegna PEC")
         elif "CONSEGNA" in subject_upper:
@@ -601,72 +804,27 @@ class AccountMove(models.Model):
         else:
             return False
 
-        msg_attachments = []
-        seen = set()
-        for att in (message_dict or {}).get("attachments", []) or []:
-            fname = getattr(att, "fname", "")
-            content = getattr(att, "content", None)
-            if not fname and isinstance(att, dict):
-                fname = att.get("fname") or att.get("name") or ""
-                content = att.get("content")
-            if not fname and isinstance(att, (tuple, list)) and att:
-                fname = att[0] or ""
-                content = att[1] if len(att) > 1 else None
-
-            if not fname or not content:
-                continue
-
-            key = fname.strip().lower()
-            if not key or key in seen:
-                continue
-            seen.add(key)
-
-            if isinstance(content, str):
-                content = content.encode()
-            elif not isinstance(content, (bytes, bytearray)):
-                content = str(content).encode()
-
-            try:
-                decoded = base64.b64decode(content, validate=True)
-                if decoded:
-                    content = decoded
-            except Exception:
-                pass
-
-            msg_attachments.append((fname, content))
-
-        if not self.l10n_it_edi_state:
-            self.l10n_it_edi_state = "processing"
-        self.l10n_it_edi_pec_state = pec_state
-
-        self.message_post(body=_("%s: %s") % (label, subject), attachments=msg_attachments)
+        self._l10n_it_edi_pec_update(
+            None if self.l10n_it_edi_state else "processing",
+            pec_state,
+            _("%s: %s") % (label, subject),
+            (message_dict or {}).get("attachments"),
+        )
         return True
 
     def _detect_notification_type(self, root):
         """Detect type of SdI notification"""
-        if self._l10n_it_edi_pec_xml_text(root, "ListaErrori"):
-            return "NS"
-        if self._l10n_it_edi_pec_xml_text(root, "DataOraConsegna"):
-            return "RC"
-        if self._l10n_it_edi_pec_xml_text(root, "EsitoCommittente"):
-            return "NE"
-        root_name = (getattr(root, "tag", "") or "")
-        if root_name.endswith("DecorrenzaTermini") or self._l10n_it_edi_pec_xml_text(root, "DecorrenzaTermini"):
-            return "DT"
-        if root_name.endswith("AttestazioneTrasmissioneFattura") or self._l10n_it_edi_pec_xml_text(root, "AttestazioneTrasmissioneFattura"):
-            return "AT"
-        desc_text = self._l10n_it_edi_pec_xml_text(root, "Descrizione")
-        if desc_text and "consegna" in desc_text.lower():
-            return "MC"
-        return "UNKNOWN"
+        return sdi_notification(root).type
 
     def _process_sdi_notification(self, notification_data):
         """Process SdI notification and post it to the related invoice."""
         self.ensure_one()
 
-        notification_type = notification_data.get("type")
-        root = notification_data.get("xml")
-        
+        notification = notification_data.get("notification")
+        if notification is None:
+            notification = sdi_notification(notification_data.get("xml"))
+        notification_type = notification_data.get("type") or notification.type
+
         state_mapping = {
             "NS": "rejected",
             "MC": "forward_failed",
@@ -674,12 +832,11 @@ class AccountMove(models.Model):
             "DT": "accepted_by_pa_partner_after_expiry",
             "AT": "processing",
         }
-        
+
         if notification_type == "NE":
-            esito_text = self._l10n_it_edi_pec_xml_text(root, "Esito")
-            if esito_text == "EC01":
+            if notification.esito == "EC01":
                 new_state = "accepted_by_pa_partner"
-            elif esito_text == "EC02":
+            elif notification.esito == "EC02":
                 new_state = "rejected_by_pa_partner"
             else:
                 new_state = "processing"
@@ -687,25 +844,11 @@ class AccountMove(models.Model):
             new_state = state_mapping.get(notification_type, "processing")
 
         # Extract additional info
-        id_sdi_text = self._l10n_it_edi_pec_xml_text(root, "IdentificativoSdI", default="N/A")
-        
-        detail = ""
+        id_sdi_text = notification.identificativo_sdi or "N/A"
         if notification_type == "NS":
-            try:
-                descs = [
-                    (d or "").strip()
-                    for d in root.xpath('//*[local-name()="Descrizione"]/text()')
-                ]
-            except Exception:
-                descs = []
-            detail = ", ".join([d for d in descs if d])
-        elif notification_type == "NE":
-            detail = self._l10n_it_edi_pec_xml_text(root, "Descrizione")
-        elif notification_type == "MC":
-            detail = self._l10n_it_edi_pec_xml_text(root, "Descrizione")
-
-        if not detail:
-            detail = self._l10n_it_edi_pec_xml_text(root, "Descrizione")
+            detail = ", ".join(notification.descriptions)
+        else:
+            detail = notification.description
         msg = _(
             "Risposta SdI %s: stato %s (Id SdI: %s)%s"
         ) % (
@@ -715,41 +858,23 @@ class AccountMove(models.Model):
             (" - " + detail) if detail else "",
         )
 
-        self.l10n_it_edi_state = new_state
-        if new_state in {"processing", "being_sent"}:
-            self.l10n_it_edi_pec_state = "sent"
-        elif new_state in {
-            "forwarded",
-            "accepted_by_pa_partner",
-            "accepted_by_pa_partner_after_expiry",
-        }:
-            self.l10n_it_edi_pec_state = "delivered"
-        elif new_state in {"forward_failed", "rejected", "rejected_by_pa_partner"}:
-            self.l10n_it_edi_pec_state = "error"
-
-        msg_attachments = []
-        seen = set()
-        for name, content in (notification_data.get("msg_attachments") or []):
-            if not name or not content:
-                continue
-            key = (name or "").strip().lower()
-            if not key or key in seen:
-                continue
-            seen.add(key)
-            if isinstance(content, str):
-                content = content.encode()
-            elif not isinstance(content, (bytes, bytearray)):
-                content = str(content).encode()
-
-            try:
-                decoded = base64.b64decode(content, validate=True)
-                if decoded:
-                    content = decoded
-            except Exception:
-                pass
-            msg_attachments.append((name, content))
-
-        self.message_post(body=msg, attachments=msg_attachments)
+        # RC, NS and MC are the first notification of a transmission: an
+        # invoice sent again after a rejection gets a new identifier
+        if notification.identificativo_sdi and (
+            notification_type in SDI_TRANSMISSION_NOTIFICATION_TYPES
+            or not self.l10n_it_edi_pec_sdi_id
+        ):
+            self.sudo().l10n_it_edi_pec_sdi_id = notification.identificativo_sdi
+            match_cache = self.env.context.get("pec_match_cache")
+            if match_cache is not None:
+                match_cache.sdi_ids[notification.identificativo_sdi] = self.id
+
+        self._l10n_it_edi_pec_update(
+            new_state,
+            PEC_STATE_BY_SDI_STATE.get(new_state),
+            msg,
+            notification_data.get("msg_attachments"),
+        )
         
         _logger.info(
             "Processed SdI notification %s for invoice %s: new state %s",
@@ -0,0 +1,437 @@
+# Copyright 2025 Your Company
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import config
+
+from .account_move import PecMoveUpdates
+from .mail_thread import PEC_RECEIPT_REFERENCE_HEADER, PecMatchCache
+
+_logger = logging.getLogger(__name__)
+SPOOL_DIRECTORY = "pec_spool"
+SPOOL_DONE_RETENTION_DAYS = 30
+QUARANTINE_MAX_ATTEMPTS = 5
+QUARANTINE_BACKOFF = 300
+
+
+class _PecUpdatesFailed(Exception):
+    """Rolls back a commit batch whose invoice updates could not be applied"""
+
+
+class FetchmailPecSpool(models.Model):
+    """Raw PEC messages downloaded from a server and waiting for routing.
+
+    Downloading only writes the message to the spool and acknowledges it on
+    the server; ``_process_pending`` feeds the spooled messages to
+    ``message_process`` independently from the mailbox session. Messages
+    above ``fetchmail.pec.stream.threshold`` bytes are streamed from the
+    spool file instead (see ``mail.thread._pec_message_process_file``).
+
+    The spool is also the quarantine of messages that cannot be processed:
+    failed entries are retried with an exponential backoff and parked after
+    ``fetchmail.pec.quarantine.max_attempts`` attempts. Parked entries are
+    only reprocessed on demand, and the fetch skips their Message-Id.
+    """
+
+    _name = "fetchmail.pec.spool"
+    _description = "PEC message spool"
+    _order = "id"
+
+    server_id = fields.Many2one(
+        "fetchmail.server",
+        string="Server",
+        required=True,
+        index=True,
+        ondelete="cascade",
+    )
+    message_id = fields.Char("Message-Id", index=True, readonly=True)
+    subject = fields.Char(readonly=True)
+    reference_message_id = fields.Char(
+        "Referenced Message-Id",
+        readonly=True,
+        help="Message-Id of the sent e-invoice a PEC receipt refers to",
+    )
+    size = fields.Integer(readonly=True)
+    checksum = fields.Char(index=True, readonly=True)
+    store_fname = fields.Char("Spool file", readonly=True)
+    state = fields.Selection(
+        selection=[
+            ("pending", "Pending"),
+            ("error", "Error"),
+            ("parked", "Parked"),
+            ("done", "Processed"),
+        ],
+        default="pending",
+        required=True,
+        index=True,
+    )
+    attempts = fields.Integer(readonly=True)
+    next_attempt = fields.Datetime(
+        readonly=True,
+        index=True,
+        help="A failed message is not retried before this time",
+    )
+    error_message = fields.Text(readonly=True)
+
+    @api.model
+    def _spool_directory(self, server):
+        path = os.path.join(
+            config.filestore(self.env.cr.dbname), SPOOL_DIRECTORY, str(server.id)
+        )
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @api.model
+    def _spool_message(self, server, raw_message, headers=None):
+        """Durably store ``raw_message`` for ``server`` and index it"""
+        return self._spool_chunks(server, [raw_message], headers)
+
+    @api.model
+    def _spool_chunks(self, server, chunks, headers=None):
+        """Durably store the message made of the bytes ``chunks`` and index it.
+
+        ``chunks`` can be a generator reading from the mail server, so large
+        messages are written to disk without being held in memory. A message
+        already spooled for the server, by Message-Id or content, is not
+        stored twice: this happens when the previous session could not
+        acknowledge it on the mail server.
+        """
+        directory = self._spool_directory(server)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as spool_file:
+                for chunk in chunks:
+                    spool_file.write(chunk)
+                    sha1.update(chunk)
+                    size += len(chunk)
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+        except BaseException:
+            self._unlink_spool_file(tmp_path)
+            raise
+
+        checksum = sha1.hexdigest()
+        message_id = ((headers or {}).get("Message-Id") or "").strip()
+        domain = [("server_id", "=", server.id)]
+        if message_id:
+            domain += ["|", ("message_id", "=", message_id), ("checksum", "=", checksum)]
+        else:
+            domain += [("checksum", "=", checksum)]
+        existing = self.search(domain, limit=1)
+        if existing:
+            self._unlink_spool_file(tmp_path)
+            return existing
+
+        path = os.path.join(directory, checksum + ".eml")
+        os.replace(tmp_path, path)
+        self.env.cr.postrollback.add(lambda: self._unlink_spool_file(path))
+
+        return self.create(
+            {
+                "server_id": server.id,
+                "message_id": message_id or False,
+                "subject": str((headers or {}).get("Subject") or "")[:255] or False,
+                "reference_message_id": str(
+                    (headers or {}).get(PEC_RECEIPT_REFERENCE_HEADER) or ""
+                ).strip()
+                or False,
+                "size": size,
+                "checksum": checksum,
+                "store_fname": path,
+            }
+        )
+
+    @api.model
+    def _spooled_message_ids(self, server, message_ids):
+        """Return the ``message_ids`` already spooled for ``server``.
+
+        Used at header-prefetch time: these messages, parked ones included,
+        are not downloaded again.
+        """
+        message_ids = [mid for mid in message_ids if mid]
+        if not message_ids:
+            return set()
+        entries = self.search_read(
+            [("server_id", "=", server.id), ("message_id", "in", message_ids)],
+            ["message_id"],
+        )
+        return {entry["message_id"] for entry in entries}
+
+    @api.model
+    def _quarantine_policy(self):
+        """Return the ``(max attempts, base backoff seconds)`` of failed entries"""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        try:
+            max_attempts = int(
+                get_param("fetchmail.pec.quarantine.max_attempts", QUARANTINE_MAX_ATTEMPTS)
+            )
+            backoff = int(get_param("fetchmail.pec.quarantine.backoff", QUARANTINE_BACKOFF))
+        except (TypeError, ValueError):
+            max_attempts, backoff = QUARANTINE_MAX_ATTEMPTS, QUARANTINE_BACKOFF
+        return max(max_attempts, 1), max(backoff, 0)
+
+    def _record_failure(self, error_message):
+        """Count a failed attempt; return True when the entry gets parked"""
+        self.ensure_one()
+        max_attempts, backoff = self._quarantine_policy()
+        attempts = self.attempts + 1
+        vals = {"attempts": attempts, "error_message": error_message}
+        if attempts >= max_attempts:
+            vals.update(state="parked", next_attempt=False)
+        else:
+            vals.update(
+                state="error",
+                next_attempt=fields.Datetime.add(
+                    fields.Datetime.now(), seconds=backoff * 2 ** (attempts - 1)
+                ),
+            )
+        self.write(vals)
+        return self.state == "parked"
+
+    @api.model
+    def _unlink_spool_file(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            _logger.warning("Could not remove PEC spool file %s", path, exc_info=True)
+
+    def _read_raw(self):
+        self.ensure_one()
+        with open(self.store_fname, "rb") as spool_file:
+            return spool_file.read()
+
+    def _pec_match_keys(self):
+        """Return the ``PecMatchKeys`` of the entries, from their headers"""
+        MailThread = self.env["mail.thread"]
+        return [
+            MailThread._pec_subject_match_keys(entry.subject, entry.reference_message_id)
+            for entry in self
+        ]
+
+    def _lock_for_processing(self):
+        """Lock the entries still to route until the next commit.
+
+        The cron and a manual check can drain the spool at the same time:
+        entries locked by the other transaction, or routed by it since they
+        were read, are left out.
+        """
+        if not self:
+            return self
+        self.flush_recordset(["state"])
+        self.env.cr.execute(
+            """
+            SELECT id
+              FROM fetchmail_pec_spool
+             WHERE id IN %s
+               AND state != 'done'
+               FOR UPDATE SKIP LOCKED
+            """,
+            (tuple(self.ids),),
+        )
+        locked_ids = {row[0] for row in self.env.cr.fetchall()}
+        locked = self.filtered(lambda e: e.id in locked_ids)
+        locked.invalidate_recordset()
+        return locked
+
+    def _mark_done(self):
+        paths = [path for path in self.mapped("store_fname") if path]
+        self.write(
+            {
+                "state": "done",
+                "store_fname": False,
+                "error_message": False,
+                "next_attempt": False,
+            }
+        )
+        for path in paths:
+            self.env.cr.postcommit.add(lambda path=path: self._unlink_spool_file(path))
+
+    def _process_pending(self):
+        """Route the spooled messages of a single server.
+
+        Each message runs in its own savepoint and the work is committed in
+        batches, following the server commit policy. The run stops when the
+        server budget is spent. The updates of the invoices of a batch are
+        applied when it is committed, merged per invoice; when they fail,
+        the batch is rolled back and routed again entry by entry, each one
+        with the updates of its invoices, so only the entries whose updates
+        fail are retried and no routing is applied twice. The entries of a
+        batch are locked first (see ``_lock_for_processing``).
+        """
+        server = self.server_id.sudo()
+        server.ensure_one()
+        additional_context = {
+            "fetchmail_cron_running": True,
+            "fetchmail_server_id": server.id,
+            "server_type": server.server_type or "imap",
+        }
+        server = server.with_context(**additional_context)
+        # The updates of the invoices are applied per commit batch, merged
+        # per invoice
+        move_updates = PecMoveUpdates()
+        match_cache = PecMatchCache()
+        MailThread = self.env["mail.thread"].sudo().with_context(
+            pec_match_cache=match_cache,
+            pec_move_updates=move_updates,
+            **additional_context,
+        )
+        commit_size, commit_interval = server._pec_commit_policy()
+        stream_threshold = server._pec_stream_threshold()
+        budget = server._pec_run_budget()
+
+        error_messages = []
+
+        def _record_failure(entry, error_message):
+            if entry._record_failure(error_message):
+                # Only parking is notified, not every failed attempt
+                error_messages.append(
+                    _(
+                        "PEC message %(message_id)s parked after %(attempts)s "
+                        "failed attempts: %(error)s"
+                    )
+                    % {
+                        "message_id": entry.message_id or entry.subject or entry.id,
+                        "attempts": entry.attempts,
+                        "error": entry.error_message,
+                    }
+                )
+
+        def _route(entry, flush=False):
+            """Route ``entry`` in its own savepoint; return whether it succeeded.
+
+            With ``flush``, the updates of its invoices are applied in the
+            savepoint too and the entry fails when they fail.
+            """
+            mark = move_updates.mark(entry.id)
+            try:
+                with self.env.cr.savepoint():
+                    if entry.size > stream_threshold:
+                        MailThread._pec_message_process_file(entry.store_fname)
+                    else:
+                        MailThread.message_process(
+                            "mail.thread",
+                            entry._read_raw(),
+                            save_original=True,
+                            strip_attachments=False,
+                        )
+                    if flush:
+                        error_message = move_updates.flush(self.env).get(entry.id)
+                        if error_message:
+                            raise UserError(error_message)
+                server.last_pec_error_message = ""
+                return True
+            except Exception as e:
+                move_updates.discard(mark)
+                server.manage_pec_failure(e, [])
+                _record_failure(entry, server.last_pec_error_message)
+                return False
+
+        index = 0
+        while index < len(self):
+            if budget.exhausted:
+                # The rest is left to the next run, scheduled right away
+                self._trigger_processing()
+                break
+            batch = self[index:index + commit_size]
+            if budget.max_messages:
+                batch = batch[: budget.max_messages - budget.messages]
+            locked = batch._lock_for_processing()
+            # The invoices of the commit batch are resolved before routing
+            # it, from the headers stored with the entries
+            MailThread._pec_prefetch_matches(locked._pec_match_keys())
+            batch_start = time.monotonic()
+            first_error = len(error_messages)
+            attempted = routed = self.browse()
+            try:
+                with self.env.cr.savepoint():
+                    for entry in batch:
+                        index += 1
+                        if entry not in locked:
+                            continue
+                        budget.consume()
+                        attempted |= entry
+                        if _route(entry):
+                            routed |= entry
+                        if (
+                            budget.exhausted
+                            or time.monotonic() - batch_start >= commit_interval
+                        ):
+                            break
+                    if move_updates.flush(self.env):
+                        raise _PecUpdatesFailed()
+            except _PecUpdatesFailed:
+                _logger.info(
+                    "PEC invoice updates of %s spool entries failed, routing them one by one",
+                    len(attempted),
+                )
+                del error_messages[first_error:]
+                match_cache.clear()
+                MailThread._pec_prefetch_matches(attempted._pec_match_keys())
+                routed = self.browse()
+                for entry in attempted:
+                    if _route(entry, flush=True):
+                        routed |= entry
+            routed._mark_done()
+            self.env.cr.commit()
+
+        if error_messages:
+            server.notify_or_log(error_messages)
+
+    @api.model
+    def _cron_process(self, server_ids=None):
+        """Drain the spool, server by server, retrying failed entries when due"""
+        domain = [
+            "|",
+            ("state", "=", "pending"),
+            "&",
+            ("state", "=", "error"),
+            "|",
+            ("next_attempt", "=", False),
+            ("next_attempt", "<=", fields.Datetime.now()),
+        ]
+        if server_ids:
+            domain.append(("server_id", "in", server_ids))
+        self.search(domain)._process_pending_by_server()
+
+    @api.model
+    def _trigger_processing(self):
+        cron = self.env.ref(
+            "l10n_it_edi_pec.ir_cron_fetchmail_pec_spool", raise_if_not_found=False
+        )
+        if cron and self.search_count([("state", "=", "pending")], limit=1):
+            cron._trigger()
+
+    def action_reprocess(self):
+        entries = self.filtered(lambda e: e.state in ("error", "parked"))
+        entries.next_attempt = False
+        entries._process_pending_by_server()
+        return True
+
+    def _process_pending_by_server(self):
+        for server in self.server_id:
+            self.filtered(lambda e: e.server_id == server)._process_pending()
+
+    @api.autovacuum
+    def _gc_done_entries(self):
+        limit_date = fields.Datetime.subtract(
+            fields.Datetime.now(), days=SPOOL_DONE_RETENTION_DAYS
+        )
+        self.search([("state", "=", "done"), ("write_date", "<", limit_date)]).unlink()
+
+    def unlink(self):
+        paths = [path for path in self.mapped("store_fname") if path]
+        res = super().unlink()
+        for path in paths:
+            self.env.cr.postcommit.add(lambda path=path: self._unlink_spool_file(path))
+        return res
@@ -1,15 +1,287 @@
 # Copyright 2025 Your Company
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import imaplib
+import json
 import logging
+import poplib
+import queue
+import random
+import re
+import select
+import ssl
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 from email import policy
 from email.parser import BytesParser
 
-from odoo import _, fields, models
-from odoo.exceptions import ValidationError
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import config, ormcache
+
+from .mail_thread import PEC_RECEIPT_REFERENCE_HEADER, is_pec_message_id
 
 _logger = logging.getLogger(__name__)
-MAX_POP_MESSAGES = 50
+PEC_RUN_MAX_MESSAGES = 200
+PEC_RUN_MAX_SECONDS = 120
+PEC_SOCKET_TIMEOUT = 60
+PEC_BREAKER_BACKOFF = 300
+PEC_BREAKER_MAX_BACKOFF = 6 * 3600
+SDI_PEC_DOMAIN = "@pec.fatturapa.it"
+PEC_HEADER_FIELDS = "FROM REPLY-TO RETURN-PATH MESSAGE-ID SUBJECT X-RIFERIMENTO-MESSAGE-ID"
+IMAP_FETCH_UID_REGEX = re.compile(rb"\bUID (?P<uid>\d+)")
+IMAP_FETCH_SIZE_REGEX = re.compile(rb"\bRFC822\.SIZE (?P<size>\d+)")
+IMAP_BATCH_SIZE = 100
+PEC_FETCH_WORKERS = 4
+PEC_COMMIT_BATCH_SIZE = 50
+PEC_COMMIT_INTERVAL = 30
+IMAP_IDLE_SESSION = 600
+IMAP_IDLE_TIMEOUT = 240
+PEC_STREAM_THRESHOLD = 5 * 1024 * 1024
+IMAP_IDLE_EVENT_REGEX = re.compile(rb"^\* \d+ (EXISTS|RECENT)\b", re.MULTILINE)
+
+
+def _imap_open(params):
+    """Open and authenticate an IMAP connection from plain parameters.
+
+    No ORM access happens here, so it can run outside the request thread.
+    """
+    timeout = params.get("timeout") or None
+    if params["is_ssl"]:
+        imap_server = imaplib.IMAP4_SSL(params["host"], params["port"] or 993, timeout=timeout)
+    else:
+        imap_server = imaplib.IMAP4(params["host"], params["port"] or 143, timeout=timeout)
+    if params["user"]:
+        imap_server.login(params["user"], params["password"] or "")
+    return imap_server
+
+
+def _imap_new_tag(imap_server):
+    """Return a tag for a command ``imaplib`` does not implement, like IDLE.
+
+    Relies on the private ``_new_tag`` of ``imaplib``.
+    """
+    return imap_server._new_tag()
+
+
+def _imap_has_buffered_data(imap_server):
+    """Return True when response data can be read without waiting.
+
+    ``imaplib`` reads through a buffered file: a response received along
+    with the previous line sits in its buffer, where ``select`` on the
+    socket cannot see it. The buffer is peeked with the socket briefly non
+    blocking.
+    """
+    sock = imap_server.sock
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(imap_server.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _imap_idle(imap_server, timeout):
+    """Run one IDLE command for at most ``timeout`` seconds.
+
+    Returns True as soon as the server announces new messages.
+    """
+    tag = _imap_new_tag(imap_server)
+    imap_server.send(tag + b" IDLE\r\n")
+    while True:
+        line = imap_server.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while starting IDLE")
+        if line.startswith(b"+"):
+            break
+        if line.startswith(tag):
+            raise imaplib.IMAP4.error("IDLE refused: %r" % line)
+
+    deadline = time.monotonic() + timeout
+    activity = False
+    while not activity:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not _imap_has_buffered_data(imap_server):
+            ready, _write, _error = select.select([imap_server.sock], [], [], remaining)
+            if not ready:
+                continue
+        line = imap_server.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if line.startswith(tag):
+            # The server ended the IDLE command itself
+            return activity
+        activity = bool(IMAP_IDLE_EVENT_REGEX.match(line))
+
+    imap_server.send(b"DONE\r\n")
+    while True:
+        line = imap_server.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+        if line.startswith(tag):
+            break
+    return activity
+
+
+def _imap_idle_watch(params, last_uid, deadline, idle_timeout, notify):
+    """Keep an IDLE session open until ``deadline`` and call ``notify``
+    whenever new messages reach the mailbox."""
+    imap_server = _imap_open(params)
+    try:
+        if "IDLE" not in imap_server.capabilities:
+            raise imaplib.IMAP4.error("server does not support IDLE")
+        imap_server.select()
+        uidnext = _imap_response_value(imap_server, "UIDNEXT")
+        if uidnext and uidnext.isdigit() and int(uidnext) > last_uid + 1:
+            notify()
+        while time.monotonic() < deadline:
+            timeout = min(idle_timeout, deadline - time.monotonic())
+            if _imap_idle(imap_server, timeout):
+                notify()
+    finally:
+        try:
+            imap_server.logout()
+        except Exception:
+            pass
+
+
+def _imap_uid_set(uids):
+    """Build a compact IMAP sequence set, e.g. ``1001:1100,1205``"""
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(
+        str(first) if first == last else "%d:%d" % (first, last)
+        for first, last in ranges
+    )
+
+
+def _imap_response_value(imap_server, code):
+    """Return the value of a SELECT response code such as UIDNEXT"""
+    typ, data = imap_server.response(code)
+    value = data[-1] if data else None
+    if isinstance(value, bytes):
+        value = value.decode()
+    return (value or "").strip() or None
+
+
+def _parse_imap_fetch_response(data):
+    """Yield ``(uid, payload)`` pairs from an ``imaplib`` FETCH response.
+
+    Literal payloads come back as ``(envelope, bytes)`` tuples followed by
+    a closing bytes item; some servers put the ``UID`` attribute in that
+    closing item instead of the envelope.
+    """
+    data = list(data or [])
+    for index, item in enumerate(data):
+        if not isinstance(item, tuple) or len(item) < 2:
+            continue
+        match = IMAP_FETCH_UID_REGEX.search(item[0] or b"")
+        if not match and index + 1 < len(data) and isinstance(data[index + 1], bytes):
+            match = IMAP_FETCH_UID_REGEX.search(data[index + 1])
+        if not match:
+            continue
+        yield match.group("uid"), item[1] or b""
+
+
+def _pec_message_id(headers):
+    return str((headers or {}).get("Message-Id") or "").strip()
+
+
+def _parse_imap_fetch_sizes(data):
+    """Return the ``RFC822.SIZE`` of each UID of a FETCH response"""
+    data = list(data or [])
+    sizes = {}
+    for index, item in enumerate(data):
+        if not isinstance(item, tuple) or len(item) < 2:
+            continue
+        attributes = item[0] or b""
+        if index + 1 < len(data) and isinstance(data[index + 1], bytes):
+            attributes += b" " + data[index + 1]
+        uid = IMAP_FETCH_UID_REGEX.search(attributes)
+        size = IMAP_FETCH_SIZE_REGEX.search(attributes)
+        if uid and size:
+            sizes[uid.group("uid")] = int(size.group("size"))
+    return sizes
+
+
+PecRouting = namedtuple("PecRouting", "company_id max_retry")
+
+
+class PopMultilineResponse:
+    """Multi-line POP3 response read one line at a time; ``command`` is sent
+    when the response is first read.
+
+    ``poplib`` only offers commands that collect the whole response in
+    memory: this is the one place relying on its private ``_putcmd``,
+    ``_getresp`` and ``_getline``.
+    """
+
+    def __init__(self, pop_server, command):
+        self.pop_server = pop_server
+        self.command = command
+        self.sent = False
+        self.finished = False
+
+    def __iter__(self):
+        if not self.sent:
+            self.sent = True
+            # An error status line has no multi-line body to read
+            self.finished = True
+            self.pop_server._putcmd(self.command)
+            self.pop_server._getresp()
+            self.finished = False
+        while not self.finished:
+            line, octets = self.pop_server._getline()
+            if line == b".":
+                self.finished = True
+                return
+            yield line[1:] if line.startswith(b"..") else line
+
+    def skip(self):
+        """Read the rest of the response up to its terminating ``.`` line.
+
+        The next command can then be sent on the same session. When the
+        response cannot be read, the connection is closed and the error
+        raised: the session can not be resynchronized.
+        """
+        if not self.sent:
+            return
+        try:
+            for line in self:
+                pass
+        except Exception:
+            self.pop_server.close()
+            raise
+
+
+class PecRunBudget:
+    """Message and wall-time allowance of a single fetch or routing run"""
+
+    def __init__(self, max_messages=0, max_seconds=0):
+        self.max_messages = max_messages
+        self.deadline = time.monotonic() + max_seconds if max_seconds else None
+        self.messages = 0
+
+    def consume(self):
+        self.messages += 1
+
+    @property
+    def exhausted(self):
+        if self.max_messages and self.messages >= self.max_messages:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
 
 
 class FetchmailServer(models.Model):
@@ -32,65 +304,686 @@ class FetchmailServer(models.Model):
         domain=[("email", "!=", False)],
         default=_default_e_inv_notify_partner_ids,
     )
+    pec_breaker_state = fields.Selection(
+        selection=[
+            ("closed", "Closed"),
+            ("open", "Open"),
+            ("half_open", "Half-open"),
+        ],
+        string="Circuit breaker",
+        default="closed",
+        required=True,
+        readonly=True,
+        copy=False,
+        help="Closed: the server is fetched normally. Open: after repeated "
+        "failures, runs skip the server until the next attempt. Half-open: "
+        "a single probe run is checking whether the server is back.",
+    )
+    pec_breaker_next_attempt = fields.Datetime(
+        "Next attempt",
+        readonly=True,
+        copy=False,
+        help="While the circuit is open, the server is not contacted before "
+        "this time",
+    )
+    pec_run_max_messages = fields.Integer(
+        "Messages per run",
+        default=PEC_RUN_MAX_MESSAGES,
+        help="Maximum number of messages downloaded, or routed, by a single "
+        "run. The next run resumes from where this one stopped. 0 means no "
+        "limit.",
+    )
+    pec_run_max_seconds = fields.Integer(
+        "Seconds per run",
+        default=PEC_RUN_MAX_SECONDS,
+        help="A run stops taking new messages after this many seconds and "
+        "schedules the next one. 0 means no limit.",
+    )
+    pec_socket_timeout = fields.Integer(
+        "Socket timeout",
+        default=PEC_SOCKET_TIMEOUT,
+        help="Seconds after which a silent IMAP or POP3 connection is "
+        "dropped. 0 means no timeout.",
+    )
+    pec_pop_uidl_ledger = fields.Text(
+        "POP3 UIDL ledger",
+        readonly=True,
+        copy=False,
+        help="POP3 messages already examined on this server, by UIDL",
+    )
+    pec_imap_idle = fields.Boolean(
+        "Push via IMAP IDLE",
+        help="Keep an IMAP IDLE session open on this server so that new SdI "
+        "messages are fetched within seconds. Requires the 'Listen for "
+        "E-invoice PEC Emails' scheduled action; regular polling stays active "
+        "as a fallback.",
+    )
+    pec_imap_uidvalidity = fields.Char(
+        "IMAP UIDVALIDITY",
+        readonly=True,
+        copy=False,
+        help="UIDVALIDITY of the PEC mailbox when it was last synchronized",
+    )
+    pec_imap_last_uid = fields.Integer(
+        "Last synchronized IMAP UID",
+        readonly=True,
+        copy=False,
+        help="Messages up to this UID have already been examined",
+    )
+    pec_imap_highest_modseq = fields.Char(
+        "IMAP HIGHESTMODSEQ",
+        readonly=True,
+        copy=False,
+        help="Mailbox modification sequence at the last complete run (CONDSTORE)",
+    )
+    pec_imap_retry_uids = fields.Char(
+        "IMAP UIDs to retry",
+        readonly=True,
+        copy=False,
+        help="UIDs below the last synchronized UID whose processing failed",
+    )
+
+    @ormcache("self.id")
+    def _pec_routing(self):
+        """Return the ``PecRouting`` of the server.
+
+        That is the id of the company it receives e-invoices for and the
+        ``fetchmail.pec.max.retry`` failures tolerated before the circuit
+        opens. The routing reads them for every message: they are cached,
+        and writes to the companies and the parameters clear the cache.
+        """
+        company = (
+            self.env["res.company"]
+            .sudo()
+            .search([("l10n_it_edi_pec_server_id", "=", self.id)], limit=1)
+        )
+        try:
+            max_retry = int(
+                self.env["ir.config_parameter"].sudo().get_param(
+                    "fetchmail.pec.max.retry", default="3"
+                )
+            )
+        except (TypeError, ValueError):
+            max_retry = 3
+        return PecRouting(company.id, max_retry)
+
+    def _pec_headers_are_sdi(self, headers):
+        """Return True when the sender headers point to the SdI PEC domain.
+
+        The receipts of the PEC provider for an e-invoice sent via PEC are
+        kept as well: they reference a Message-Id generated by this module.
+        """
+        headers_to_check = [
+            headers.get("Reply-To") or "",
+            headers.get("From") or "",
+            headers.get("Return-Path") or "",
+        ]
+        if any(SDI_PEC_DOMAIN in str(h) for h in headers_to_check):
+            return True
+        return is_pec_message_id(str(headers.get(PEC_RECEIPT_REFERENCE_HEADER) or ""))
+
+    def _pec_imap_batch_size(self):
+        batch_size = self.env["ir.config_parameter"].sudo().get_param(
+            "fetchmail.pec.imap.batch_size", default=str(IMAP_BATCH_SIZE)
+        )
+        try:
+            return max(int(batch_size), 1)
+        except (TypeError, ValueError):
+            return IMAP_BATCH_SIZE
+
+    def _pec_commit_policy(self):
+        """Return the ``(messages, seconds)`` thresholds of a commit batch"""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        try:
+            size = int(get_param("fetchmail.pec.commit.batch_size", PEC_COMMIT_BATCH_SIZE))
+        except (TypeError, ValueError):
+            size = PEC_COMMIT_BATCH_SIZE
+        try:
+            interval = int(get_param("fetchmail.pec.commit.interval", PEC_COMMIT_INTERVAL))
+        except (TypeError, ValueError):
+            interval = PEC_COMMIT_INTERVAL
+        return max(size, 1), max(interval, 0)
+
+    def _pec_breaker_backoff(self):
+        """Seconds to wait before the next probe, with exponential backoff.
+
+        The delay doubles with each failure past ``fetchmail.pec.max.retry``
+        and is jittered so that servers failing together are not probed in
+        lockstep.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        max_retry = self._pec_routing().max_retry
+        try:
+            backoff = int(get_param("fetchmail.pec.breaker.backoff", PEC_BREAKER_BACKOFF))
+            max_backoff = int(
+                get_param("fetchmail.pec.breaker.max_backoff", PEC_BREAKER_MAX_BACKOFF)
+            )
+        except (TypeError, ValueError):
+            backoff, max_backoff = PEC_BREAKER_BACKOFF, PEC_BREAKER_MAX_BACKOFF
+        exponent = min(max(self.pec_error_count - max_retry - 1, 0), 16)
+        delay = min(max(backoff, 1) * 2**exponent, max(max_backoff, 1))
+        return random.uniform(delay / 2, delay)
+
+    def _pec_breaker_allows_attempt(self):
+        """Return True when a run may contact the server.
+
+        The first run after the backoff of an open circuit becomes the
+        half-open probe; it leases the server for another backoff period so
+        that concurrent runs do not probe it too. Manual checks pass
+        ``pec_breaker_force`` in the context.
+        """
+        self.ensure_one()
+        if self.pec_breaker_state == "closed" or self.env.context.get("pec_breaker_force"):
+            return True
+        now = fields.Datetime.now()
+        if self.pec_breaker_next_attempt and now < self.pec_breaker_next_attempt:
+            return False
+        self.write(
+            {
+                "pec_breaker_state": "half_open",
+                "pec_breaker_next_attempt": now
+                + timedelta(seconds=self._pec_breaker_backoff()),
+            }
+        )
+        return True
+
+    def _pec_breaker_record_failure(self):
+        self.ensure_one()
+        max_retry = self._pec_routing().max_retry
+        self.pec_error_count += 1
+        if self.pec_breaker_state == "closed" and self.pec_error_count <= max_retry:
+            return
+        was_closed = self.pec_breaker_state == "closed"
+        self.write(
+            {
+                "pec_breaker_state": "open",
+                "pec_breaker_next_attempt": fields.Datetime.now()
+                + timedelta(seconds=self._pec_breaker_backoff()),
+            }
+        )
+        if was_closed:
+            self.notify_about_server_reset()
+
+    def _pec_breaker_record_success(self):
+        self.ensure_one()
+        if self.pec_breaker_state != "closed":
+            _logger.info("PEC server %s is reachable again", self.name)
+        if self.pec_error_count or self.pec_breaker_state != "closed":
+            self.write(
+                {
+                    "pec_error_count": 0,
+                    "pec_breaker_state": "closed",
+                    "pec_breaker_next_attempt": False,
+                }
+            )
+
+    def action_pec_breaker_reset(self):
+        self.write(
+            {
+                "pec_error_count": 0,
+                "pec_breaker_state": "closed",
+                "pec_breaker_next_attempt": False,
+            }
+        )
+        return True
+
+    def _pec_run_budget(self):
+        self.ensure_one()
+        return PecRunBudget(
+            max(self.pec_run_max_messages, 0), max(self.pec_run_max_seconds, 0)
+        )
+
+    def _pec_schedule_next_run(self):
+        """Have the fetch cron resume the work left by a run out of budget"""
+        cron = self.env.ref("l10n_it_edi_pec.ir_cron_fetchmail_pec", raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+
+    def _pec_stream_threshold(self):
+        """Size in bytes above which a message is never held in memory.
+
+        It also bounds the size of a single FETCH response, so it is the
+        memory limit of a fetch run.
+        """
+        threshold = self.env["ir.config_parameter"].sudo().get_param(
+            "fetchmail.pec.stream.threshold", default=str(PEC_STREAM_THRESHOLD)
+        )
+        try:
+            return max(int(threshold), 64 * 1024)
+        except (TypeError, ValueError):
+            return PEC_STREAM_THRESHOLD
+
+    def _pec_imap_retry_uid_list(self):
+        self.ensure_one()
+        return [
+            int(uid)
+            for uid in (self.pec_imap_retry_uids or "").split(",")
+            if uid.strip().isdigit()
+        ]
+
+    def _pec_imap_save_sync_state(self, last_uid, retry_uids):
+        self.ensure_one()
+        self.write(
+            {
+                "pec_imap_last_uid": max(last_uid, self.pec_imap_last_uid),
+                "pec_imap_retry_uids": ",".join(str(uid) for uid in sorted(retry_uids)),
+            }
+        )
+
+    def _pec_imap_sync_uids(self, imap_server):
+        """Return the UIDs to examine on the selected mailbox, and its
+        CONDSTORE HIGHESTMODSEQ.
+
+        Once synchronized, only ``UID last+1:*`` plus the failed UIDs are
+        searched, so the cost of a run depends on the new messages and not on
+        the mailbox size or on the ``\\Seen`` flags. When UIDNEXT shows that
+        no message arrived above the high-water mark, and HIGHESTMODSEQ
+        (when reported) is the one of the last complete run, no search is
+        issued at all. The caller stores the HIGHESTMODSEQ only once a run
+        examined every UID. The first run, and any run after a UIDVALIDITY
+        change, falls back to the unseen messages and records the high-water
+        mark.
+        """
+        self.ensure_one()
+        uidvalidity = _imap_response_value(imap_server, "UIDVALIDITY")
+        uidnext = _imap_response_value(imap_server, "UIDNEXT")
+        modseq = _imap_response_value(imap_server, "HIGHESTMODSEQ")
+
+        if not uidvalidity or uidvalidity != self.pec_imap_uidvalidity:
+            result, data = imap_server.uid("search", None, "(UNSEEN)")
+            uids = data[0].split() if data and data[0] else []
+            if uidnext and uidnext.isdigit():
+                last_uid = int(uidnext) - 1
+            else:
+                result, data = imap_server.uid("search", None, "UID *")
+                top = data[0].split() if data and data[0] else []
+                last_uid = int(top[-1]) if top else 0
+            # Older messages were already handled while the mailbox was
+            # polled by flags: only the unseen ones are examined now.
+            self.write(
+                {
+                    "pec_imap_uidvalidity": uidvalidity or False,
+                    "pec_imap_last_uid": last_uid,
+                    "pec_imap_highest_modseq": False,
+                    "pec_imap_retry_uids": False,
+                }
+            )
+            return uids, modseq
+
+        retry_uids = self._pec_imap_retry_uid_list()
+        last_uid = self.pec_imap_last_uid
+        unchanged = (
+            uidnext
+            and uidnext.isdigit()
+            and int(uidnext) <= last_uid + 1
+            and (not modseq or modseq == self.pec_imap_highest_modseq)
+        )
+        new_uids = []
+        if not unchanged:
+            result, data = imap_server.uid("search", None, "UID %d:*" % (last_uid + 1))
+            # "n:*" always matches the highest UID, even when it is below n
+            new_uids = [
+                uid
+                for uid in (data[0].split() if data and data[0] else [])
+                if int(uid) > last_uid
+            ]
+        uids = sorted({str(uid).encode() for uid in retry_uids} | set(new_uids), key=int)
+        return uids, modseq
+
+    def _pec_imap_connect_params(self):
+        self.ensure_one()
+        return {
+            "host": self.server,
+            "port": self.port,
+            "is_ssl": self.is_ssl,
+            "user": self.user,
+            "password": self.password,
+            "timeout": max(self.pec_socket_timeout, 0),
+        }
+
+    def _pec_idle_session_length(self):
+        session = self.env["ir.config_parameter"].sudo().get_param(
+            "fetchmail.pec.idle.session", default=str(IMAP_IDLE_SESSION)
+        )
+        try:
+            session = int(session)
+        except (TypeError, ValueError):
+            session = IMAP_IDLE_SESSION
+        # Stay below the hard time limit of cron workers
+        limit = config.get("limit_time_real_cron") or -1
+        if limit < 0:
+            limit = config.get("limit_time_real") or 0
+        if limit > 0:
+            session = min(session, limit - 15)
+        return max(session, 30)
+
+    def _pec_idle_timeout(self):
+        """Seconds an IDLE command lasts before it is issued again"""
+        timeout = self.env["ir.config_parameter"].sudo().get_param(
+            "fetchmail.pec.idle.timeout", default=str(IMAP_IDLE_TIMEOUT)
+        )
+        try:
+            return max(int(timeout), 1)
+        except (TypeError, ValueError):
+            return IMAP_IDLE_TIMEOUT
+
+    @api.model
+    def _cron_pec_idle_listen(self):
+        """Listen with IMAP IDLE on the PEC servers flagged for push.
+
+        One thread per server holds the IDLE session; it only touches the
+        network, while this thread triggers the fetch cron when messages
+        arrive. Sessions last ``fetchmail.pec.idle.session`` seconds and the
+        scheduled action restarts them.
+        """
+        servers = self.search(
+            [
+                ("is_l10n_it_edi_pec", "=", True),
+                ("pec_imap_idle", "=", True),
+                ("server_type", "=", "imap"),
+                ("pec_breaker_state", "=", "closed"),
+            ]
+        )
+        if not servers:
+            return
+        fetch_cron = self.env.ref(
+            "l10n_it_edi_pec.ir_cron_fetchmail_pec", raise_if_not_found=False
+        )
+        if not fetch_cron:
+            return
+
+        deadline = time.monotonic() + self._pec_idle_session_length()
+        idle_timeout = self._pec_idle_timeout()
+        events = queue.Queue()
+
+        def _watch(server_name, params, last_uid):
+            try:
+                _imap_idle_watch(
+                    params, last_uid, deadline, idle_timeout, lambda: events.put(server_name)
+                )
+            except Exception:
+                _logger.warning(
+                    "IMAP IDLE session on PEC server %s failed, polling continues",
+                    server_name,
+                    exc_info=True,
+                )
+
+        threads = []
+        for server in servers:
+            thread = threading.Thread(
+                target=_watch,
+                args=(server.name, server._pec_imap_connect_params(), server.pec_imap_last_uid),
+                name="pec-idle-%s" % server.id,
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+        # Release the snapshot while the sessions wait for messages
+        self.env.cr.commit()
+
+        while any(thread.is_alive() for thread in threads):
+            try:
+                server_name = events.get(timeout=1)
+            except queue.Empty:
+                continue
+            while not events.empty():
+                events.get_nowait()
+            _logger.debug("New messages announced by PEC server %s", server_name)
+            fetch_cron._trigger()
+            self.env.cr.commit()
+        for thread in threads:
+            thread.join()
+
+    def _imap_fetch_pec_headers(self, imap_server, uids):
+        """Fetch the routing headers and sizes of ``uids`` in a single UID FETCH.
+
+        ``BODY.PEEK`` leaves the ``\\Seen`` flag untouched, so messages that
+        are not processed stay unread on the server. Return the headers and
+        the ``RFC822.SIZE`` by UID; UIDs whose headers could not be read are
+        missing from the headers.
+        """
+        if not uids:
+            return {}, {}
+        result, data = imap_server.uid(
+            "fetch",
+            _imap_uid_set(uids),
+            "(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (%s)])" % PEC_HEADER_FIELDS,
+        )
+        if result != "OK":
+            raise UserError(
+                _("Could not fetch the headers of the PEC messages %s", _imap_uid_set(uids))
+            )
+        parser = BytesParser(policy=policy.default)
+        headers_by_uid = {}
+        for uid, header_bytes in _parse_imap_fetch_response(data):
+            try:
+                headers_by_uid[uid] = parser.parsebytes(header_bytes, headersonly=True)
+            except Exception:
+                _logger.debug("Unparsable PEC headers for UID %s", uid, exc_info=True)
+        return headers_by_uid, _parse_imap_fetch_sizes(data)
+
+    def _imap_existing_uids(self, imap_server, uids):
+        """Return the ``uids`` that are still in the selected mailbox.
+
+        A UID FETCH returns nothing for expunged messages, and they never
+        come back; when the search fails, every UID is kept.
+        """
+        result, data = imap_server.uid("search", None, "UID %s" % _imap_uid_set(uids))
+        if result != "OK":
+            return list(uids)
+        found = {int(uid) for uid in (data[0].split() if data and data[0] else [])}
+        return [uid for uid in uids if int(uid) in found]
+
+    def _imap_fetch_pec_bodies(self, imap_server, uids):
+        """Download the full messages of ``uids`` in a single UID FETCH"""
+        if not uids:
+            return {}
+        result, data = imap_server.uid("fetch", _imap_uid_set(uids), "(BODY.PEEK[])")
+        if result != "OK":
+            return {}
+        return dict(_parse_imap_fetch_response(data))
+
+    def _imap_iter_pec_body_chunks(self, imap_server, uid, chunk_size):
+        """Download the message ``uid`` with partial fetches of ``chunk_size``"""
+        offset = 0
+        while True:
+            result, data = imap_server.uid(
+                "fetch", _imap_uid_set([uid]), "(BODY.PEEK[]<%d.%d>)" % (offset, chunk_size)
+            )
+            if result != "OK":
+                raise UserError(
+                    _("Could not download PEC message with UID %s", uid.decode())
+                )
+            chunk = next(
+                (payload for _uid, payload in _parse_imap_fetch_response(data)), b""
+            )
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            offset += len(chunk)
+
+    def _imap_iter_pec_messages(self, imap_server, uids, sizes):
+        """Yield ``(uid, chunks)`` for the messages ``uids``.
+
+        Messages are downloaded in FETCH commands whose total size stays
+        below ``_pec_stream_threshold``; larger messages are downloaded in
+        partial fetches while the spool consumes ``chunks``. ``chunks`` is
+        None when the server did not return the message.
+        """
+        threshold = self._pec_stream_threshold()
+        groups = []
+        group_size = 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if size > threshold:
+                groups.append((True, [uid]))
+                continue
+            if not groups or groups[-1][0] or group_size + size > threshold:
+                groups.append((False, []))
+                group_size = 0
+            groups[-1][1].append(uid)
+            group_size += size
+
+        for streamed, group in groups:
+            if streamed:
+                yield group[0], self._imap_iter_pec_body_chunks(
+                    imap_server, group[0], threshold
+                )
+                continue
+            bodies_by_uid = self._imap_fetch_pec_bodies(imap_server, group)
+            for uid in group:
+                raw_message = bodies_by_uid.pop(uid, b"")
+                yield uid, [raw_message] if raw_message else None
 
     def fetch_mail_server_type_imap(
         self, server, MailThread, error_messages, **additional_context
     ):
-        """Fetch emails using IMAP protocol for PEC servers"""
+        """Fetch emails using IMAP protocol for PEC servers
+
+        New messages (see ``_pec_imap_sync_uids``) are handled in chunks of
+        ``fetchmail.pec.imap.batch_size`` UIDs: the routing headers of the
+        chunk are fetched first, then the full bodies of the SdI messages
+        (see ``_imap_iter_pec_messages``). SdI messages are written to the ``fetchmail.pec.spool``
+        and committed in batches (see ``_pec_commit_policy``); the committed
+        UIDs are then flagged ``\\Seen`` with one UID STORE. Routing happens
+        later, when the spool is drained.
+
+        A run stops once the server budget (see ``_pec_run_budget``) is
+        spent; the synchronization state then works as a cursor and the
+        next run, scheduled right away, continues from there.
+        """
         imap_server = None
         try:
-            # Create IMAP connection using server configuration
-            import imaplib
-            import ssl
-            
-            host = server.server
-            port = server.port or 993
-            if server.is_ssl:
-                imap_server = imaplib.IMAP4_SSL(host, port)
-            else:
-                imap_server = imaplib.IMAP4(host, server.port or 143)
-            
-            # Login to IMAP server
-            if server.user:
-                imap_server.login(server.user, server.password or "")
-            
+            imap_server = _imap_open(server._pec_imap_connect_params())
+
+            if {"CONDSTORE", "ENABLE"} <= set(imap_server.capabilities):
+                # Makes the server report HIGHESTMODSEQ on SELECT
+                imap_server.enable("CONDSTORE")
             imap_server.select()
-            result, data = imap_server.search(None, "(UNSEEN)")
-            
-            for num in data[0].split():
-                result, data = imap_server.fetch(num, "(RFC822)")
-                raw_message = data[0][1] if data and data[0] else b""
+            uids, modseq = server._pec_imap_sync_uids(imap_server)
+            retry_uids = set(server._pec_imap_retry_uid_list())
 
-                is_sdi_pec = False
-                try:
-                    eml = BytesParser(policy=policy.default).parsebytes(raw_message or b"")
-                    headers_to_check = [
-                        eml.get("Reply-To") or "",
-                        eml.get("From") or "",
-                        eml.get("Return-Path") or "",
-                    ]
-                    is_sdi_pec = any("@pec.fatturapa.it" in h for h in headers_to_check)
-                except Exception:
-                    is_sdi_pec = False
-
-                if not is_sdi_pec:
-                    continue
+            Spool = self.env["fetchmail.pec.spool"].sudo()
+            commit_size, commit_interval = server._pec_commit_policy()
+            budget = server._pec_run_budget()
+            pending_uids = []
+            examined_uid = 0
+            # The high-water mark never passes a new UID whose headers could
+            # not be read: it is examined again by the next run. Older ones
+            # are only kept in the retry list.
+            unexamined_uids = []
+            next_uid = None
+            batch_start = time.monotonic()
 
-                try:
-                    MailThread.with_context(**additional_context).message_process(
-                        'mail.thread',
-                        raw_message,
-                        save_original=True,
-                        strip_attachments=False,
+            def _commit_batch():
+                last_uid = examined_uid
+                new_unexamined = [
+                    uid for uid in unexamined_uids if uid > server.pec_imap_last_uid
+                ]
+                if new_unexamined:
+                    last_uid = min(last_uid, min(new_unexamined) - 1)
+                server._pec_imap_save_sync_state(last_uid, retry_uids)
+                self.env.cr.commit()
+                # Flags are only set once the spooled messages are durable
+                if pending_uids:
+                    imap_server.uid(
+                        "store", _imap_uid_set(pending_uids), "+FLAGS", "(\\Seen)"
                     )
-                    server.last_pec_error_message = ""
-                except Exception as e:
-                    server.manage_pec_failure(e, error_messages)
-                    continue
+                pending_uids.clear()
+
+            batch_size = server._pec_imap_batch_size()
+            for start in range(0, len(uids), batch_size):
+                chunk = uids[start:start + batch_size]
+                if budget.exhausted:
+                    next_uid = chunk[0]
+                    break
+                headers_by_uid, sizes_by_uid = server._imap_fetch_pec_headers(
+                    imap_server, chunk
+                )
+                headerless_uids = [int(uid) for uid in chunk if uid not in headers_by_uid]
+                if headerless_uids:
+                    # Expunged messages, e.g. deleted in webmail, are dropped
+                    existing_uids = server._imap_existing_uids(imap_server, headerless_uids)
+                    retry_uids.difference_update(headerless_uids)
+                    headerless_uids = existing_uids
+                unexamined_uids.extend(headerless_uids)
+                retry_uids.update(headerless_uids)
+                sdi_uids = [
+                    uid
+                    for uid in chunk
+                    if uid in headers_by_uid
+                    and server._pec_headers_are_sdi(headers_by_uid[uid])
+                ]
+                # Screened out on their headers: never downloaded
+                retry_uids.difference_update(
+                    int(uid) for uid in chunk if uid in headers_by_uid and uid not in sdi_uids
+                )
+                # Already spooled, parked ones included: acknowledge only
+                spooled = Spool._spooled_message_ids(
+                    server,
+                    [_pec_message_id(headers_by_uid[uid]) for uid in sdi_uids],
+                )
+                known_uids = [
+                    uid
+                    for uid in sdi_uids
+                    if _pec_message_id(headers_by_uid[uid]) in spooled
+                ]
+                pending_uids.extend(known_uids)
+                retry_uids.difference_update(int(uid) for uid in known_uids)
+                sdi_uids = [uid for uid in sdi_uids if uid not in known_uids]
+
+                for uid, chunks in server._imap_iter_pec_messages(
+                    imap_server, sdi_uids, sizes_by_uid
+                ):
+                    if budget.exhausted:
+                        next_uid = uid
+                        break
+                    budget.consume()
+                    if chunks is None:
+                        retry_uids.add(int(uid))
+                        continue
+
+                    try:
+                        # A database error only rolls back this message
+                        with self.env.cr.savepoint():
+                            Spool._spool_chunks(server, chunks, headers_by_uid[uid])
+                    except Exception as e:
+                        server.manage_pec_failure(e, error_messages)
+                        retry_uids.add(int(uid))
+                        continue
+
+                    pending_uids.append(uid)
+                    retry_uids.discard(int(uid))
+                    if (
+                        len(pending_uids) >= commit_size
+                        or time.monotonic() - batch_start >= commit_interval
+                    ):
+                        examined_uid = int(uid)
+                        _commit_batch()
+                        batch_start = time.monotonic()
+
+                if next_uid is not None:
+                    break
+                examined_uid = max(int(uid) for uid in chunk)
+
+            if next_uid is not None:
+                # Out of budget: newer UIDs are resumed from the high-water
+                # mark, older ones (retries, first unseen scan) are kept in
+                # the retry list.
+                examined_uid = int(next_uid) - 1
+                retry_uids.update(
+                    int(uid)
+                    for uid in uids
+                    if int(next_uid) <= int(uid) <= server.pec_imap_last_uid
+                )
+            else:
+                # Every UID was examined: the mailbox state is now in sync
+                server.pec_imap_highest_modseq = modseq or False
+            _commit_batch()
+            if next_uid is not None:
+                server._pec_schedule_next_run()
 
-                imap_server.store(num, "+FLAGS", "\\Seen")
-                self.env.cr.commit()
-                
         except Exception as e:
             server.manage_pec_failure(e, error_messages)
         finally:
@@ -101,51 +994,203 @@ class FetchmailServer(models.Model):
                 except:
                     pass
 
+    def _pec_pop_ledger(self):
+        self.ensure_one()
+        try:
+            ledger = json.loads(self.pec_pop_uidl_ledger or "{}")
+        except ValueError:
+            ledger = {}
+        return ledger if isinstance(ledger, dict) else {}
+
+    def _pec_pop_save_ledger(self, ledger):
+        self.ensure_one()
+        self.pec_pop_uidl_ledger = json.dumps(ledger, sort_keys=True) if ledger else False
+
+    def _pop_list_uidls(self, pop_server):
+        """Return ``(num, uidl)`` pairs for every message in the maildrop.
+
+        ``uidl`` is None when the server does not support UIDL, in which case
+        no message can be remembered across sessions.
+        """
+        try:
+            response, listing, octets = pop_server.uidl()
+        except poplib.error_proto:
+            num_messages, total_size = pop_server.stat()
+            return [(num, None) for num in range(1, num_messages + 1)]
+        messages = []
+        for line in listing:
+            num, _sep, uidl = line.decode(errors="replace").partition(" ")
+            if num.isdigit():
+                messages.append((int(num), uidl.strip() or None))
+        return messages
+
+    def _pop_list_sizes(self, pop_server):
+        """Return the size of every message in the maildrop, by number"""
+        response, listing, octets = pop_server.list()
+        sizes = {}
+        for line in listing:
+            num, _sep, size = line.decode(errors="replace").partition(" ")
+            if num.isdigit() and size.strip().isdigit():
+                sizes[int(num)] = int(size)
+        return sizes
+
+    def _pop_iter_message_chunks(self, response, chunk_size):
+        """Yield the lines of a RETR ``response`` in about ``chunk_size`` bytes.
+
+        ``poplib.POP3.retr`` collects the whole message in a list of lines;
+        the ``PopMultilineResponse`` is read incrementally instead.
+        """
+        lines = []
+        buffered = 0
+        for line in response:
+            lines.append(line)
+            buffered += len(line) + 1
+            if buffered >= chunk_size:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+                buffered = 0
+        yield b"\n".join(lines)
+
+    def _pop_fetch_pec_headers(self, pop_server, num):
+        """Return the headers of message ``num`` using ``TOP num 0``"""
+        try:
+            response, lines, octets = pop_server.top(num, 0)
+        except poplib.error_proto:
+            return None
+        return BytesParser(policy=policy.default).parsebytes(
+            b"\r\n".join(lines), headersonly=True
+        )
+
     def fetch_mail_server_type_pop(
         self, server, MailThread, error_messages, **additional_context
     ):
-        """Fetch emails using POP3 protocol for PEC servers"""
+        """Fetch emails using POP3 protocol for PEC servers
+
+        Every examined message is recorded in a UIDL ledger: non-SdI mail is
+        screened with ``TOP n 0`` and never downloaded again, spooled
+        messages are remembered until the server drops them, and failed ones
+        are retried without blocking the following messages. Downloads stop
+        when the server budget (see ``_pec_run_budget``) is spent; the
+        ledger lets the next run, scheduled right away, continue from there.
+        """
         pop_server = None
         try:
-            import poplib
-            
             # Create POP3 connection using server configuration
             host = server.server
             port = server.port or 995
+            timeout = max(server.pec_socket_timeout, 0) or None
             if server.is_ssl:
-                pop_server = poplib.POP3_SSL(host, port)
+                pop_server = poplib.POP3_SSL(host, port, timeout=timeout)
             else:
-                pop_server = poplib.POP3(host, server.port or 110)
-            
+                pop_server = poplib.POP3(host, server.port or 110, timeout=timeout)
+
             # Login to POP3 server
             if server.user:
                 pop_server.user(server.user)
                 pop_server.pass_(server.password or "")
-            
-            while True:
-                (num_messages, total_size) = pop_server.stat()
-                pop_server.list()
-                
-                for num in range(1, min(MAX_POP_MESSAGES, num_messages) + 1):
-                    (header, messages, octets) = pop_server.retr(num)
-                    message = b"\n".join(messages)
-                    try:
-                        MailThread.with_context(**additional_context).message_process(
-                            'mail.thread',  # Use generic model
-                            message,
-                            save_original=True,
-                            strip_attachments=False,
-                        )
-                        pop_server.dele(num)
-                        server.last_pec_error_message = ""
-                    except Exception as e:
-                        server.manage_pec_failure(e, error_messages)
-                        continue
-                    self.env.cr.commit()
-                    
-                if num_messages < MAX_POP_MESSAGES:
+
+            messages = server._pop_list_uidls(pop_server)
+            ledger = server._pec_pop_ledger()
+            present = {uidl for num, uidl in messages if uidl}
+            ledger = {uidl: state for uidl, state in ledger.items() if uidl in present}
+            server._pec_pop_save_ledger(ledger)
+
+            # Processed in an earlier session that did not reach QUIT
+            for num, uidl in messages:
+                if uidl and ledger.get(uidl) == "done":
+                    pop_server.dele(num)
+
+            Spool = self.env["fetchmail.pec.spool"].sudo()
+            commit_size, commit_interval = server._pec_commit_policy()
+            pending_nums = []
+            batch_start = time.monotonic()
+
+            def _commit_batch():
+                server._pec_pop_save_ledger(ledger)
+                self.env.cr.commit()
+                # Messages are only deleted once they are durably spooled
+                for pending_num in pending_nums:
+                    pop_server.dele(pending_num)
+                pending_nums.clear()
+
+            # New messages first, then the ones that failed before
+            candidates = [m for m in messages if not m[1] or m[1] not in ledger]
+            candidates += [m for m in messages if m[1] and ledger.get(m[1]) == "retry"]
+
+            sizes = server._pop_list_sizes(pop_server)
+            stream_threshold = server._pec_stream_threshold()
+            budget = server._pec_run_budget()
+            out_of_budget = False
+            for num, uidl in candidates:
+                if budget.exhausted:
+                    out_of_budget = True
                     break
-                    
+                message = None
+                headers = server._pop_fetch_pec_headers(pop_server, num)
+                if headers is None and sizes.get(num, 0) <= stream_threshold:
+                    # TOP is optional in POP3: screen on the full message.
+                    # Larger messages are spooled unscreened rather than
+                    # loaded in memory.
+                    (header, lines, octets) = pop_server.retr(num)
+                    budget.consume()
+                    message = b"\n".join(lines)
+                    headers = BytesParser(policy=policy.default).parsebytes(
+                        message, headersonly=True
+                    )
+                if headers is not None and not server._pec_headers_are_sdi(headers):
+                    if uidl:
+                        ledger[uidl] = "skip"
+                    continue
+                if message is None and headers is not None and Spool._spooled_message_ids(
+                    server, [_pec_message_id(headers)]
+                ):
+                    # Already spooled, parked ones included: just delete it
+                    if uidl:
+                        ledger[uidl] = "done"
+                    pending_nums.append(num)
+                    continue
+
+                response = None
+                if message is not None:
+                    chunks = [message]
+                elif sizes.get(num, 0) > stream_threshold:
+                    budget.consume()
+                    response = PopMultilineResponse(pop_server, "RETR %s" % num)
+                    chunks = server._pop_iter_message_chunks(response, stream_threshold)
+                else:
+                    (header, lines, octets) = pop_server.retr(num)
+                    budget.consume()
+                    chunks = [b"\n".join(lines)]
+                try:
+                    # A database error only rolls back this message
+                    with self.env.cr.savepoint():
+                        Spool._spool_chunks(server, chunks, headers)
+                except Exception as e:
+                    server.manage_pec_failure(e, error_messages)
+                    if uidl:
+                        ledger[uidl] = "retry"
+                    if response is not None:
+                        # A download stopped half-way leaves the rest of the
+                        # message on the connection; when it cannot be read,
+                        # the session is aborted.
+                        response.skip()
+                    continue
+                if uidl:
+                    # Deletion only happens on QUIT: remember the message in
+                    # case the session does not end cleanly.
+                    ledger[uidl] = "done"
+                pending_nums.append(num)
+                if (
+                    len(pending_nums) >= commit_size
+                    or time.monotonic() - batch_start >= commit_interval
+                ):
+                    _commit_batch()
+                    batch_start = time.monotonic()
+
+            _commit_batch()
+            if out_of_budget:
+                server._pec_schedule_next_run()
+
         except Exception as e:
             server.manage_pec_failure(e, error_messages)
         finally:
@@ -155,67 +1200,143 @@ class FetchmailServer(models.Model):
                 except:
                     pass
 
-    def fetch_mail(self, raise_exception=True):
-        """Override to handle PEC email fetching for e-invoices"""
-        for server in self:
-            if not server.is_l10n_it_edi_pec:
-                # For non-PEC servers, use standard behavior
-                super(FetchmailServer, server).fetch_mail(
-                    raise_exception=raise_exception
-                )
-                continue
+    def _pec_fetch_workers(self):
+        workers = self.env["ir.config_parameter"].sudo().get_param(
+            "fetchmail.pec.fetch.workers", default=str(PEC_FETCH_WORKERS)
+        )
+        try:
+            return max(int(workers), 1)
+        except (TypeError, ValueError):
+            return PEC_FETCH_WORKERS
 
-            # PEC server handling
-            try:
-                additional_context = {"fetchmail_cron_running": True}
-                server_ctx = server.with_context(**additional_context)
-                server_sudo = server_ctx.sudo()
-                MailThread = server_sudo.env["mail.thread"]
+    def _fetch_pec_server(self, raise_exception=True):
+        """Download the messages of a single PEC server into the spool"""
+        self.ensure_one()
+        server = self
+        try:
+            additional_context = {"fetchmail_cron_running": True}
+            server_ctx = server.with_context(**additional_context)
+            server_sudo = server_ctx.sudo()
+            MailThread = server_sudo.env["mail.thread"]
+            _logger.debug(
+                "start checking for new e-invoices on PEC server %s",
+                server_ctx.name,
+            )
+            additional_context["fetchmail_server_id"] = server_ctx.id
+            additional_context["server_type"] = server_ctx.server_type or "imap"
+            error_messages = list()
+
+            if not server_sudo._pec_breaker_allows_attempt():
                 _logger.debug(
-                    "start checking for new e-invoices on PEC server %s",
+                    "PEC server %s skipped: circuit open until %s",
                     server_ctx.name,
+                    server_sudo.pec_breaker_next_attempt,
                 )
-                additional_context["fetchmail_server_id"] = server_ctx.id
-                additional_context["server_type"] = server_ctx.server_type or "imap"
-                error_messages = list()
+                return
 
-                if (server_sudo.server_type or "imap") == "imap":
-                    server_sudo.fetch_mail_server_type_imap(
-                        server_sudo, MailThread, error_messages, **additional_context
-                    )
-                else:
-                    server_sudo.fetch_mail_server_type_pop(
-                        server_sudo, MailThread, error_messages, **additional_context
-                    )
+            if (server_sudo.server_type or "imap") == "imap":
+                server_sudo.fetch_mail_server_type_imap(
+                    server_sudo, MailThread, error_messages, **additional_context
+                )
+            else:
+                server_sudo.fetch_mail_server_type_pop(
+                    server_sudo, MailThread, error_messages, **additional_context
+                )
+
+            server_sudo.env["fetchmail.pec.spool"]._trigger_processing()
 
-                if error_messages:
-                    server_sudo.notify_or_log(error_messages)
-                    server_sudo.pec_error_count += 1
-                    max_retry = self.env["ir.config_parameter"].sudo().get_param(
-                        "fetchmail.pec.max.retry", default="3"
+            if error_messages:
+                server_sudo.notify_or_log(error_messages)
+                server_sudo._pec_breaker_record_failure()
+            else:
+                server_sudo._pec_breaker_record_success()
+        except Exception as e:
+            if raise_exception:
+                raise ValidationError(
+                    _(
+                        "Couldn't get your emails. Check out the error message below for more info:\n%s",
+                        e,
                     )
-                    if server_sudo.pec_error_count > int(max_retry):
-                        server_sudo.active = False
-                        server_sudo.notify_about_server_reset()
-                else:
-                    server_sudo.pec_error_count = 0
-            except Exception as e:
-                if raise_exception:
-                    raise ValidationError(
-                        _(
-                            "Couldn't get your emails. Check out the error message below for more info:\n%s",
-                            e,
-                        )
-                    ) from e
-                _logger.warning(
-                    "General failure when trying to fetch mail from %s server %s.",
-                    server.server_type,
-                    server.name,
-                    exc_info=True,
+                ) from e
+            _logger.warning(
+                "General failure when trying to fetch mail from %s server %s.",
+                server.server_type,
+                server.name,
+                exc_info=True,
+            )
+
+    def _fetch_pec_servers_parallel(self, workers, raise_exception=True):
+        """Fetch several PEC servers concurrently.
+
+        Each server is handled by a pool thread with its own cursor, so a
+        slow provider only delays its own mailbox and every server commits
+        its messages in its own transaction. The caller commits first: the
+        pool threads must not wait on rows locked by its transaction.
+        """
+        dbname = self.env.cr.dbname
+        uid = self.env.uid
+        context = dict(self.env.context)
+        registry = self.env.registry
+
+        def _fetch(server_id):
+            threading.current_thread().dbname = dbname
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                env["fetchmail.server"].browse(server_id)._fetch_pec_server(
+                    raise_exception=raise_exception
                 )
 
+        errors = []
+        with ThreadPoolExecutor(
+            max_workers=min(workers, len(self)), thread_name_prefix="pec-fetch"
+        ) as executor:
+            futures = {executor.submit(_fetch, server.id): server for server in self}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+        self.env.invalidate_all()
+        if errors:
+            raise errors[0]
+
+    def fetch_mail(self, raise_exception=True):
+        """Override to handle PEC email fetching for e-invoices"""
+        pec_servers = self.filtered("is_l10n_it_edi_pec")
+        for server in self - pec_servers:
+            # For non-PEC servers, use standard behavior
+            super(FetchmailServer, server).fetch_mail(
+                raise_exception=raise_exception
+            )
+
+        for server in pec_servers:
+            server._fetch_pec_server(raise_exception=raise_exception)
+
         return True
 
+    @api.model
+    def _cron_fetch_pec_mail(self):
+        """Fetch the PEC servers of the companies receiving e-invoices.
+
+        The cron owns its transaction, so only here is it committed to fetch
+        several servers in parallel (see ``_fetch_pec_servers_parallel``);
+        ``fetch_mail`` keeps the transaction of its caller.
+        """
+        servers = self.env["res.company"].search(
+            [("l10n_it_edi_use_pec", "=", True), ("l10n_it_edi_pec_server_id", "!=", False)]
+        ).l10n_it_edi_pec_server_id
+        pec_servers = servers.filtered("is_l10n_it_edi_pec")
+        workers = self._pec_fetch_workers()
+        if (
+            len(pec_servers) > 1
+            and workers > 1
+            and not self.env.registry.in_test_mode()
+        ):
+            self.env.cr.commit()
+            pec_servers._fetch_pec_servers_parallel(workers)
+            servers -= pec_servers
+        servers.fetch_mail()
+
     def manage_pec_failure(self, exception, error_messages):
         self.ensure_one()
         _logger.warning(
@@ -236,10 +1357,15 @@ class FetchmailServer(models.Model):
         self.ensure_one()
         self.notify_or_log(
             _(
-                "PEC server %(name)s has been reset. "
-                "Last error message is '%(error_message)s'"
+                "PEC server %(name)s keeps failing: it will only be retried "
+                "from %(next_attempt)s, with increasing delays until it "
+                "answers again. Last error message is '%(error_message)s'"
             )
-            % {"name": self.name, "error_message": self.last_pec_error_message}
+            % {
+                "name": self.name,
+                "next_attempt": self.pec_breaker_next_attempt,
+                "error_message": self.last_pec_error_message,
+            }
         )
 
     def notify_or_log(self, message):
@@ -2,15 +2,25 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 import base64
+import binascii
+from collections import namedtuple
+from datetime import timezone
 from email import policy
+from email.message import Message
 from email.parser import BytesParser
+from email.utils import make_msgid, parsedate_to_datetime
+import functools
+import hashlib
+import io
 import logging
+import os
 import re
-from types import SimpleNamespace
+import tempfile
+import zipfile
 
 from lxml import etree
 
-from odoo import _, api, models
+from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
 _logger = logging.getLogger(__name__)
@@ -20,94 +30,829 @@ INVOICE_KEY_REGEX = (
     r"_(?P<progressive>[a-zA-Z0-9]{1,5})"
 )
 
-FATTURAPA_IN_REGEX = (
-    rf"^{INVOICE_KEY_REGEX}"
-    r"\.(xml|XML|Xml|zip|ZIP|Zip|p7m|P7M|P7m)"
-    r"(\.(p7m|P7M|P7m))?$"
+invoice_filename_search_regex = re.compile(
+    r"(?P<filename>" + INVOICE_KEY_REGEX + r"\.(xml|XML|Xml)(\.(p7m|P7M|P7m))?)"
 )
-RESPONSE_MAIL_REGEX = (
-    rf"^{INVOICE_KEY_REGEX}_[A-Z]{{2}}_[a-zA-Z0-9]{{0,3}}"
-    r"\.(xml|XML|Xml)"
-    r"(\.(p7m|P7M|P7m))?$"
+
+SDI_NOTIFICATION_TYPES = ("RC", "NS", "MC", "NE", "DT", "AT", "MT")
+# The SdI messages end their subject with the IdentificativoSdI, e.g.
+# "POSTA CERTIFICATA: Notifica di esito 1234567"
+sdi_subject_id_regex = re.compile(
+    r"^(?:POSTA CERTIFICATA:\s*)?(?:Invio File|Ricevuta|Notifica|Attestazione)\b"
+    r"\D*?(?P<sdi_id>\d+)\s*$",
+    re.IGNORECASE,
+)
+# The notifications that answer a transmission and assign its IdentificativoSdI
+SDI_TRANSMISSION_NOTIFICATION_TYPES = ("RC", "NS", "MC")
+PEC_FILENAME_CACHE_SIZE = 4096
+pec_filename_regex = re.compile(
+    r"(?P<sender_id>IT[a-zA-Z0-9]{11,16}|(?!IT)[A-Z]{2}[a-zA-Z0-9]{2,28})"
+    r"_(?P<progressive>[a-zA-Z0-9]{1,5})"
+    r"(?:_(?P<notification_type>[A-Z]{2})_[a-zA-Z0-9]{0,3})?"
+    r"(?:\.(?P<extension>xml|XML|Xml|zip|ZIP|Zip|p7m|P7M|P7m))?"
+    r"(?P<p7m>\.(?:p7m|P7M|P7m))?"
 )
 
-fatturapa_regex = re.compile(FATTURAPA_IN_REGEX)
-response_regex = re.compile(RESPONSE_MAIL_REGEX)
-invoice_filename_search_regex = re.compile(
-    r"(?P<filename>" + INVOICE_KEY_REGEX + r"\.(xml|XML|Xml)(\.(p7m|P7M|P7m))?)"
+
+class PecFilenameKey(
+    namedtuple(
+        "PecFilenameKey", "sender_id progressive notification_type extension p7m"
+    )
+):
+    """SdI file name ``<sender_id>_<progressive>[_<type>_<id>].<ext>[.p7m]``.
+
+    ``extension`` is lower case, and empty when the name goes on after the
+    SdI part (e.g. a subject tail): such a key still identifies the invoice
+    but is neither an invoice nor a notification file.
+    """
+
+    __slots__ = ()
+
+    @property
+    def invoice_filename(self):
+        """Name of the invoice file the key refers to"""
+        return f"{self.sender_id}_{self.progressive}.xml"
+
+    @property
+    def invoice_key(self):
+        """Normalized key of the invoice, see ``account.move.l10n_it_edi_pec_key``"""
+        return f"{self.sender_id}_{self.progressive}".lower()
+
+    @property
+    def is_invoice(self):
+        return not self.notification_type and self.extension in ("xml", "zip", "p7m")
+
+    @property
+    def is_notification(self):
+        return bool(self.notification_type) and self.extension == "xml"
+
+
+@functools.lru_cache(maxsize=PEC_FILENAME_CACHE_SIZE)
+def pec_filename_key(filename):
+    """Return the ``PecFilenameKey`` of ``filename``, or None.
+
+    The same names come back for every attachment, subject and lookup of
+    a routing, so parsed keys are memoized.
+    """
+    filename = (filename or "").strip()
+    match = pec_filename_regex.match(filename)
+    if not match:
+        return None
+    extension = (match.group("extension") or "").lower()
+    p7m = bool(match.group("p7m")) or extension == "p7m"
+    if match.end() != len(filename):
+        extension, p7m = "", False
+    return PecFilenameKey(
+        match.group("sender_id"),
+        match.group("progressive"),
+        match.group("notification_type") or "",
+        extension,
+        p7m,
+    )
+
+
+SDI_MESSAGES_NAMESPACE = "http://ivaservizi.agenziaentrate.gov.it/docs/xsd/messaggi/v1.0"
+SDI_NOTIFICATION_ROOTS = {
+    "RicevutaConsegna": "RC",
+    "NotificaScarto": "NS",
+    "NotificaMancataConsegna": "MC",
+    "NotificaEsito": "NE",
+    "NotificaDecorrenzaTermini": "DT",
+    "AttestazioneTrasmissioneFattura": "AT",
+    "FileMetadati": "MT",
+}
+# Elements whose content identifies the type of a notification with an
+# unknown root, in order of precedence
+SDI_NOTIFICATION_MARKERS = (
+    ("ListaErrori", "NS"),
+    ("DataOraConsegna", "RC"),
+    ("EsitoCommittente", "NE"),
+    ("DecorrenzaTermini", "DT"),
+    ("AttestazioneTrasmissioneFattura", "AT"),
+)
+SDI_NOTIFICATION_FIELDS = ("IdentificativoSdI", "NomeFile", "Esito", "Descrizione") + tuple(
+    name for name, _type in SDI_NOTIFICATION_MARKERS
+)
+# All the fields in a single traversal of the tree; SdI only qualifies the
+# root element, but qualified children are matched as well
+sdi_notification_fields_xpath = etree.XPath(
+    "//*[" + " or ".join(f'local-name()="{name}"' for name in SDI_NOTIFICATION_FIELDS) + "]"
 )
 
 
-class MailThread(models.AbstractModel):
-    _inherit = "mail.thread"
+class SdiNotification(
+    namedtuple(
+        "SdiNotification", "type identificativo_sdi nome_file esito descriptions"
+    )
+):
+    """Fields of an SdI notification XML read by the PEC handlers"""
+
+    __slots__ = ()
 
-    def _coerce_bytes(self, value):
-        if not value:
-            return b""
-        if isinstance(value, (bytes, bytearray)):
-            return bytes(value)
-        if isinstance(value, str):
-            return value.encode()
-        return str(value).encode()
+    @property
+    def description(self):
+        return self.descriptions[0] if self.descriptions else ""
 
-    def _decode_bytes_maybe_base64(self, value):
-        raw = self._coerce_bytes(value)
-        head = raw[:200].lstrip()
-        if not head:
-            return b""
 
-        if b"<" in head or head.startswith(b"From:") or head.startswith(b"Received:"):
-            return raw
+def sdi_notification(root):
+    """Return the ``SdiNotification`` of the parsed notification ``root``.
+
+    The type comes from the root element of the SdI messages namespace;
+    other roots are typed from their content, as a last resort.
+    """
+    values = {}
+    descriptions = []
+    for node in sdi_notification_fields_xpath(root):
+        name = etree.QName(node).localname
+        if name in ("ListaErrori", "EsitoCommittente", "AttestazioneTrasmissioneFattura"):
+            text = "".join(node.itertext()).strip()
+        else:
+            text = (node.text or "").strip()
+        if name == "Descrizione":
+            if text:
+                descriptions.append(text)
+        elif text:
+            values.setdefault(name, text)
+
+    qname = etree.QName(root)
+    notification_type = None
+    if qname.namespace in (SDI_MESSAGES_NAMESPACE, None):
+        notification_type = SDI_NOTIFICATION_ROOTS.get(qname.localname)
+    if not notification_type:
+        notification_type = next(
+            (type_ for name, type_ in SDI_NOTIFICATION_MARKERS if values.get(name)), None
+        )
+    if not notification_type:
+        if descriptions and "consegna" in descriptions[0].lower():
+            notification_type = "MC"
+        else:
+            notification_type = "UNKNOWN"
 
+    return SdiNotification(
+        notification_type,
+        values.get("IdentificativoSdI", ""),
+        values.get("NomeFile", ""),
+        values.get("Esito", ""),
+        tuple(descriptions),
+    )
+
+
+# The PEC provider answers every message sent with acceptance and delivery
+# receipts, which reference its Message-Id in a header and in daticert.xml
+PEC_RECEIPT_TYPE_HEADER = "X-Ricevuta"
+PEC_RECEIPT_REFERENCE_HEADER = "X-Riferimento-Message-ID"
+PEC_RECEIPT_DATA_FILENAME = "daticert.xml"
+PEC_MESSAGE_ID_TAG = "l10n_it_edi_pec"
+
+PecReceipt = namedtuple("PecReceipt", "type message_id")
+
+
+def pec_message_id(domain=None):
+    """Return a new Message-Id for an e-invoice sent via PEC.
+
+    The ids carry ``PEC_MESSAGE_ID_TAG``, so the receipts that reference
+    them are recognized from their headers alone.
+    """
+    return make_msgid(idstring=PEC_MESSAGE_ID_TAG, domain=domain)
+
+
+def is_pec_message_id(message_id):
+    return f".{PEC_MESSAGE_ID_TAG}@" in (message_id or "")
+
+
+def _normalize_message_id(message_id):
+    message_id = str(message_id or "").strip()
+    if message_id and not message_id.startswith("<"):
+        message_id = f"<{message_id}>"
+    return message_id
+
+
+def pec_receipt(headers, attachments=()):
+    """Return the ``PecReceipt`` of a PEC provider receipt, or None.
+
+    The receipt type (``accettazione``, ``avvenuta-consegna``...) and the
+    referenced Message-Id are read from the headers, and from the
+    ``daticert.xml`` attachment when the headers lack them. The
+    certification of a plain message (``posta-certificata``) is no receipt.
+    """
+    receipt_type = str(headers.get(PEC_RECEIPT_TYPE_HEADER) or "").strip().lower()
+    message_id = _normalize_message_id(headers.get(PEC_RECEIPT_REFERENCE_HEADER))
+    if not (receipt_type and message_id):
+        for attachment in attachments or ():
+            if attachment.key != PEC_RECEIPT_DATA_FILENAME:
+                continue
+            try:
+                root = etree.fromstring(attachment.payload)
+            except (etree.LxmlError, ValueError):
+                break
+            receipt_type = receipt_type or (root.get("tipo") or "").strip().lower()
+            message_id = message_id or _normalize_message_id(root.findtext(".//msgid"))
+            break
+    if not message_id or receipt_type == "posta-certificata":
+        return None
+    return PecReceipt(receipt_type, message_id)
+
+
+MIME_LINE_LIMIT = 64 * 1024
+MIME_HEADER_LIMIT = 1024 * 1024
+MIME_MAX_NESTING = 2
+ZIP_READ_CHUNK_SIZE = 64 * 1024
+
+
+class _MimeLineReader:
+    """Read a binary file line by line, with a one-line push back.
+
+    Lines longer than ``MIME_LINE_LIMIT`` are returned in pieces; only the
+    first piece of a line can be a multipart delimiter.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushed = None
+        self.at_line_start = True
+
+    def readline(self):
+        if self.pushed is not None:
+            pushed, self.pushed = self.pushed, None
+            return pushed
+        line = self.fp.readline(MIME_LINE_LIMIT)
+        starts_line = self.at_line_start
+        self.at_line_start = line.endswith(b"\n")
+        return line, starts_line
+
+    def unread(self, line, starts_line):
+        self.pushed = (line, starts_line)
+
+
+class _MimeSpooledPart:
+    """Decoded payload of a MIME leaf part, written to a temporary file"""
+
+    __slots__ = ("fname", "mimetype", "path", "checksum", "size", "_file", "_sha1")
+
+    def __init__(self, directory, fname, mimetype):
+        self.fname = fname
+        self.mimetype = mimetype
+        fd, self.path = tempfile.mkstemp(suffix=".part", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self._sha1 = hashlib.sha1()
+        self.checksum = None
+        self.size = 0
+
+    def write(self, data):
+        if data:
+            self._file.write(data)
+            self._sha1.update(data)
+            self.size += len(data)
+
+    def close(self):
+        self._file.close()
+        self.checksum = self._sha1.hexdigest()
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
         try:
-            decoded = base64.b64decode(raw, validate=True)
-        except Exception:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _MimeBodyDecoder:
+    """Incrementally decode a part body according to its transfer encoding"""
+
+    def __init__(self, encoding, sink):
+        self.encoding = (encoding or "").strip().lower()
+        self.sink = sink
+        self.pending = b""
+
+    def feed(self, data):
+        if self.encoding == "base64":
+            data = self.pending + b"".join(data.split())
+            usable = len(data) - len(data) % 4
+            self.pending = data[usable:]
+            if usable:
+                self.sink.write(base64.b64decode(data[:usable]))
+        elif self.encoding == "quoted-printable":
+            self.sink.write(binascii.a2b_qp(data))
+        else:
+            self.sink.write(data)
+
+    def close(self):
+        if self.pending:
+            # Lenient on a truncated last quantum, like get_payload(decode=True)
             try:
-                decoded = base64.b64decode(raw)
-            except Exception:
-                return raw
+                self.sink.write(base64.b64decode(self.pending + b"==", validate=False))
+            except binascii.Error:
+                _logger.debug("Dropped a truncated base64 quantum")
+            self.pending = b""
+
+
+def _mime_delimiter(line, boundaries):
+    """Return ``(boundary, is_closing)`` when ``line`` delimits a part"""
+    if not line.startswith(b"--"):
+        return None
+    stripped = line.rstrip(b"\r\n").rstrip(b" \t")
+    for boundary in reversed(boundaries):
+        if stripped == b"--" + boundary:
+            return boundary, False
+        if stripped == b"--" + boundary + b"--":
+            return boundary, True
+    return None
+
+
+def _mime_next_delimiter(reader, boundaries):
+    """Skip to the next delimiter of ``boundaries`` and leave it unread"""
+    while True:
+        line, starts_line = reader.readline()
+        if not line:
+            return None
+        marker = starts_line and _mime_delimiter(line, boundaries)
+        if marker:
+            reader.unread(line, starts_line)
+            return marker
+
+
+def _mime_read_headers(reader):
+    lines = []
+    size = 0
+    while True:
+        line, starts_line = reader.readline()
+        if not line or (starts_line and line in (b"\r\n", b"\n")):
+            break
+        if size < MIME_HEADER_LIMIT:
+            lines.append(line)
+            size += len(line)
+    return BytesParser(policy=policy.default).parsebytes(b"".join(lines), headersonly=True)
+
+
+def _mime_read_body(reader, boundaries, decoder):
+    """Feed the body up to the next delimiter to ``decoder``.
+
+    The line break preceding a delimiter belongs to the delimiter, so each
+    line break is only written once the following line is known.
+    """
+    pending_eol = b""
+    while True:
+        line, starts_line = reader.readline()
+        if not line:
+            break
+        if starts_line and _mime_delimiter(line, boundaries):
+            reader.unread(line, starts_line)
+            break
+        if decoder is None:
+            continue
+        content = line.rstrip(b"\r\n")
+        eol = line[len(content):]
+        if decoder.encoding == "quoted-printable" and eol and content.endswith(b"="):
+            # Soft line break
+            content, eol = content[:-1], b""
+        decoder.feed(pending_eol + content)
+        pending_eol = eol
+    if decoder is not None:
+        decoder.close()
+
+
+def _mime_walk(reader, boundaries, directory, result, depth=0):
+    """Parse one MIME entity from ``reader`` into ``result``.
+
+    Leaf parts with a filename are decoded to temporary files in
+    ``directory``; nested messages are walked in place, as
+    ``_extract_pec_attachments_from_message`` does with the parsed tree.
+    """
+    headers = _mime_read_headers(reader)
+    content_type = headers.get_content_type()
+    encoding = headers.get("Content-Transfer-Encoding") or ""
+
+    if headers.get_content_maintype() == "multipart" and headers.get_boundary():
+        boundary = headers.get_boundary().encode("ascii", "replace")
+        inner_boundaries = boundaries + [boundary]
+        marker = _mime_next_delimiter(reader, inner_boundaries)
+        while marker and marker[0] == boundary:
+            reader.readline()
+            if marker[1]:
+                # Epilogue, up to the delimiter of an enclosing multipart
+                _mime_next_delimiter(reader, boundaries)
+                break
+            _mime_walk(reader, inner_boundaries, directory, result, depth=depth)
+            marker = _mime_next_delimiter(reader, inner_boundaries)
+        return headers
+
+    if (
+        content_type == "message/rfc822"
+        and depth < MIME_MAX_NESTING
+        and encoding.strip().lower() not in ("base64", "quoted-printable")
+    ):
+        nested = _mime_walk(reader, boundaries, directory, result, depth=depth + 1)
+        nested_subject = (nested.get("Subject") or "").strip()
+        if nested_subject and not result["nested_subject"]:
+            result["nested_subject"] = nested_subject
+        return headers
+
+    filename = headers.get_filename()
+    decoder = None
+    if filename:
+        part = _MimeSpooledPart(directory, filename, content_type)
+        result["parts"].append(part)
+        decoder = _MimeBodyDecoder(encoding, part)
+    _mime_read_body(reader, boundaries, decoder)
+    if filename:
+        part.close()
+    return headers
+
+
+def _pec_walk(message, max_nesting=MIME_MAX_NESTING):
+    """Yield the parts of the parsed ``message`` in ``Message.walk`` order.
+
+    ``message/rfc822`` parts are yielded as well, but only entered down to
+    ``max_nesting`` nested messages, like the stream parsing: PEC envelopes
+    never go deeper, and crafted messages cannot exhaust the stack or the
+    time of the routing.
+    """
+    stack = [(message, 0)]
+    while stack:
+        part, nesting = stack.pop()
+        yield part
+        if not part.is_multipart():
+            continue
+        if part.get_content_type() == "message/rfc822":
+            if nesting >= max_nesting:
+                continue
+            nesting += 1
+        stack.extend((subpart, nesting) for subpart in reversed(part.get_payload()))
+
+
+def _mime_stream_parse(fp, directory):
+    """Parse the message in binary file ``fp`` without loading it in memory.
+
+    Return ``(headers, nested_subject, parts)`` where ``parts`` are the
+    ``_MimeSpooledPart`` of the leaf parts that have a filename; their
+    temporary files belong to the caller.
+    """
+    result = {"nested_subject": "", "parts": []}
+    try:
+        headers = _mime_walk(_MimeLineReader(fp), [], directory, result)
+    except Exception:
+        for part in result["parts"]:
+            part.discard()
+        raise
+    return headers, result["nested_subject"], result["parts"]
+
+
+class _AllegatiExtractor:
+    """Parser target building an invoice tree without its ``Allegati``.
+
+    The ``Attachment`` payload of each ``Allegati`` is decoded from base64
+    while it is parsed, into a ``_MimeSpooledPart`` named after its
+    ``NomeAttachment``; the other elements go to a ``TreeBuilder``.
+    """
+
+    def __init__(self, directory):
+        self.builder = etree.TreeBuilder()
+        self.directory = directory
+        self.parts = []
+        self.depth = 0
+        self.field = None
+        self.text = []
+        self.values = {}
+        self.part = None
+        self.decoder = None
+
+    def start(self, tag, attrib, nsmap=None):
+        if not self.depth:
+            if etree.QName(tag).localname != "Allegati":
+                return self.builder.start(tag, attrib, nsmap)
+            self.values = {}
+        elif etree.QName(tag).localname == "Attachment":
+            self.part = _MimeSpooledPart(self.directory, "", "application/octet-stream")
+            self.parts.append(self.part)
+            self.decoder = _MimeBodyDecoder("base64", self.part)
+        else:
+            self.field = etree.QName(tag).localname
+            self.text = []
+        self.depth += 1
+
+    def data(self, data):
+        if not self.depth:
+            self.builder.data(data)
+        elif self.decoder:
+            self.decoder.feed(data.encode("ascii", "ignore"))
+        elif self.field:
+            self.text.append(data)
+
+    def end(self, tag):
+        if not self.depth:
+            return self.builder.end(tag)
+        self.depth -= 1
+        if self.decoder:
+            self.decoder.close()
+            self.part.close()
+            self.decoder = None
+        elif self.field:
+            self.values[self.field] = "".join(self.text).strip()
+            self.field = None
+        if not self.depth and self.part:
+            self.part.fname = self.values.get("NomeAttachment") or "allegato"
+            self.part = None
+
+    def comment(self, text):
+        if not self.depth:
+            self.builder.comment(text)
+
+    def pi(self, target, data=None):
+        if not self.depth:
+            self.builder.pi(target, data)
+
+    def close(self):
+        return self.builder.close()
+
+
+def _strip_invoice_allegati(fp, directory, chunk_size=64 * 1024):
+    """Parse the invoice XML in binary file ``fp`` without its attachments.
+
+    Return ``(xml, parts)``: the invoice serialized without its ``Allegati``
+    and the ``_MimeSpooledPart`` of their decoded payloads, whose temporary
+    files in ``directory`` belong to the caller. The payloads are decoded
+    chunk by chunk, so memory use does not depend on their size.
+    """
+    target = _AllegatiExtractor(directory)
+    parser = etree.XMLParser(target=target, huge_tree=True, resolve_entities=False)
+    try:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            parser.feed(chunk)
+        root = parser.close()
+    except Exception:
+        for part in target.parts:
+            part.discard()
+        raise
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8"), target.parts
+
+
+class PecMatchCache:
+    """Invoices matched by the keys of the messages of a routing run.
+
+    ``mail.thread._pec_prefetch_matches`` resolves the keys of the
+    messages of a commit batch up front, with one query per kind of key,
+    and the lookups of the routing read them here first. Each mapping goes from a
+    key to the id of its latest invoice, ``False`` when none matched:
+    ``invoice_keys`` is keyed by ``(company id, invoice key)``,
+    ``sdi_ids`` by IdentificativoSdI and ``message_ids`` by the Message-Id
+    of the invoice sent.
+    """
+
+    __slots__ = ("invoice_keys", "sdi_ids", "message_ids")
+
+    def __init__(self):
+        self.invoice_keys = {}
+        self.sdi_ids = {}
+        self.message_ids = {}
+
+    def clear(self):
+        """Forget every match, e.g. once the batch it was read for is rolled back"""
+        self.invoice_keys.clear()
+        self.sdi_ids.clear()
+        self.message_ids.clear()
+
+    @staticmethod
+    def lookup(mapping, keys):
+        """Return the latest invoice id of ``keys`` in ``mapping``.
+
+        ``False`` when none of them matched, None when one of them was not
+        resolved in advance and must be looked up.
+        """
+        move_ids = []
+        for key in keys:
+            if key not in mapping:
+                return None
+            move_ids.append(mapping[key])
+        return max(move_ids, default=False)
+
+
+PecMatchKeys = namedtuple("PecMatchKeys", "invoice_keys sdi_ids message_ids")
+
+
+class PecMimeMessage:
+    """Parsed PEC message shared by the routing steps.
+
+    ``message_route`` wraps the ``EmailMessage`` parsed by
+    ``message_process`` and puts it in the ``pec_mime`` context key, so the
+    handlers and the nested-eml unwrapping work on the same tree. Nested
+    messages found in attachments are only parsed when first needed, and
+    memoized per attachment.
+    """
+
+    __slots__ = ("message", "_nested")
+
+    def __init__(self, message):
+        self.message = message
+        self._nested = {}
+
+    def nested(self, attachment, parse):
+        """Return ``parse()``, computed once for ``attachment``"""
+        key = id(attachment)
+        if key not in self._nested:
+            self._nested[key] = (attachment, parse())
+        return self._nested[key][1]
+
+
+PEC_BASE64_HEAD = re.compile(rb"[A-Za-z0-9+/=\s]*")
+
+
+def _pec_payload(content):
+    """Return the decoded bytes of an attachment ``content``.
+
+    Attachments built by the PEC parsing already carry bytes; contents
+    coming from ``message_parse`` can be text, and contents built by older
+    callers can still be base64 encoded: those are decoded here, once.
+    """
+    if not content:
+        return b""
+    if isinstance(content, Message):
+        return content.as_bytes()
+    if isinstance(content, str):
+        content = content.encode()
+    elif isinstance(content, (bytearray, memoryview)):
+        content = bytes(content)
+    elif not isinstance(content, bytes):
+        content = str(content).encode()
+
+    head = content[:200].lstrip()
+    if (
+        b"<" in head
+        or head.startswith((b"From:", b"Received:"))
+        or not PEC_BASE64_HEAD.fullmatch(head)
+    ):
+        return content
+    try:
+        return base64.b64decode(b"".join(content.split()), validate=True) or content
+    except (binascii.Error, ValueError):
+        return content
+
+
+class PecAttachment:
+    """Attachment of a PEC message, decoded once.
+
+    ``payload`` holds the decoded bytes; for the attachments of streamed
+    messages it is only read from the filestore when a handler asks for it,
+    and for ``message/rfc822`` parts the parsed ``message`` is kept as is.
+    ``key`` is the normalized file name, ``filename_key`` its parsed
+    ``PecFilenameKey`` and ``kind`` its classification (``invoice``,
+    ``notification``, ``eml`` or ``other``); ``parse_notification`` parses
+    the SdI notification of the payload only once. ``content`` is
+    an alias of ``payload`` for the code written against the attachments of
+    ``message_parse``; use ``pec_attachment`` to build one from any of the
+    shapes the handlers accept.
+    """
+
+    __slots__ = (
+        "fname",
+        "key",
+        "filename_key",
+        "kind",
+        "mimetype",
+        "message",
+        "checksum",
+        "file_size",
+        "full_path",
+        "_payload",
+        "_notification",
+    )
+
+    def __init__(
+        self,
+        fname,
+        payload=None,
+        mimetype=None,
+        message=None,
+        checksum=None,
+        file_size=None,
+        full_path=None,
+    ):
+        self.fname = fname or ""
+        self.key = self.fname.strip().lower()
+        self.filename_key = pec_filename_key(self.fname)
+        if self.filename_key and self.filename_key.is_invoice:
+            self.kind = "invoice"
+        elif self.filename_key and self.filename_key.is_notification:
+            self.kind = "notification"
+        elif self.key.endswith(".eml"):
+            self.kind = "eml"
+        else:
+            self.kind = "other"
+        self.mimetype = mimetype
+        self.message = message
+        self.checksum = checksum
+        self.file_size = file_size
+        self.full_path = full_path
+        self._payload = payload
+        self._notification = None
+
+    def __repr__(self):
+        return f"<PecAttachment {self.fname!r} ({self.kind})>"
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            if self.message is not None:
+                self._payload = self.message.as_bytes()
+            elif self.full_path:
+                with open(self.full_path, "rb") as payload_file:
+                    return payload_file.read()
+            else:
+                self._payload = b""
+        return self._payload
 
-        decoded_head = decoded[:200].lstrip()
-        if b"<" in decoded_head or decoded_head.startswith(b"From:") or decoded_head.startswith(b"Received:"):
-            return decoded
-        return raw
+    content = payload
 
-    def _extract_pec_attachments_from_eml_bytes(self, eml_bytes, depth=0):
-        if not eml_bytes:
-            return "", []
+    def parse_notification(self):
+        """Return the ``(root, SdiNotification)`` of the payload.
 
-        try:
-            eml = BytesParser(policy=policy.default).parsebytes(eml_bytes)
-        except Exception:
-            return "", []
+        The payload is parsed on the first call only, and so is a parsing
+        error raised again to the later callers.
+        """
+        if self._notification is None:
+            try:
+                root = etree.fromstring(self.payload)
+                self._notification = (root, sdi_notification(root))
+            except Exception as e:
+                self._notification = e
+        if isinstance(self._notification, Exception):
+            raise self._notification
+        return self._notification
+
+
+def pec_attachment(attachment):
+    """Return ``attachment`` as a ``PecAttachment``.
+
+    Accepts ``PecAttachment`` as they are, objects with ``fname`` and
+    ``content`` (``message_parse`` attachments), dicts with ``fname`` or
+    ``name`` and ``content``, and ``(name, content)`` tuples.
+    """
+    if isinstance(attachment, PecAttachment):
+        return attachment
+    fname = getattr(attachment, "fname", "")
+    content = getattr(attachment, "content", None)
+    if not fname and isinstance(attachment, dict):
+        fname = attachment.get("fname") or attachment.get("name") or ""
+        content = attachment.get("content")
+    if not fname and isinstance(attachment, (tuple, list)) and attachment:
+        fname = attachment[0] or ""
+        content = attachment[1] if len(attachment) > 1 else None
+    if isinstance(content, Message):
+        return PecAttachment(fname, message=content)
+    return PecAttachment(fname, _pec_payload(content))
+
+
+def pec_attachments(attachments):
+    return [pec_attachment(attachment) for attachment in attachments or []]
+
+
+def pec_post_attachments(attachments):
+    """Return the ``(name, bytes)`` of ``attachments`` for ``message_post``.
+
+    Attachments without name or content are skipped, and so are the
+    duplicates of a file name.
+    """
+    result = []
+    seen = set()
+    for attachment in attachments or []:
+        attachment = pec_attachment(attachment)
+        if not attachment.key or attachment.key in seen:
+            continue
+        payload = attachment.payload
+        if not payload:
+            continue
+        seen.add(attachment.key)
+        result.append((attachment.fname, payload))
+    return result
+
+
+class MailThread(models.AbstractModel):
+    _inherit = "mail.thread"
 
+    def _extract_pec_attachments_from_message(self, eml):
+        """Return the subject and the file attachments of a parsed message.
+
+        ``_pec_walk`` descends into ``message/rfc822`` parts, down to
+        ``MIME_MAX_NESTING`` levels, so nested messages are visited in place
+        instead of being serialized and parsed again; they only provide the
+        subject when ``eml`` has none.
+        """
         subject = (eml.get("Subject") or "").strip()
         extracted = []
 
-        for part in eml.walk():
-            filename = part.get_filename() or ""
+        for part in _pec_walk(eml):
             content_type = (part.get_content_type() or "").lower()
 
             if content_type == "message/rfc822":
-                if depth >= 2:
-                    continue
                 payload = part.get_payload()
-                if isinstance(payload, list) and payload:
-                    try:
-                        nested_bytes = payload[0].as_bytes()
-                    except Exception:
-                        nested_bytes = b""
-                    nested_subject, nested_attachments = self._extract_pec_attachments_from_eml_bytes(
-                        nested_bytes, depth=depth + 1
-                    )
-                    if nested_subject and not subject:
-                        subject = nested_subject
-                    extracted.extend(nested_attachments)
+                if not subject and isinstance(payload, list) and payload:
+                    subject = (payload[0].get("Subject") or "").strip()
                 continue
 
             if part.is_multipart():
                 continue
 
+            filename = part.get_filename() or ""
             if not filename:
                 continue
 
@@ -116,63 +861,42 @@ class MailThread(models.AbstractModel):
                 continue
 
             extracted.append(
-                SimpleNamespace(
-                    fname=filename,
-                    content=base64.b64encode(payload_bytes),
-                )
+                PecAttachment(filename, payload_bytes, mimetype=content_type)
             )
 
         return subject, extracted
 
-    def _extract_pec_attachments_from_eml_attachment(self, attachment):
-        content = getattr(attachment, "content", None)
-        raw = self._coerce_bytes(content)
-        candidates = [raw]
+    def _extract_pec_attachments_from_eml_bytes(self, eml_bytes):
+        if not eml_bytes:
+            return "", []
 
         try:
-            decoded = base64.b64decode(raw, validate=True)
-            if decoded and decoded != raw:
-                candidates.append(decoded)
+            eml = BytesParser(policy=policy.default).parsebytes(eml_bytes)
         except Exception:
-            try:
-                decoded = base64.b64decode(raw)
-                if decoded and decoded != raw:
-                    candidates.append(decoded)
-            except Exception:
-                pass
-
-        best_subject = ""
-        best_attachments = []
-        for candidate in candidates:
-            subject, extracted = self._extract_pec_attachments_from_eml_bytes(candidate)
-            if len(extracted) > len(best_attachments):
-                best_subject = subject
-                best_attachments = extracted
-            elif extracted and not best_attachments and subject:
-                best_subject = subject
-                best_attachments = extracted
+            return "", []
+        return self._extract_pec_attachments_from_message(eml)
 
-        return best_subject, best_attachments
+    def _extract_pec_attachments_from_eml_attachment(self, attachment):
+        """Unwrap an ``.eml`` attachment, parsing it at most once per routing.
+
+        ``message_parse`` hands ``message/rfc822`` parts over as messages,
+        which are used as they are; raw contents are parsed once through the
+        ``pec_mime`` model of the routing context.
+        """
+        attachment = pec_attachment(attachment)
+        if attachment.message is not None:
+            return self._extract_pec_attachments_from_message(attachment.message)
+
+        mime = self.env.context.get("pec_mime") or PecMimeMessage(None)
+        return mime.nested(
+            attachment,
+            lambda: self._extract_pec_attachments_from_eml_bytes(attachment.payload),
+        )
 
     def _maybe_unwrap_pec_nested_eml(self, message_dict):
-        attachments = message_dict.get("attachments", []) or []
-        if not attachments:
-            return
-
-        def _att_name(att):
-            fname = getattr(att, "fname", "")
-            if not fname and isinstance(att, dict):
-                fname = att.get("fname") or att.get("name") or ""
-            if not fname and isinstance(att, (tuple, list)) and att:
-                fname = att[0] or ""
-            return fname or ""
-
-        nested_emls = []
-        for att in attachments:
-            fname = _att_name(att)
-            if (fname or "").lower().endswith(".eml"):
-                nested_emls.append(att)
-
+        attachments = pec_attachments(message_dict.get("attachments"))
+        message_dict["attachments"] = attachments
+        nested_emls = [att for att in attachments if att.kind == "eml"]
         if not nested_emls:
             return
 
@@ -187,23 +911,18 @@ class MailThread(models.AbstractModel):
         if not extracted:
             return
 
-        existing_names = {
-            (_att_name(a) or "").strip().lower()
-            for a in attachments
-            if _att_name(a)
-        }
+        existing_names = {a.key for a in attachments if a.key}
         deduped_extracted = []
         for a in extracted:
-            name = (getattr(a, "fname", "") or "").strip().lower()
-            if not name or name in existing_names:
+            if not a.key or a.key in existing_names:
                 continue
-            existing_names.add(name)
+            existing_names.add(a.key)
             deduped_extracted.append(a)
 
         if not deduped_extracted:
             return
 
-        message_dict["attachments"] = list(attachments) + deduped_extracted
+        message_dict["attachments"] = attachments + deduped_extracted
 
         current_subject = message_dict.get("subject") or ""
         current_invoice = self._extract_invoice_filename_from_text(current_subject)
@@ -213,7 +932,7 @@ class MailThread(models.AbstractModel):
 
         _logger.debug(
             "PEC nested eml unwrapped: extracted=%s inner_subject=%s",
-            [getattr(a, "fname", "") for a in deduped_extracted],
+            [a.fname for a in deduped_extracted],
             inner_subject,
         )
 
@@ -229,17 +948,19 @@ class MailThread(models.AbstractModel):
             "return_path": message.get("Return-Path"),
         }
         attachments = message_dict.get("attachments", []) or []
-        attachment_names = [getattr(a, "fname", "") for a in attachments]
         matches = []
-        for name in attachment_names:
-            if not name:
+        for attachment in pec_attachments(attachments):
+            if not attachment.fname:
                 continue
+            filename_key = attachment.filename_key
             matches.append(
                 {
-                    "name": name,
-                    "fatturapa": bool(fatturapa_regex.match(name)),
-                    "response": bool(response_regex.match(name)),
-                    "invoice_filename_in_text": self._extract_invoice_filename_from_text(name),
+                    "name": attachment.fname,
+                    "fatturapa": attachment.kind == "invoice",
+                    "response": attachment.kind == "notification",
+                    "invoice_filename_in_text": (
+                        filename_key.invoice_filename if filename_key else None
+                    ),
                 }
             )
 
@@ -274,44 +995,24 @@ class MailThread(models.AbstractModel):
         return self._normalize_invoice_xml_filename(match.group("filename"))
 
     def _extract_invoice_filenames_from_notification_xml(self, attachment):
-        content = getattr(attachment, "content", None)
-        xml_bytes = self._decode_bytes_maybe_base64(content)
-        if not xml_bytes:
+        attachment = pec_attachment(attachment)
+        if not attachment.payload:
             return []
 
         try:
-            root = etree.fromstring(xml_bytes)
+            filename = attachment.parse_notification()[1].nome_file
         except Exception:
             return []
 
-        filename = root.xpath('string(//*[local-name()="NomeFile"][1])')
-        filename = (filename or "").strip()
         if filename:
             return [self._normalize_invoice_xml_filename(filename)]
         return []
 
     def _invoice_filename_from_notification_filename(self, filename):
-        filename = (filename or "").strip()
-        if not filename:
-            return None
-
-        base = filename
-        lower = base.lower()
-        if lower.endswith(".xml.p7m"):
-            base = base[:-8]
-        elif lower.endswith(".p7m"):
-            base = base[:-4]
-        elif lower.endswith(".xml"):
-            base = base[:-4]
-
-        for sep in ("_RC_", "_NS_", "_MC_", "_NE_", "_DT_", "_AT_", "_MT_"):
-            if sep in base:
-                base = base.split(sep)[0]
-                break
-
-        if not base:
+        filename_key = pec_filename_key(filename)
+        if not filename_key:
             return None
-        return self._normalize_invoice_xml_filename(base + ".xml")
+        return filename_key.invoice_filename
 
     def clean_message_dict(self, message_dict):
         """Clean message dict from unnecessary fields"""
@@ -331,13 +1032,164 @@ class MailThread(models.AbstractModel):
         for field in fields_to_clean:
             message_dict.pop(field, None)
 
+    @api.model
+    def _pec_store_spooled_part(self, part):
+        """Move the payload of ``part`` into the filestore.
+
+        No ``ir.attachment`` is created here: the file is marked for the
+        filestore garbage collection and only kept if a handler creates an
+        attachment from its payload (see ``_pec_attachment_payload_vals``),
+        which then finds the file already in place.
+        """
+        Attachment = self.env["ir.attachment"].sudo()
+        if Attachment._storage() != "file":
+            with open(part.path, "rb") as part_file:
+                raw = part_file.read()
+            part.discard()
+            return PecAttachment(
+                part.fname,
+                raw,
+                mimetype=part.mimetype,
+                checksum=part.checksum,
+                file_size=part.size,
+            )
+
+        # Same layout as ``ir.attachment._get_path``, which cannot be used
+        # here: it compares an existing file with the data it is given
+        store_fname = "%s/%s" % (part.checksum[:2], part.checksum)
+        full_path = Attachment._full_path(store_fname)
+        if os.path.isfile(full_path):
+            # Same checksum, same content: the payload is already stored
+            part.discard()
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(part.path, full_path)
+        Attachment._mark_for_gc(store_fname)
+        return PecAttachment(
+            part.fname,
+            mimetype=part.mimetype,
+            checksum=part.checksum,
+            file_size=part.size,
+            full_path=full_path,
+        )
+
+    @api.model
+    def _pec_attachment_payload_vals(self, pec_attachment):
+        """Return the ``ir.attachment`` values of the payload of ``pec_attachment``.
+
+        ``ir.attachment`` computes its storage values from the data itself,
+        so the payload is always given as ``raw``: for streamed messages it
+        is read from the filestore only now, one attachment at a time.
+        Empty payloads give empty values.
+        """
+        raw = pec_attachment.payload
+        return {"raw": raw} if raw else {}
+
+    @api.model
+    def _pec_extract_invoice_allegati(self, attachment):
+        """Split the embedded ``Allegati`` out of the invoice ``attachment``.
+
+        Invoices above ``fetchmail.pec.stream.threshold`` bytes are stream
+        parsed: return the invoice XML without its ``Allegati`` and the
+        ``PecAttachment`` of their payloads, already in the filestore. Return
+        ``(None, [])`` when the invoice is to be imported as it is.
+        """
+        threshold = self.env["fetchmail.server"]._pec_stream_threshold()
+        if (attachment.file_size or 0) <= threshold or (attachment.name or "").lower().endswith(".p7m"):
+            return None, []
+
+        Attachment = self.env["ir.attachment"].sudo()
+        directory = Attachment._filestore()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            if attachment.store_fname:
+                with open(attachment._full_path(attachment.store_fname), "rb") as source:
+                    xml, parts = _strip_invoice_allegati(source, directory)
+            else:
+                xml, parts = _strip_invoice_allegati(io.BytesIO(attachment.raw), directory)
+        except (OSError, etree.LxmlError):
+            _logger.info(
+                "E-invoice %s could not be stream parsed, imported as it is",
+                attachment.name,
+                exc_info=True,
+            )
+            return None, []
+
+        try:
+            allegati = [self._pec_store_spooled_part(part) for part in parts]
+        finally:
+            for part in parts:
+                part.discard()
+        if not allegati:
+            return None, []
+        return xml, allegati
+
+    @api.model
+    def _pec_message_process_file(self, path):
+        """Route the PEC message stored at ``path`` without loading it.
+
+        Counterpart of ``message_process`` for large spooled messages: the
+        MIME structure is parsed line by line and the decoded attachments
+        go straight to the filestore, so memory use does not depend on the
+        message size. PEC routing handles the message itself and never
+        returns routes to process.
+        """
+        with open(path, "rb") as message_file:
+            message, nested_subject, parts = _mime_stream_parse(
+                message_file, os.path.dirname(path)
+            )
+        try:
+            attachments = [self._pec_store_spooled_part(part) for part in parts]
+        finally:
+            for part in parts:
+                part.discard()
+
+        subject = (message.get("Subject") or "").strip()
+        current_invoice = self._extract_invoice_filename_from_text(subject)
+        if nested_subject and (
+            subject.upper().startswith("POSTA CERTIFICATA")
+            or (self._extract_invoice_filename_from_text(nested_subject) and not current_invoice)
+        ):
+            subject = nested_subject
+
+        date = False
+        try:
+            parsed_date = parsedate_to_datetime(message.get("Date"))
+            if parsed_date.tzinfo:
+                parsed_date = parsed_date.astimezone(timezone.utc).replace(tzinfo=None)
+            date = fields.Datetime.to_string(parsed_date)
+        except (TypeError, ValueError):
+            pass
+
+        message_dict = {
+            "message_id": (message.get("Message-Id") or "").strip(),
+            "subject": subject,
+            "from": message.get("From") or "",
+            "date": date,
+            "body": "",
+            "attachments": attachments,
+        }
+        routes = self.message_route(message, message_dict)
+        if routes:
+            _logger.warning(
+                "Streamed PEC message %s was not handled by the PEC routing",
+                message_dict["message_id"],
+            )
+        return message_dict["message_id"]
+
     @api.model
     def message_route(
         self, message, message_dict, model=None, thread_id=None, custom_values=None
     ):
-        """Route PEC messages to appropriate handlers"""
+        """Route PEC messages to appropriate handlers.
 
-        self._maybe_unwrap_pec_nested_eml(message_dict)
+        The parsed ``message`` is shared with the handlers through the
+        ``pec_mime`` context key (see ``PecMimeMessage``). On the PEC
+        branches the attachments of ``message_dict`` become
+        ``PecAttachment``, decoded once for all the handlers.
+        """
+        if "pec_mime" not in self.env.context:
+            self = self.with_context(pec_mime=PecMimeMessage(message))
 
         # Check if this is a PEC message from SdI
         if any(
@@ -352,16 +1204,13 @@ class MailThread(models.AbstractModel):
                 "Processing FatturaPA PEC with Message-Id: %s",
                 message.get("Message-Id"),
             )
-            
+            self._maybe_unwrap_pec_nested_eml(message_dict)
+
             fatturapa_attachments = [
-                x
-                for x in message_dict.get("attachments", [])
-                if fatturapa_regex.match(x.fname)
+                x for x in message_dict["attachments"] if x.kind == "invoice"
             ]
             response_attachments = [
-                x
-                for x in message_dict.get("attachments", [])
-                if response_regex.match(x.fname)
+                x for x in message_dict["attachments"] if x.kind == "notification"
             ]
             
             # Incoming invoice with notification
@@ -379,15 +1228,22 @@ class MailThread(models.AbstractModel):
                 self.env.context["fetchmail_server_id"]
             )
             if fetchmail_server.is_l10n_it_edi_pec:
+                self._maybe_unwrap_pec_nested_eml(message_dict)
                 self._log_pec_routing_debug(message, message_dict, fetchmail_server=fetchmail_server)
+                # PEC receipts reference the Message-Id of the invoice sent
+                receipt = pec_receipt(message, message_dict["attachments"])
+                invoice = self._find_invoice_by_pec_receipt(receipt)
+                if invoice:
+                    return self.manage_pec_sdi_response(invoice, message_dict, receipt=receipt)
+
                 # Try to find related invoice by SUBJECT
                 invoice = self.find_invoice_by_subject(message_dict["subject"])
                 if invoice:
-                    return self.manage_pec_sdi_response(invoice, message_dict)
+                    return self.manage_pec_sdi_response(invoice, message_dict, receipt=receipt)
                 
                 # Try to find related invoice by ATTACHMENT (SdI notification)
                 # This handles cases where sender is not @pec.fatturapa.it or subject format differs
-                if any(response_regex.match(x.fname) for x in message_dict.get("attachments", [])):
+                if any(x.kind == "notification" for x in message_dict["attachments"]):
                     return self.manage_pec_sdi_notification(message, message_dict)
 
                 return self.manage_pec_sdi_notification(message, message_dict)
@@ -400,13 +1256,13 @@ class MailThread(models.AbstractModel):
             custom_values=custom_values,
         )
 
-    def manage_pec_sdi_response(self, invoice, message_dict):
+    def manage_pec_sdi_response(self, invoice, message_dict, receipt=None):
         """Handle PEC response related to sent invoice"""
         message_dict["model"] = "account.move"
         message_dict["res_id"] = invoice.id
         parsed = invoice._l10n_it_edi_parse_pec_notification(message_dict)
         if not parsed:
-            applied = invoice._l10n_it_edi_apply_pec_receipt(message_dict)
+            applied = invoice._l10n_it_edi_apply_pec_receipt(message_dict, receipt=receipt)
             _logger.info(
                 "PEC response fallback applied=%s invoice_id=%s invoice_name=%s subject=%s",
                 bool(applied),
@@ -415,29 +1271,9 @@ class MailThread(models.AbstractModel):
                 (message_dict or {}).get("subject"),
             )
             if not applied:
-                msg_attachments = []
-                seen = set()
-                for att in (message_dict or {}).get("attachments", []) or []:
-                    fname = getattr(att, "fname", "")
-                    content = getattr(att, "content", None)
-                    if not fname and isinstance(att, dict):
-                        fname = att.get("fname") or att.get("name") or ""
-                        content = att.get("content")
-                    if not fname and isinstance(att, (tuple, list)) and att:
-                        fname = att[0] or ""
-                        content = att[1] if len(att) > 1 else None
-
-                    if not fname or not content:
-                        continue
-
-                    key = (fname or "").strip().lower()
-                    if not key or key in seen:
-                        continue
-                    seen.add(key)
-
-                    payload = self._decode_bytes_maybe_base64(content)
-                    if payload:
-                        msg_attachments.append((fname, payload))
+                msg_attachments = pec_post_attachments(
+                    (message_dict or {}).get("attachments")
+                )
 
                 subject = (message_dict or {}).get("subject") or ""
                 invoice.message_post(
@@ -464,6 +1300,16 @@ class MailThread(models.AbstractModel):
             invoice_filename_from_subject,
         )
 
+        attachments = pec_attachments(message_dict.get("attachments"))
+        invoice = self._find_invoice_by_sdi_id(attachments)
+        if invoice:
+            _logger.info(
+                "PEC notification matched invoice by IdentificativoSdI invoice_id=%s invoice_name=%s",
+                invoice.id,
+                invoice.name,
+            )
+            return self.manage_pec_sdi_response(invoice, message_dict)
+
         invoice_from_subject = self.find_invoice_by_subject(subject)
         if invoice_from_subject:
             _logger.info(
@@ -473,75 +1319,44 @@ class MailThread(models.AbstractModel):
             )
             return self.manage_pec_sdi_response(invoice_from_subject, message_dict)
 
-        for attachment in message_dict.get("attachments", []):
-            fname = getattr(attachment, "fname", "")
+        tried = set()
+        for attachment in attachments:
+            fname = attachment.fname
             _logger.debug(
                 "PEC notification attachment fname=%s fatturapa_match=%s response_match=%s",
                 fname,
-                bool(fatturapa_regex.match(fname or "")),
-                bool(response_regex.match(fname or "")),
+                attachment.kind == "invoice",
+                attachment.kind == "notification",
             )
 
-            invoice_filename = self._invoice_filename_from_notification_filename(fname)
-            if invoice_filename:
-                _logger.debug(
-                    "PEC notification derived invoice_filename=%s from notification fname=%s",
-                    invoice_filename,
-                    fname,
-                )
-                invoice = self._find_invoice_by_xml_filename(invoice_filename)
-                if invoice:
-                    _logger.info(
-                        "PEC notification matched invoice by derived filename invoice_id=%s invoice_name=%s",
-                        invoice.id,
-                        invoice.name,
-                    )
-                    return self.manage_pec_sdi_response(invoice, message_dict)
-                _logger.debug(
-                    "PEC notification no invoice matched by derived filename=%s",
-                    invoice_filename,
-                )
-
-            match = response_regex.match(fname)
-            if match:
-                country_or_vat = match.group(1) or match.group(2) or ""
-                invoice_filename = f"{country_or_vat}_{match.group('progressive')}.xml"
-                invoice_filename = self._normalize_invoice_xml_filename(invoice_filename)
-                _logger.debug(
-                    "PEC notification inferred invoice_filename=%s from response attachment=%s",
-                    invoice_filename,
-                    fname,
-                )
-                invoice = self._find_invoice_by_xml_filename(invoice_filename)
-                if invoice:
-                    _logger.info(
-                        "PEC notification matched invoice by inferred filename invoice_id=%s invoice_name=%s",
-                        invoice.id,
-                        invoice.name,
-                    )
-                    return self.manage_pec_sdi_response(invoice, message_dict)
-                _logger.debug(
-                    "PEC notification no invoice matched by inferred filename=%s",
-                    invoice_filename,
-                )
-
-            invoice_filename = self._extract_invoice_filename_from_text(fname)
-            if invoice_filename:
+            # One lookup per invoice file name: the attachments of a
+            # notification usually all point to the same invoice
+            if attachment.filename_key:
+                invoice_filename = attachment.filename_key.invoice_filename
+                origin = "derived"
+            else:
+                invoice_filename = self._extract_invoice_filename_from_text(fname)
+                origin = "extracted"
+            if invoice_filename and invoice_filename.lower() not in tried:
+                tried.add(invoice_filename.lower())
                 _logger.debug(
-                    "PEC notification extracted invoice_filename=%s from attachment fname=%s",
+                    "PEC notification %s invoice_filename=%s from attachment fname=%s",
+                    origin,
                     invoice_filename,
                     fname,
                 )
                 invoice = self._find_invoice_by_xml_filename(invoice_filename)
                 if invoice:
                     _logger.info(
-                        "PEC notification matched invoice by extracted filename invoice_id=%s invoice_name=%s",
+                        "PEC notification matched invoice by %s filename invoice_id=%s invoice_name=%s",
+                        origin,
                         invoice.id,
                         invoice.name,
                     )
                     return self.manage_pec_sdi_response(invoice, message_dict)
                 _logger.debug(
-                    "PEC notification no invoice matched by extracted filename=%s",
+                    "PEC notification no invoice matched by %s filename=%s",
+                    origin,
                     invoice_filename,
                 )
 
@@ -554,6 +1369,9 @@ class MailThread(models.AbstractModel):
                 )
 
             for invoice_filename in invoice_filenames_from_xml:
+                if invoice_filename.lower() in tried:
+                    continue
+                tried.add(invoice_filename.lower())
                 invoice = self._find_invoice_by_xml_filename(invoice_filename)
                 if invoice:
                     _logger.info(
@@ -571,47 +1389,81 @@ class MailThread(models.AbstractModel):
             "PEC notification discarded: no match found message_id=%s subject=%s attachments=%s",
             message.get("Message-Id"),
             subject,
-            [getattr(a, "fname", "") for a in (message_dict.get("attachments", []) or [])],
+            [pec_attachment(a).fname for a in (message_dict.get("attachments", []) or [])],
         )
 
-        fetchmail_server_id = self.env.context.get("fetchmail_server_id")
-        if fetchmail_server_id:
-            company = self.env["res.company"].sudo().search(
-                [("l10n_it_edi_pec_server_id", "=", fetchmail_server_id)], limit=1
+        company = self._pec_server_company()
+        if company:
+            msg_attachments = pec_post_attachments(message_dict.get("attachments"))
+
+            company.message_post(
+                body=_(
+                    "Notifica PEC non associata ad alcuna fattura. Subject: %(subject)s - Message-Id: %(message_id)s"
+                )
+                % {
+                    "subject": subject,
+                    "message_id": message.get("Message-Id") or "",
+                },
+                attachments=msg_attachments,
             )
-            if company:
-                msg_attachments = []
-                seen = set()
-                for att in (message_dict.get("attachments", []) or []):
-                    fname = getattr(att, "fname", "")
-                    content = getattr(att, "content", None)
-                    if not fname and isinstance(att, dict):
-                        fname = att.get("fname") or att.get("name") or ""
-                        content = att.get("content")
-                    if not fname and isinstance(att, (tuple, list)) and att:
-                        fname = att[0] or ""
-                        content = att[1] if len(att) > 1 else None
-
-                    if not fname or not content:
-                        continue
-                    key = fname.strip().lower()
-                    if not key or key in seen:
-                        continue
-                    seen.add(key)
+        return []
+
+    def _pec_iter_invoice_files(self, fatturapa_attachments):
+        """Yield ``(invoice file, received attachment)`` of incoming invoices.
+
+        ZIP archives are expanded: each of their XML or P7M invoices is
+        yielded with the archive as received attachment.
+        """
+        for fp_att in pec_attachments(fatturapa_attachments):
+            if fp_att.filename_key and fp_att.filename_key.extension == "zip":
+                for member in self._pec_iter_zip_invoices(fp_att):
+                    yield member, fp_att
+            else:
+                yield fp_att, fp_att
 
-                    msg_attachments.append((fname, self._decode_bytes_maybe_base64(content)))
+    def _pec_iter_zip_invoices(self, archive):
+        """Yield the invoices of the ZIP ``archive`` as ``PecAttachment``.
 
-                company.message_post(
-                    body=_(
-                        "Notifica PEC non associata ad alcuna fattura. Subject: %(subject)s - Message-Id: %(message_id)s"
+        Members are read one at a time and copied in chunks to the
+        filestore (see ``_pec_store_spooled_part``), so neither the archive
+        nor a whole member is held in memory when the archive is stored.
+        """
+        Attachment = self.env["ir.attachment"].sudo()
+        directory = Attachment._filestore()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            if archive.full_path:
+                source = open(archive.full_path, "rb")
+            else:
+                source = io.BytesIO(archive.payload)
+            with source, zipfile.ZipFile(source) as zip_file:
+                for info in zip_file.infolist():
+                    name = os.path.basename(info.filename)
+                    filename_key = pec_filename_key(name)
+                    if (
+                        info.is_dir()
+                        or not (filename_key and filename_key.is_invoice)
+                        or filename_key.extension == "zip"
+                    ):
+                        continue
+                    part = _MimeSpooledPart(
+                        directory,
+                        name,
+                        "application/pkcs7-mime" if filename_key.p7m else "application/xml",
                     )
-                    % {
-                        "subject": subject,
-                        "message_id": message.get("Message-Id") or "",
-                    },
-                    attachments=msg_attachments,
-                )
-        return []
+                    try:
+                        with zip_file.open(info) as member:
+                            for chunk in iter(lambda: member.read(ZIP_READ_CHUNK_SIZE), b""):
+                                part.write(chunk)
+                        part.close()
+                        invoice_file = self._pec_store_spooled_part(part)
+                    finally:
+                        part.discard()
+                    yield invoice_file
+        except (OSError, zipfile.BadZipFile):
+            _logger.warning(
+                "Could not read the e-invoice archive %s", archive.fname, exc_info=True
+            )
 
     def manage_pec_fe_attachments(
         self, message, message_dict, response_attachments, fatturapa_attachments
@@ -620,36 +1472,20 @@ class MailThread(models.AbstractModel):
         if len(response_attachments) > 1:
             _logger.info("More than 1 notification found in incoming invoice mail")
 
-        fetchmail_server_id = self.env.context.get("fetchmail_server_id")
-        company = False
-        if fetchmail_server_id:
-            company = (
-                self.env["res.company"]
-                .sudo()
-                .search([("l10n_it_edi_pec_server_id", "=", fetchmail_server_id)], limit=1)
-            )
+        company = self._pec_server_company()
 
         Attachment = self.env["ir.attachment"].sudo()
         subject = (message_dict or {}).get("subject") or ""
 
         response_by_invoice = {}
-        for att in (message_dict.get("attachments", []) or []):
-            fname = getattr(att, "fname", "")
-            if not fname and isinstance(att, dict):
-                fname = att.get("fname") or att.get("name") or ""
-            if not fname and isinstance(att, (tuple, list)) and att:
-                fname = att[0] or ""
-            if not fname:
-                continue
-
-            invoice_filename = self._invoice_filename_from_notification_filename(fname)
-            if not invoice_filename:
+        for att in pec_attachments(message_dict.get("attachments")):
+            if not att.filename_key:
                 continue
-            response_by_invoice.setdefault(invoice_filename.strip().lower(), []).append(att)
+            invoice_filename = att.filename_key.invoice_filename
+            response_by_invoice.setdefault(invoice_filename.lower(), []).append(att)
 
-        for fp_att in fatturapa_attachments:
-            fname = getattr(fp_att, "fname", "")
-            content = getattr(fp_att, "content", None)
+        for fp_att, received_att in self._pec_iter_invoice_files(fatturapa_attachments):
+            fname = fp_att.fname
             if not fname:
                 continue
 
@@ -666,18 +1502,17 @@ class MailThread(models.AbstractModel):
             if existing and existing.res_id:
                 move = self.env["account.move"].sudo().browse(existing.res_id).exists()
             else:
-                raw = self._decode_bytes_maybe_base64(content)
-                if not raw:
-                    continue
-
                 new_att_vals = {
                     "name": fname,
                     "type": "binary",
                     "mimetype": "application/xml",
-                    "raw": raw,
                     "res_model": "account.move",
                     "res_id": 0,
                 }
+                payload_vals = self._pec_attachment_payload_vals(fp_att)
+                if not payload_vals:
+                    continue
+                new_att_vals.update(payload_vals)
                 if company:
                     new_att_vals["company_id"] = company.id
                 new_att = Attachment.create(new_att_vals)
@@ -686,34 +1521,12 @@ class MailThread(models.AbstractModel):
             if not move:
                 continue
 
-            resp_atts = response_by_invoice.get(
-                self._normalize_invoice_xml_filename(fname).strip().lower(),
-                response_attachments,
-            )
-            msg_attachments = []
-            seen = set()
-            for ra in resp_atts:
-                rname = getattr(ra, "fname", "")
-                rcontent = getattr(ra, "content", None)
-                if not rname and isinstance(ra, dict):
-                    rname = ra.get("fname") or ra.get("name") or ""
-                    rcontent = ra.get("content")
-                if not rname and isinstance(ra, (tuple, list)) and ra:
-                    rname = ra[0] or ""
-                    rcontent = ra[1] if len(ra) > 1 else None
-
-                if not rname or not rcontent:
-                    continue
-
-                key = (rname or "").strip().lower()
-                if not key or key in seen:
-                    continue
-                seen.add(key)
-
-                payload = self._decode_bytes_maybe_base64(rcontent)
-                if payload:
-                    msg_attachments.append((rname, payload))
-
+            resp_atts = response_attachments
+            if received_att.filename_key:
+                resp_atts = response_by_invoice.get(
+                    received_att.filename_key.invoice_filename.lower(), response_attachments
+                )
+            msg_attachments = pec_post_attachments(resp_atts)
             if msg_attachments:
                 move.message_post(
                     body=_("Notifiche PEC ricevute. Subject: %s") % subject,
@@ -723,42 +1536,156 @@ class MailThread(models.AbstractModel):
         self.clean_message_dict(message_dict)
         return []
 
+    def _pec_server_company(self):
+        """Return the company of the fetchmail server of the context.
+
+        Empty without server, or when no company receives on it.
+        """
+        fetchmail_server_id = self.env.context.get("fetchmail_server_id")
+        if not fetchmail_server_id:
+            return self.env["res.company"]
+        routing = self.env["fetchmail.server"].browse(fetchmail_server_id)._pec_routing()
+        return self.env["res.company"].sudo().browse(routing.company_id)
+
+    @api.model
+    def _pec_subject_match_keys(self, subject, reference_message_id=None):
+        """Return the ``PecMatchKeys`` known from the headers of a message.
+
+        The e-invoice file name or the IdentificativoSdI in the ``subject``,
+        and the Message-Id a PEC receipt refers to, are read without
+        parsing the message; the routing looks up the keys found in its
+        parts.
+        """
+        subject = subject or ""
+        invoice_keys = set()
+        filename = self._extract_invoice_filename_from_text(subject)
+        filename_key = pec_filename_key(filename) if filename else None
+        if filename_key:
+            invoice_keys.add(filename_key.invoice_key)
+        sdi_ids = set()
+        match = sdi_subject_id_regex.search(subject.strip())
+        if match:
+            sdi_ids.add(match.group("sdi_id"))
+        message_ids = set()
+        if is_pec_message_id(reference_message_id or ""):
+            message_ids.add(reference_message_id)
+        return PecMatchKeys(invoice_keys, sdi_ids, message_ids)
+
+    @api.model
+    def _pec_prefetch_matches(self, match_keys):
+        """Resolve at once the invoices of the ``PecMatchKeys`` of a batch.
+
+        Each kind of key is resolved with a single query into the
+        ``PecMatchCache`` of the ``pec_match_cache`` context key. The
+        routing of each message then reads its invoice there instead of
+        querying for it.
+        """
+        cache = self.env.context.get("pec_match_cache")
+        if cache is None:
+            return
+        invoice_keys, sdi_ids, message_ids = set(), set(), set()
+        for keys in match_keys:
+            invoice_keys |= keys.invoice_keys
+            sdi_ids |= keys.sdi_ids
+            message_ids |= keys.message_ids
+
+        Move = self.env["account.move"].sudo()
+
+        def _latest_moves(field_name, values, domain=()):
+            """Map each of ``values`` to the id of its latest move, or False"""
+            latest = dict.fromkeys(values, False)
+            if latest:
+                for row in Move.search_read(
+                    list(domain) + [(field_name, "in", list(latest))],
+                    [field_name],
+                    order="id desc",
+                ):
+                    latest[row[field_name]] = latest[row[field_name]] or row["id"]
+            return latest
+
+        company_id = self._pec_server_company().id
+        out_move_domain = [("move_type", "in", ("out_invoice", "out_refund", "out_receipt"))]
+        if company_id:
+            out_move_domain.append(("company_id", "=", company_id))
+
+        invoice_keys = {key for key in invoice_keys if (company_id, key) not in cache.invoice_keys}
+        for invoice_key, move_id in _latest_moves(
+            "l10n_it_edi_pec_key", invoice_keys, out_move_domain
+        ).items():
+            cache.invoice_keys[company_id, invoice_key] = move_id
+        cache.sdi_ids.update(
+            _latest_moves("l10n_it_edi_pec_sdi_id", sdi_ids - cache.sdi_ids.keys())
+        )
+        cache.message_ids.update(
+            _latest_moves("l10n_it_edi_pec_message_id", message_ids - cache.message_ids.keys())
+        )
+
+    def _pec_match_cache_lookup(self, mapping_name, keys):
+        """Return the invoice of ``keys`` resolved in the run cache, or None"""
+        cache = self.env.context.get("pec_match_cache")
+        if cache is None:
+            return None
+        move_id = cache.lookup(getattr(cache, mapping_name), keys)
+        if move_id is None:
+            return None
+        return self.env["account.move"].sudo().browse(move_id)
+
+    def _find_invoice_by_pec_receipt(self, receipt):
+        """Return the invoice sent with the Message-Id ``receipt`` refers to"""
+        if not receipt or not is_pec_message_id(receipt.message_id):
+            return self.env["account.move"]
+        move = self._pec_match_cache_lookup("message_ids", [receipt.message_id])
+        if move is not None:
+            return move
+        return (
+            self.env["account.move"]
+            .sudo()
+            .search([("l10n_it_edi_pec_message_id", "=", receipt.message_id)], limit=1)
+        )
+
+    def _find_invoice_by_sdi_id(self, attachments):
+        """Return the invoice whose stored IdentificativoSdI is the one of a
+        notification among ``attachments``.
+
+        The identifier is stored on the first notification of a
+        transmission, so this single indexed lookup matches all the later
+        ones without the file name heuristics.
+        """
+        sdi_ids = set()
+        for attachment in attachments:
+            if attachment.kind != "notification":
+                continue
+            try:
+                notification = attachment.parse_notification()[1]
+            except Exception:
+                continue
+            if notification.identificativo_sdi:
+                sdi_ids.add(notification.identificativo_sdi)
+        if not sdi_ids:
+            return self.env["account.move"]
+        move = self._pec_match_cache_lookup("sdi_ids", sdi_ids)
+        if move is not None:
+            return move
+        return (
+            self.env["account.move"]
+            .sudo()
+            .search(
+                [("l10n_it_edi_pec_sdi_id", "in", list(sdi_ids))],
+                order="id desc",
+                limit=1,
+            )
+        )
+
     def _find_invoice_by_xml_filename(self, filename):
         filename = (filename or "").strip()
         if not filename:
             return self.env["account.move"]
 
-        derived = self._invoice_filename_from_notification_filename(filename)
-        if derived:
-            filename = derived
-
-        filename = self._normalize_invoice_xml_filename(filename)
-
-        fetchmail_server_id = self.env.context.get("fetchmail_server_id")
-        company = False
-        if fetchmail_server_id:
-            company = (
-                self.env["res.company"]
-                .sudo()
-                .search([("l10n_it_edi_pec_server_id", "=", fetchmail_server_id)], limit=1)
-            )
+        filename_key = pec_filename_key(filename)
+        if not filename_key:
+            return self.env["account.move"]
 
-        def _base_name(name):
-            name = (name or "").strip()
-            lower = name.lower()
-            if lower.endswith(".xml.p7m"):
-                return name[:-8]
-            if lower.endswith(".p7m"):
-                return name[:-4]
-            if lower.endswith(".xml"):
-                return name[:-4]
-            return name
-
-        def _strip_notification_suffix(name):
-            for sep in ("_RC_", "_NS_", "_MC_", "_NE_", "_DT_", "_AT_", "_MT_"):
-                if sep in (name or ""):
-                    return (name or "").split(sep)[0]
-            return name
+        company = self._pec_server_company()
 
         def _move_from_attachment(att):
             if not att:
@@ -781,18 +1708,28 @@ class MailThread(models.AbstractModel):
 
         Move = self.env["account.move"].sudo()
         out_move_domain = [("move_type", "in", ("out_invoice", "out_refund", "out_receipt"))]
-        
-        base = _base_name(filename)
-        base_stripped = _strip_notification_suffix(base)
-        key_match = re.match(INVOICE_KEY_REGEX, base_stripped)
-        progressive = key_match.group("progressive") if key_match else ""
-        country_or_vat = key_match.group(1) if key_match else ""
-        if not (country_or_vat and progressive):
-            return self.env["account.move"]
-
         if company:
             out_move_domain.append(("company_id", "=", company.id))
-        else:
+
+        # Invoices sent by this module carry the key of their file
+        move = self._pec_match_cache_lookup(
+            "invoice_keys", [(company.id, filename_key.invoice_key)]
+        )
+        if move is None:
+            move = Move.search(
+                out_move_domain + [("l10n_it_edi_pec_key", "=", filename_key.invoice_key)],
+                order="id desc",
+                limit=1,
+            )
+        if move:
+            return move
+
+        # Otherwise look at the names of the attachments: invoices sent
+        # before the key existed or by other means, or whose key is the one
+        # of another file
+        country_or_vat = filename_key.sender_id
+        progressive = filename_key.progressive
+        if not company:
             out_move_domain.append(("company_id.vat", "=ilike", country_or_vat))
 
         Attachment = self.env["ir.attachment"].sudo()
@@ -878,19 +1815,11 @@ class MailThread(models.AbstractModel):
 
     def create_invoice_from_attachment(self, attachment, message_dict=None):
         """Create invoice from incoming e-invoice XML"""
-        fetchmail_server_id = self.env.context.get("fetchmail_server_id")
         received_date = False
         if message_dict and "date" in message_dict:
             received_date = message_dict["date"]
         
-        company_id = False
-        if fetchmail_server_id:
-            company = self.env["res.company"].sudo().search(
-                [("l10n_it_edi_pec_server_id", "=", fetchmail_server_id)],
-                limit=1,
-            )
-            if company:
-                company_id = company.id
+        company_id = self._pec_server_company().id
 
         # Create empty move
         move = self.env["account.move"].with_company(company_id or self.env.company.id).create(
@@ -904,18 +1833,54 @@ class MailThread(models.AbstractModel):
             "res_field": "l10n_it_edi_attachment_file",
         })
         
+        # Large embedded documents are moved to their own attachments, and
+        # the invoice is imported from a copy of the XML without them
+        slim_xml, allegati = self._pec_extract_invoice_allegati(attachment)
+        import_attachment = attachment
+        if slim_xml:
+            import_attachment = self.env["ir.attachment"].sudo().create(
+                {
+                    "name": attachment.name,
+                    "raw": slim_xml,
+                    "mimetype": "application/xml",
+                    "res_model": "account.move",
+                    "res_id": move.id,
+                }
+            )
+
         # Import from XML
         try:
             move_ctx = move.with_context(
                 account_predictive_bills_disable_prediction=True,
                 no_new_invoice=True,
             )
-            move_ctx._extend_with_attachments(attachment, new=True)
+            move_ctx._extend_with_attachments(import_attachment, new=True)
             move.message_post(body=_("Fattura fornitore generata da file in ingresso: %s") % attachment.name)
             
         except Exception as e:
             error_msg = _("Error importing e-invoice: %s") % str(e)
             _logger.error("Error importing e-invoice %s: %s", attachment.name, str(e))
             raise
+        finally:
+            if import_attachment != attachment:
+                import_attachment.unlink()
+
+        if allegati:
+            # One at a time: only one streamed payload is read in memory
+            allegati_attachments = self.env["ir.attachment"].sudo()
+            for allegato in allegati:
+                allegati_attachments |= allegati_attachments.create(
+                    {
+                        "name": allegato.fname,
+                        "res_model": "account.move",
+                        "res_id": move.id,
+                        "company_id": move.company_id.id,
+                        **self._pec_attachment_payload_vals(allegato),
+                    }
+                )
+            move.with_context(no_new_invoice=True).message_post(
+                body=_("Allegati della fattura in ingresso"),
+                attachment_ids=allegati_attachments.ids,
+            )
         
         return move
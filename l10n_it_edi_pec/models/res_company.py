@@ -1,7 +1,9 @@
 # Copyright 2025 Your Company
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+from odoo import api, fields, models
+
+SDI_PEC_EMAIL = "sdi01@pec.fatturapa.it"
 
 
 class ResCompany(models.Model):
@@ -31,9 +33,30 @@ class ResCompany(models.Model):
     l10n_it_edi_pec_sdi_email = fields.Char(
         string='SdI PEC Email',
         help="PEC email address of SdI (initially sdi01@pec.fatturapa.it)",
-        default='sdi01@pec.fatturapa.it'
+        default=SDI_PEC_EMAIL
     )
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        companies = super().create(vals_list)
+        if any(vals.get("l10n_it_edi_pec_server_id") for vals in vals_list):
+            # fetchmail.server._pec_routing maps the servers to companies
+            self.env.registry.clear_cache()
+        return companies
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "l10n_it_edi_pec_server_id" in vals:
+            self.env.registry.clear_cache()
+        return res
+
+    def _l10n_it_edi_pec_sdi_address(self):
+        """Return the PEC address of SdI the e-invoices are sent to"""
+        self.ensure_one()
+        return self.l10n_it_edi_pec_sdi_email or self.env[
+            "ir.config_parameter"
+        ].sudo().get_param("l10n_it_edi_pec.sdi_email", default=SDI_PEC_EMAIL)
+
     def _l10n_it_edi_export_check(self):
         errors = super()._l10n_it_edi_export_check()
         if not errors:
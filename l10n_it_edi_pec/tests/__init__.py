@@ -1 +1,2 @@
 from . import test_notification_matching
+from . import test_fetchmail_pec
@@ -0,0 +1,1255 @@
+import base64
+import io
+import os
+import socket
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from email.message import EmailMessage
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+
+from odoo.addons.l10n_it_edi_pec.models.account_move import PecMoveUpdates
+from odoo.addons.l10n_it_edi_pec.models.fetchmail_server import (
+    _imap_idle,
+    _imap_uid_set,
+    _parse_imap_fetch_response,
+)
+from odoo.addons.l10n_it_edi_pec.models.mail_thread import (
+    PecAttachment,
+    _mime_stream_parse,
+    _strip_invoice_allegati,
+    pec_attachment,
+    pec_message_id,
+    pec_post_attachments,
+)
+
+
+IMAP_OPEN = "odoo.addons.l10n_it_edi_pec.models.fetchmail_server._imap_open"
+
+
+def _raw_message(uid, sender="sdi01@pec.fatturapa.it"):
+    return (
+        b"From: %s\r\nMessage-Id: <%d@example.com>\r\nSubject: message %d\r\n"
+        b"\r\nbody %d\r\n" % (sender.encode(), uid, uid, uid)
+    )
+
+
+def _invoice_message(message_id, attachments):
+    """Return an SdI message delivering the invoice files ``attachments``"""
+    message = EmailMessage()
+    message["From"] = "sdi01@pec.fatturapa.it"
+    message["Message-Id"] = message_id
+    message["Subject"] = "Invio File IT01234567890_abcde.xml"
+    message.set_content("Fattura in ingresso")
+    for fname, payload in [("IT01234567890_abcde_MT_001.xml", b"<FileMetadati/>")] + attachments:
+        message.add_attachment(
+            payload, maintype="application", subtype="octet-stream", filename=fname
+        )
+    return message.as_bytes()
+
+
+class FakeImap:
+    """IMAP connection serving ``messages`` by UID, recording the commands"""
+
+    capabilities = ("IMAP4REV1",)
+
+    def __init__(self, messages, responses=None):
+        self.messages = messages
+        self.responses = responses or {}
+        self.commands = []
+        self.seen = set()
+        self.missing_headers = set()
+        self.failing_fetch = None
+
+    def select(self, mailbox="INBOX"):
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        value = self.responses.get(code)
+        return code, [value.encode() if value else None]
+
+    def enable(self, capability):
+        return "OK", []
+
+    def close(self):
+        pass
+
+    def logout(self):
+        pass
+
+    def _uids(self, uid_set):
+        uids = set()
+        for part in uid_set.split(","):
+            first, __, last = part.partition(":")
+            uids.update(range(int(first), int(last or first) + 1))
+        return sorted(uids & set(self.messages))
+
+    def uid(self, command, *args):
+        self.commands.append((command,) + args)
+        if command == "search":
+            criteria = args[-1]
+            if criteria.endswith(":*"):
+                first = int(criteria[4:-2])
+                uids = [uid for uid in sorted(self.messages) if uid >= first]
+            elif criteria.startswith("UID "):
+                uids = self._uids(criteria[4:])
+            else:
+                uids = [uid for uid in sorted(self.messages) if uid not in self.seen]
+            return "OK", [b" ".join(b"%d" % uid for uid in uids)]
+        if command == "store":
+            self.seen.update(self._uids(args[0]))
+            return "OK", []
+        uid_set, items = args
+        if self.failing_fetch and self.failing_fetch in items:
+            return "NO", [b"fetch failed"]
+        data = []
+        for uid in self._uids(uid_set):
+            raw_message = self.messages[uid]
+            payload = raw_message
+            if "HEADER.FIELDS" in items:
+                if uid in self.missing_headers:
+                    continue
+                payload = raw_message.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+            data.append(
+                (
+                    b"%d (UID %d RFC822.SIZE %d BODY[] {%d}"
+                    % (uid, uid, len(raw_message), len(payload)),
+                    payload,
+                )
+            )
+            data.append(b")")
+        return "OK", data
+
+    def fetched_bodies(self):
+        return [
+            command[1]
+            for command in self.commands
+            if command[0] == "fetch" and "HEADER.FIELDS" not in command[2]
+        ]
+
+
+@tagged("post_install", "-at_install")
+class TestPecFetchmail(TransactionCase):
+    def test_imap_uid_set_compresses_ranges(self):
+        self.assertEqual(
+            _imap_uid_set([b"1003", b"1001", b"1002", b"7", b"1005"]),
+            "7,1001:1003,1005",
+        )
+
+    def test_parse_imap_fetch_response_reads_uid_from_envelope_or_trailer(self):
+        data = [
+            (b"1 (UID 101 BODY[] {3}", b"abc"),
+            b")",
+            (b"2 (BODY[] {3}", b"def"),
+            b" UID 102)",
+        ]
+        self.assertEqual(
+            list(_parse_imap_fetch_response(data)),
+            [(b"101", b"abc"), (b"102", b"def")],
+        )
+
+    def test_imap_sync_uids_searches_above_high_water_mark(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+                "pec_imap_uidvalidity": "42",
+                "pec_imap_last_uid": 100,
+                "pec_imap_retry_uids": "90",
+            }
+        )
+        imap_server = MagicMock()
+        imap_server.response.side_effect = lambda code: (
+            code,
+            {"UIDVALIDITY": [b"42"], "UIDNEXT": [b"103"]}.get(code, [None]),
+        )
+        imap_server.uid.return_value = ("OK", [b"100 101 102"])
+
+        uids, modseq = server._pec_imap_sync_uids(imap_server)
+
+        imap_server.uid.assert_called_once_with("search", None, "UID 101:*")
+        self.assertEqual(uids, [b"90", b"101", b"102"])
+        self.assertIsNone(modseq)
+
+    def test_imap_sync_uids_skips_search_when_nothing_arrived(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+                "pec_imap_uidvalidity": "42",
+                "pec_imap_last_uid": 102,
+            }
+        )
+        imap_server = MagicMock()
+        imap_server.response.side_effect = lambda code: (
+            code,
+            {"UIDVALIDITY": [b"42"], "UIDNEXT": [b"103"]}.get(code, [None]),
+        )
+
+        self.assertEqual(server._pec_imap_sync_uids(imap_server), ([], None))
+        imap_server.uid.assert_not_called()
+
+    def _imap_pec_server(self, **values):
+        return self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+                "pec_imap_uidvalidity": "42",
+                "pec_imap_last_uid": 100,
+                **values,
+            }
+        )
+
+    def _fetch_imap(self, server, imap_server):
+        error_messages = []
+        with patch(IMAP_OPEN, return_value=imap_server), patch.object(
+            self.env.cr, "commit"
+        ):
+            server.fetch_mail_server_type_imap(server, MagicMock(), error_messages)
+        return error_messages
+
+    def test_imap_screens_non_sdi_messages_on_headers(self):
+        server = self._imap_pec_server(pec_run_max_messages=2)
+        imap_server = FakeImap(
+            {
+                101: _raw_message(101),
+                102: _raw_message(102, "newsletter@example.com"),
+                103: _raw_message(103),
+            },
+            {"UIDVALIDITY": "42", "UIDNEXT": "104"},
+        )
+
+        self.assertFalse(self._fetch_imap(server, imap_server))
+
+        header_fetches = [
+            imap_server._uids(command[1])
+            for command in imap_server.commands
+            if command[0] == "fetch" and "HEADER.FIELDS" in command[2]
+        ]
+        self.assertEqual(header_fetches, [[101, 102, 103]])
+        downloaded = [
+            uid for body in imap_server.fetched_bodies() for uid in imap_server._uids(body)
+        ]
+        self.assertEqual(sorted(downloaded), [101, 103])
+        # Screened messages do not use the run budget and stay unread
+        self.assertEqual(imap_server.seen, {101, 103})
+        self.assertFalse(server._pec_imap_retry_uid_list())
+        self.assertEqual(server.pec_imap_last_uid, 103)
+        spooled = self.env["fetchmail.pec.spool"].search([("server_id", "=", server.id)])
+        self.assertEqual(
+            sorted(spooled.mapped("message_id")), ["<101@example.com>", "<103@example.com>"]
+        )
+
+    def test_imap_uids_without_headers_are_retried(self):
+        server = self._imap_pec_server()
+        imap_server = FakeImap(
+            {uid: _raw_message(uid) for uid in (101, 102, 103)},
+            {"UIDVALIDITY": "42", "UIDNEXT": "104"},
+        )
+        imap_server.missing_headers.add(102)
+
+        self.assertFalse(self._fetch_imap(server, imap_server))
+
+        self.assertEqual(imap_server.seen, {101, 103})
+        self.assertEqual(server._pec_imap_retry_uid_list(), [102])
+        # The high-water mark stays below the UID that was not examined
+        self.assertEqual(server.pec_imap_last_uid, 101)
+
+        imap_server.missing_headers.clear()
+        self.assertFalse(self._fetch_imap(server, imap_server))
+        self.assertEqual(imap_server.seen, {101, 102, 103})
+        self.assertFalse(server._pec_imap_retry_uid_list())
+        self.assertEqual(server.pec_imap_last_uid, 103)
+
+    def test_imap_expunged_retry_uids_are_dropped(self):
+        server = self._imap_pec_server(pec_imap_retry_uids="90,95")
+        imap_server = FakeImap(
+            {uid: _raw_message(uid) for uid in (95, 101, 102)},
+            {"UIDVALIDITY": "42", "UIDNEXT": "103"},
+        )
+        # 90 was expunged, 95 is still there but its headers are not returned
+        imap_server.missing_headers.add(95)
+
+        self.assertFalse(self._fetch_imap(server, imap_server))
+
+        self.assertEqual(imap_server.seen, {101, 102})
+        self.assertEqual(server._pec_imap_retry_uid_list(), [95])
+        self.assertEqual(server.pec_imap_last_uid, 102)
+
+    def test_imap_failed_header_fetch_keeps_sync_state(self):
+        server = self._imap_pec_server(pec_imap_retry_uids="90")
+        imap_server = FakeImap(
+            {uid: _raw_message(uid) for uid in (90, 101)},
+            {"UIDVALIDITY": "42", "UIDNEXT": "102"},
+        )
+        imap_server.failing_fetch = "HEADER.FIELDS"
+
+        error_messages = self._fetch_imap(server, imap_server)
+
+        self.assertEqual(len(error_messages), 1)
+        self.assertFalse(imap_server.seen)
+        self.assertEqual(server._pec_imap_retry_uid_list(), [90])
+        self.assertEqual(server.pec_imap_last_uid, 100)
+
+    def test_imap_run_out_of_budget_does_not_store_modseq(self):
+        server = self._imap_pec_server(pec_run_max_messages=1)
+        imap_server = FakeImap(
+            {uid: _raw_message(uid) for uid in (101, 102)},
+            {"UIDVALIDITY": "42", "UIDNEXT": "103", "HIGHESTMODSEQ": "7"},
+        )
+        imap_server.capabilities = ("IMAP4REV1", "CONDSTORE", "ENABLE")
+        FetchmailServer = type(server)
+
+        with patch.object(FetchmailServer, "_pec_schedule_next_run") as schedule_next_run:
+            self.assertFalse(self._fetch_imap(server, imap_server))
+        schedule_next_run.assert_called_once()
+        self.assertEqual(imap_server.seen, {101})
+        self.assertEqual(server.pec_imap_last_uid, 101)
+        self.assertFalse(server.pec_imap_highest_modseq)
+
+        # Same HIGHESTMODSEQ, yet the rest of the mailbox is still searched
+        imap_server.commands.clear()
+        self.assertFalse(self._fetch_imap(server, imap_server))
+        self.assertIn(("search", None, "UID 102:*"), imap_server.commands)
+        self.assertEqual(imap_server.seen, {101, 102})
+        self.assertEqual(server.pec_imap_last_uid, 102)
+        self.assertEqual(server.pec_imap_highest_modseq, "7")
+
+        imap_server.commands.clear()
+        self.assertFalse(self._fetch_imap(server, imap_server))
+        self.assertFalse([c for c in imap_server.commands if c[0] == "search"])
+
+    def _idle_connection(self, received):
+        """Return an IMAP connection on a socket pair whose peer already sent
+        ``received``, and the peer"""
+        client, peer = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(peer.close)
+        peer.sendall(received)
+        file = client.makefile("rb")
+        self.addCleanup(file.close)
+        imap_server = SimpleNamespace(
+            sock=client,
+            file=file,
+            readline=file.readline,
+            send=client.sendall,
+            _new_tag=lambda: b"A001",
+        )
+        return imap_server, peer
+
+    def test_imap_idle_sees_new_messages_buffered_with_continuation(self):
+        # EXISTS arrives with the continuation: it is in the buffer of the
+        # connection, not on the socket
+        imap_server, peer = self._idle_connection(
+            b"+ idling\r\n* 3 EXISTS\r\nA001 OK IDLE terminated\r\n"
+        )
+        self.assertTrue(_imap_idle(imap_server, 30))
+        self.assertEqual(peer.recv(1024), b"A001 IDLE\r\nDONE\r\n")
+
+    def test_imap_idle_ends_without_activity_after_timeout(self):
+        imap_server, peer = self._idle_connection(b"+ idling\r\n")
+
+        def _end_idle():
+            received = b""
+            while b"DONE" not in received:
+                received += peer.recv(1024)
+            peer.sendall(b"A001 OK IDLE terminated\r\n")
+
+        thread = threading.Thread(target=_end_idle)
+        thread.start()
+        self.assertFalse(_imap_idle(imap_server, 0.1))
+        thread.join()
+
+    def test_imap_fetch_commits_per_batch_and_isolates_failing_message(self):
+        self.env["ir.config_parameter"].sudo().set_param("fetchmail.pec.commit.batch_size", 2)
+        server = self._imap_pec_server()
+        imap_server = FakeImap(
+            {uid: _raw_message(uid) for uid in range(101, 106)},
+            {"UIDVALIDITY": "42", "UIDNEXT": "106"},
+        )
+        Spool = type(self.env["fetchmail.pec.spool"])
+        spool_chunks = Spool._spool_chunks
+        commits = []
+
+        def _spool_chunks(self, server, chunks, headers=None):
+            if str(headers["Message-Id"]) == "<103@example.com>":
+                raise OSError("No space left on device")
+            return spool_chunks(self, server, chunks, headers)
+
+        def _commit():
+            commits.append(sorted(imap_server.seen))
+
+        with patch(IMAP_OPEN, return_value=imap_server), patch.object(
+            self.env.cr, "commit", side_effect=_commit
+        ), patch.object(Spool, "_spool_chunks", autospec=True, side_effect=_spool_chunks):
+            error_messages = []
+            server.fetch_mail_server_type_imap(server, MagicMock(), error_messages)
+
+        self.assertEqual(error_messages, ["No space left on device"])
+        # Flags are set once the batch is committed: none before the first
+        self.assertEqual(commits, [[], [101, 102], [101, 102, 104, 105]])
+        self.assertEqual(imap_server.seen, {101, 102, 104, 105})
+        self.assertEqual(server._pec_imap_retry_uid_list(), [103])
+        spooled = self.env["fetchmail.pec.spool"].search([("server_id", "=", server.id)])
+        self.assertEqual(
+            sorted(spooled.mapped("message_id")),
+            ["<101@example.com>", "<102@example.com>", "<104@example.com>", "<105@example.com>"],
+        )
+
+    def test_imap_database_error_rolls_back_only_its_message(self):
+        server = self._imap_pec_server()
+        imap_server = FakeImap(
+            {uid: _raw_message(uid) for uid in (101, 102, 103)},
+            {"UIDVALIDITY": "42", "UIDNEXT": "104"},
+        )
+        Spool = type(self.env["fetchmail.pec.spool"])
+        spool_chunks = Spool._spool_chunks
+
+        def _spool_chunks(self, server, chunks, headers=None):
+            entry = spool_chunks(self, server, chunks, headers)
+            if str(headers["Message-Id"]) == "<102@example.com>":
+                # Aborts the transaction after the entry was written
+                self.env.cr.execute("SELECT 1 / 0", log_exceptions=False)
+            return entry
+
+        with patch.object(Spool, "_spool_chunks", autospec=True, side_effect=_spool_chunks):
+            error_messages = self._fetch_imap(server, imap_server)
+
+        self.assertEqual(len(error_messages), 1)
+        self.assertIn("division by zero", error_messages[0])
+        self.assertEqual(imap_server.seen, {101, 103})
+        self.assertEqual(server._pec_imap_retry_uid_list(), [102])
+        self.assertEqual(server.pec_imap_last_uid, 103)
+        spooled = self.env["fetchmail.pec.spool"].search([("server_id", "=", server.id)])
+        self.assertEqual(
+            sorted(spooled.mapped("message_id")), ["<101@example.com>", "<103@example.com>"]
+        )
+
+    def test_imap_idle_timeout_parameter_is_sanitized(self):
+        FetchmailServer = self.env["fetchmail.server"]
+        set_param = self.env["ir.config_parameter"].sudo().set_param
+        set_param("fetchmail.pec.idle.timeout", "a minute")
+        self.assertEqual(FetchmailServer._pec_idle_timeout(), 240)
+        set_param("fetchmail.pec.idle.timeout", "0")
+        self.assertEqual(FetchmailServer._pec_idle_timeout(), 1)
+
+    def test_pop_screens_headers_and_skips_ledger_entries(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC POP",
+                "server_type": "pop",
+                "server": "pop.example.com",
+                "is_ssl": True,
+                "is_l10n_it_edi_pec": True,
+                "pec_pop_uidl_ledger": '{"known": "skip", "gone": "done"}',
+            }
+        )
+        pop_server = MagicMock()
+        pop_server.uidl.return_value = (b"+OK", [b"1 known", b"2 news"], 0)
+        pop_server.top.return_value = (
+            b"+OK",
+            [b"From: newsletter@example.com", b"Subject: news"],
+            0,
+        )
+        MailThread = MagicMock()
+        error_messages = []
+        with patch(
+            "odoo.addons.l10n_it_edi_pec.models.fetchmail_server.poplib.POP3_SSL",
+            return_value=pop_server,
+        ), patch.object(self.env.cr, "commit"):
+            server.fetch_mail_server_type_pop(server, MailThread, error_messages)
+
+        pop_server.top.assert_called_once_with(2, 0)
+        pop_server.retr.assert_not_called()
+        MailThread.with_context.assert_not_called()
+        self.assertFalse(error_messages)
+        self.assertEqual(server._pec_pop_ledger(), {"known": "skip", "news": "skip"})
+
+    def test_header_screening_keeps_receipts_of_sent_invoices(self):
+        server = self.env["fetchmail.server"].create(
+            {"name": "PEC", "server_type": "imap", "is_l10n_it_edi_pec": True}
+        )
+        self.assertTrue(server._pec_headers_are_sdi({"From": "sdi01@pec.fatturapa.it"}))
+        self.assertTrue(
+            server._pec_headers_are_sdi(
+                {
+                    "From": "posta-certificata@pec.example.com",
+                    "X-Riferimento-Message-ID": pec_message_id("example.com"),
+                }
+            )
+        )
+        # Receipts of messages not sent by this module are still skipped
+        self.assertFalse(
+            server._pec_headers_are_sdi(
+                {
+                    "From": "posta-certificata@pec.example.com",
+                    "X-Riferimento-Message-ID": "<other@example.com>",
+                }
+            )
+        )
+
+    def test_routing_company_is_cached_until_companies_change(self):
+        server = self.env["fetchmail.server"].create(
+            {"name": "PEC", "server_type": "imap", "is_l10n_it_edi_pec": True}
+        )
+        company = self.env.company
+        company.l10n_it_edi_pec_server_id = server
+        MailThread = self.env["mail.thread"].with_context(fetchmail_server_id=server.id)
+
+        self.assertEqual(MailThread._pec_server_company(), company)
+        with self.assertQueryCount(0):
+            self.assertEqual(MailThread._pec_server_company(), company)
+
+        company.l10n_it_edi_pec_server_id = False
+        self.assertFalse(MailThread._pec_server_company())
+
+    def test_pop_stops_at_run_budget_and_schedules_next_run(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC POP",
+                "server_type": "pop",
+                "server": "pop.example.com",
+                "is_ssl": True,
+                "is_l10n_it_edi_pec": True,
+                "pec_run_max_messages": 1,
+            }
+        )
+        messages = {
+            1: [b"From: sdi01@pec.fatturapa.it", b"Message-Id: <1@sdi>", b"", b"one"],
+            2: [b"From: sdi01@pec.fatturapa.it", b"Message-Id: <2@sdi>", b"", b"two"],
+        }
+        pop_server = MagicMock()
+        pop_server.uidl.return_value = (b"+OK", [b"1 first", b"2 second"], 0)
+        pop_server.list.return_value = (b"+OK", [b"1 40", b"2 40"], 0)
+        pop_server.top.side_effect = lambda num, lines: (b"+OK", messages[num][:2], 0)
+        pop_server.retr.side_effect = lambda num: (b"+OK", messages[num], 0)
+        FetchmailServer = type(server)
+        with patch(
+            "odoo.addons.l10n_it_edi_pec.models.fetchmail_server.poplib.POP3_SSL",
+            return_value=pop_server,
+        ) as pop3_ssl, patch.object(self.env.cr, "commit"), patch.object(
+            FetchmailServer, "_pec_schedule_next_run"
+        ) as schedule_next_run:
+            server.fetch_mail_server_type_pop(server, MagicMock(), [])
+
+        pop3_ssl.assert_called_once_with("pop.example.com", 995, timeout=60)
+        pop_server.retr.assert_called_once_with(1)
+        pop_server.dele.assert_called_once_with(1)
+        schedule_next_run.assert_called_once()
+        self.assertEqual(server._pec_pop_ledger(), {"first": "done"})
+
+    def _pop_streaming_server(self, retr_lines):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "fetchmail.pec.stream.threshold", 65536
+        )
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC POP",
+                "server_type": "pop",
+                "server": "pop.example.com",
+                "is_ssl": True,
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        pop_server = MagicMock()
+        pop_server.uidl.return_value = (b"+OK", [b"1 big", b"2 small"], 0)
+        pop_server.list.return_value = (b"+OK", [b"1 100000", b"2 40"], 0)
+        pop_server.top.side_effect = lambda num, lines: (
+            b"+OK",
+            [b"From: sdi01@pec.fatturapa.it", b"Message-Id: <%d@sdi>" % num],
+            0,
+        )
+        pop_server._getline.side_effect = retr_lines
+        pop_server.retr.return_value = (
+            b"+OK",
+            [b"From: sdi01@pec.fatturapa.it", b"Message-Id: <2@sdi>", b"", b"two"],
+            0,
+        )
+        return server, pop_server
+
+    def _fetch_pop_failing_stream(self, server, pop_server):
+        Spool = type(self.env["fetchmail.pec.spool"])
+        spool_chunks = Spool._spool_chunks
+
+        def _spool_chunks(self, server, chunks, headers=None):
+            if str(headers["Message-Id"]) == "<1@sdi>":
+                next(iter(chunks))
+                raise OSError("No space left on device")
+            return spool_chunks(self, server, chunks, headers)
+
+        error_messages = []
+        with patch(
+            "odoo.addons.l10n_it_edi_pec.models.fetchmail_server.poplib.POP3_SSL",
+            return_value=pop_server,
+        ), patch.object(self.env.cr, "commit"), patch.object(
+            Spool, "_spool_chunks", autospec=True, side_effect=_spool_chunks
+        ):
+            server.fetch_mail_server_type_pop(server, MagicMock(), error_messages)
+        return error_messages
+
+    def test_pop_failed_stream_reads_rest_of_message(self):
+        lines = [b"From: sdi01@pec.fatturapa.it", b"a" * 40000, b"b" * 40000, b"c", b"."]
+        server, pop_server = self._pop_streaming_server(
+            [(line, len(line)) for line in lines]
+        )
+
+        error_messages = self._fetch_pop_failing_stream(server, pop_server)
+
+        self.assertEqual(error_messages, ["No space left on device"])
+        pop_server._putcmd.assert_called_once_with("RETR 1")
+        self.assertEqual(pop_server._getline.call_count, len(lines))
+        pop_server.close.assert_not_called()
+        pop_server.retr.assert_called_once_with(2)
+        pop_server.dele.assert_called_once_with(2)
+        self.assertEqual(server._pec_pop_ledger(), {"big": "retry", "small": "done"})
+
+    def test_pop_failed_stream_aborts_unreadable_session(self):
+        lines = [b"From: sdi01@pec.fatturapa.it", b"a" * 40000, b"b" * 40000]
+        server, pop_server = self._pop_streaming_server(
+            [(line, len(line)) for line in lines] + [TimeoutError("timed out")]
+        )
+
+        error_messages = self._fetch_pop_failing_stream(server, pop_server)
+
+        self.assertEqual(error_messages, ["No space left on device", "timed out"])
+        pop_server.close.assert_called_once()
+        pop_server.retr.assert_not_called()
+        pop_server.dele.assert_not_called()
+
+    def test_parallel_fetch_uses_a_cursor_per_server_and_reports_errors(self):
+        servers = self.env["fetchmail.server"].create(
+            [
+                {
+                    "name": name,
+                    "server_type": "imap",
+                    "server": "%s.example.com" % name,
+                    "is_l10n_it_edi_pec": True,
+                }
+                for name in ("first", "second")
+            ]
+        )
+        FetchmailServer = type(servers)
+        fetched = {}
+
+        def _fetch_pec_server(self, raise_exception=True):
+            fetched[self.id] = (self.env.cr, threading.current_thread().name)
+            if self.name == "second":
+                raise ConnectionError("mailbox unavailable")
+
+        with patch.object(
+            FetchmailServer, "_fetch_pec_server", autospec=True, side_effect=_fetch_pec_server
+        ):
+            with self.assertRaisesRegex(ConnectionError, "mailbox unavailable"):
+                servers._fetch_pec_servers_parallel(2)
+
+        self.assertEqual(set(fetched), set(servers.ids))
+        cursors = {cr for cr, __ in fetched.values()}
+        self.assertEqual(len(cursors), 2)
+        self.assertNotIn(self.env.cr, cursors)
+        for __, thread_name in fetched.values():
+            self.assertTrue(thread_name.startswith("pec-fetch"))
+
+    def test_only_the_fetch_cron_commits_to_fetch_in_parallel(self):
+        servers = self.env["fetchmail.server"].create(
+            [
+                {
+                    "name": name,
+                    "server_type": "imap",
+                    "server": "%s.example.com" % name,
+                    "is_l10n_it_edi_pec": True,
+                }
+                for name in ("first", "second")
+            ]
+        )
+        self.env["ir.config_parameter"].sudo().set_param("fetchmail.pec.fetch.workers", 4)
+        self.env.company.write(
+            {"l10n_it_edi_use_pec": True, "l10n_it_edi_pec_server_id": servers[0].id}
+        )
+        self.env["res.company"].create(
+            {
+                "name": "PEC company",
+                "l10n_it_edi_use_pec": True,
+                "l10n_it_edi_pec_server_id": servers[1].id,
+            }
+        )
+        FetchmailServer = type(servers)
+
+        with patch.object(self.env.registry, "in_test_mode", return_value=False), patch.object(
+            self.env.cr, "commit"
+        ) as commit, patch.object(
+            FetchmailServer, "_fetch_pec_server"
+        ) as fetch_server, patch.object(
+            FetchmailServer, "_fetch_pec_servers_parallel"
+        ) as fetch_parallel:
+            # A manual fetch keeps the transaction of its caller
+            servers.fetch_mail()
+            commit.assert_not_called()
+            fetch_parallel.assert_not_called()
+            self.assertEqual(fetch_server.call_count, 2)
+
+            self.env["fetchmail.server"]._cron_fetch_pec_mail()
+            commit.assert_called_once()
+            fetch_parallel.assert_called_once_with(4)
+
+    def test_circuit_breaker_opens_skips_and_closes_after_probe(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        self.env["ir.config_parameter"].sudo().set_param("fetchmail.pec.max.retry", 1)
+        FetchmailServer = type(server)
+
+        def _fail(self, server, MailThread, error_messages, **kwargs):
+            error_messages.append("connection refused")
+
+        with patch.object(
+            FetchmailServer, "fetch_mail_server_type_imap", autospec=True, side_effect=_fail
+        ) as fetch_imap, patch.object(FetchmailServer, "notify_or_log"):
+            server._fetch_pec_server()
+            self.assertEqual(server.pec_breaker_state, "closed")
+            server._fetch_pec_server()
+            self.assertEqual(server.pec_breaker_state, "open")
+            self.assertTrue(server.active)
+            self.assertGreater(server.pec_breaker_next_attempt, fields.Datetime.now())
+
+            server._fetch_pec_server()
+            self.assertEqual(fetch_imap.call_count, 2)
+
+        server.pec_breaker_next_attempt = fields.Datetime.now() - timedelta(seconds=1)
+        with patch.object(FetchmailServer, "fetch_mail_server_type_imap") as fetch_imap:
+            server._fetch_pec_server()
+        fetch_imap.assert_called_once()
+        self.assertEqual(server.pec_breaker_state, "closed")
+        self.assertEqual(server.pec_error_count, 0)
+
+    def test_spool_deduplicates_and_routes_messages(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        raw = b"From: sdi01@pec.fatturapa.it\r\nMessage-Id: <a@b>\r\n\r\nbody"
+        Spool = self.env["fetchmail.pec.spool"]
+        entry = Spool._spool_message(server, raw, {"Message-Id": "<a@b>"})
+        self.assertEqual(entry.state, "pending")
+        self.assertEqual(entry._read_raw(), raw)
+        self.assertEqual(Spool._spool_message(server, raw, {"Message-Id": "<a@b>"}), entry)
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(MailThread, "message_process") as message_process, patch.object(
+            self.env.cr, "commit"
+        ):
+            entry._process_pending()
+
+        message_process.assert_called_once()
+        self.assertEqual(entry.state, "done")
+        self.assertFalse(entry.store_fname)
+
+    def test_spool_prefetches_batch_from_headers_within_budget(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+                "pec_run_max_messages": 2,
+            }
+        )
+        reference = pec_message_id("example.com")
+        Spool = self.env["fetchmail.pec.spool"]
+        entries = Spool
+        for sdi_id in ("101", "102", "103"):
+            entries |= Spool._spool_message(
+                server,
+                b"Message-Id: <%s@sdi>\r\n\r\nbody" % sdi_id.encode(),
+                {
+                    "Message-Id": "<%s@sdi>" % sdi_id,
+                    "Subject": "POSTA CERTIFICATA: Notifica di esito %s" % sdi_id,
+                    "X-Riferimento-Message-ID": reference,
+                },
+            )
+        self.assertEqual(entries[0].reference_message_id, reference)
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(MailThread, "message_process") as message_process, patch.object(
+            MailThread, "_pec_prefetch_matches"
+        ) as prefetch_matches, patch.object(
+            type(Spool), "_read_raw", autospec=True, return_value=b""
+        ) as read_raw, patch.object(
+            self.env.cr, "commit"
+        ), patch.object(
+            type(Spool), "_trigger_processing"
+        ):
+            entries._process_pending()
+
+        # Out of budget after two messages: the third is neither read nor
+        # resolved, and each message is read once, by its routing
+        self.assertEqual(message_process.call_count, 2)
+        self.assertEqual(read_raw.call_count, 2)
+        prefetch_matches.assert_called_once()
+        match_keys = prefetch_matches.call_args.args[0]
+        self.assertEqual([keys.sdi_ids for keys in match_keys], [{"101"}, {"102"}])
+        self.assertEqual(match_keys[0].message_ids, {reference})
+
+    def test_spool_entry_with_failed_invoice_updates_is_retried(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        Spool = self.env["fetchmail.pec.spool"]
+        entry = Spool._spool_message(server, b"Subject: failing\r\n\r\nbody")
+        done_entry = Spool._spool_message(server, b"Subject: applied\r\n\r\nbody")
+
+        def _message_process(self, model, message, **kwargs):
+            name = message.split(b"\r\n")[0].split(b": ")[1].decode()
+            self.env["res.partner"].create({"name": "PEC %s" % name})
+
+        flush = PecMoveUpdates.flush
+
+        def _flush(self, env):
+            if any(source == entry.id for __, source in self.sources):
+                self.updates, self.sources = [], []
+                return {entry.id: "could not serialize access"}
+            return flush(self, env)
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(
+            MailThread, "message_process", autospec=True, side_effect=_message_process
+        ), patch.object(self.env.cr, "commit"):
+            with patch.object(PecMoveUpdates, "flush", autospec=True, side_effect=_flush):
+                (entry | done_entry)._process_pending()
+
+            self.assertEqual(entry.state, "error")
+            self.assertEqual(entry.attempts, 1)
+            self.assertEqual(entry.error_message, "could not serialize access")
+            self.assertTrue(entry.store_fname)
+            self.assertEqual(done_entry.state, "done")
+
+            entry._process_pending()
+
+        self.assertEqual(entry.state, "done")
+        # The routing of the failed entry was rolled back with its updates
+        self.assertEqual(
+            self.env["res.partner"].search([("name", "=like", "PEC %")]).mapped("name"),
+            ["PEC applied", "PEC failing"],
+        )
+
+    def test_spool_skips_entries_routed_by_a_concurrent_run(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        Spool = self.env["fetchmail.pec.spool"]
+        entry = Spool._spool_message(server, b"Message-Id: <a@b>\r\n\r\nbody")
+        other_entry = Spool._spool_message(server, b"Message-Id: <c@d>\r\n\r\nbody")
+        entries = entry | other_entry
+        entries.mapped("state")
+        # Routed by a manual check after the cron read the entries
+        self.env.cr.execute(
+            "UPDATE fetchmail_pec_spool SET state = 'done' WHERE id = %s", (other_entry.id,)
+        )
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(MailThread, "message_process") as message_process, patch.object(
+            self.env.cr, "commit"
+        ):
+            entries._process_pending()
+
+        message_process.assert_called_once()
+        self.assertEqual(entry.state, "done")
+        self.assertEqual(other_entry.attempts, 0)
+
+    def test_spool_routing_failure_rolls_back_only_its_message(self):
+        self.env["ir.config_parameter"].sudo().set_param("fetchmail.pec.commit.batch_size", 2)
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        Spool = self.env["fetchmail.pec.spool"]
+        entries = Spool
+        for name in ("first", "broken", "third"):
+            entries |= Spool._spool_message(server, b"Subject: %s\r\n\r\nbody" % name.encode())
+
+        def _message_process(self, model, message, **kwargs):
+            name = message.split(b"\r\n")[0].split(b": ")[1].decode()
+            self.env["res.partner"].create({"name": "PEC %s" % name})
+            if name == "broken":
+                raise ValueError("malformed")
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(
+            MailThread, "message_process", autospec=True, side_effect=_message_process
+        ), patch.object(self.env.cr, "commit") as commit:
+            entries._process_pending()
+
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(entries.mapped("state"), ["done", "error", "done"])
+        self.assertEqual(
+            self.env["res.partner"].search([("name", "=like", "PEC %")]).mapped("name"),
+            ["PEC first", "PEC third"],
+        )
+
+    def test_stream_parse_decodes_nested_parts_to_files(self):
+        xml = b"<FatturaElettronica>" + b"x" * 100000 + b"</FatturaElettronica>"
+        raw = b"\r\n".join(
+            [
+                b"From: sdi01@pec.fatturapa.it",
+                b"Subject: POSTA CERTIFICATA: Invio File 1",
+                b'Content-Type: multipart/mixed; boundary="outer"',
+                b"",
+                b"--outer",
+                b"Content-Type: message/rfc822",
+                b"",
+                b"Subject: Invio File IT01234567890_abcde.xml",
+                b'Content-Type: multipart/mixed; boundary="inner"',
+                b"",
+                b"--inner",
+                b"Content-Type: text/plain",
+                b"",
+                b"body",
+                b"--inner",
+                b"Content-Type: application/xml",
+                b'Content-Disposition: attachment; filename="IT01234567890_abcde.xml"',
+                b"Content-Transfer-Encoding: base64",
+                b"",
+                base64.b64encode(xml),
+                b"--inner--",
+                b"--outer--",
+                b"",
+            ]
+        )
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "message.eml")
+        with open(path, "wb") as message_file:
+            message_file.write(raw)
+
+        with open(path, "rb") as message_file:
+            headers, nested_subject, parts = _mime_stream_parse(message_file, directory)
+
+        self.assertEqual(headers["From"], "sdi01@pec.fatturapa.it")
+        self.assertEqual(nested_subject, "Invio File IT01234567890_abcde.xml")
+        self.assertEqual([part.fname for part in parts], ["IT01234567890_abcde.xml"])
+        with open(parts[0].path, "rb") as part_file:
+            self.assertEqual(part_file.read(), xml)
+        self.assertEqual(parts[0].size, len(xml))
+        parts[0].discard()
+
+    def test_spool_streams_messages_above_threshold(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        self.env["ir.config_parameter"].sudo().set_param(
+            "fetchmail.pec.stream.threshold", 65536
+        )
+        chunks = [b"From: sdi01@pec.fatturapa.it\r\n\r\n", b"x" * 70000]
+        entry = self.env["fetchmail.pec.spool"]._spool_chunks(server, iter(chunks))
+        self.assertEqual(entry.size, sum(len(chunk) for chunk in chunks))
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(MailThread, "message_process") as message_process, patch.object(
+            MailThread, "_pec_message_process_file"
+        ) as process_file, patch.object(self.env.cr, "commit"):
+            entry._process_pending()
+
+        message_process.assert_not_called()
+        process_file.assert_called_once()
+        self.assertEqual(entry.state, "done")
+
+    def _import_invoice_messages(self, *messages):
+        """Spool and route ``messages``, return the entries and the invoice attachments"""
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        Spool = self.env["fetchmail.pec.spool"]
+        entries = Spool.browse()
+        for raw in messages:
+            entries |= Spool._spool_message(server, raw)
+        imported = []
+
+        def _create_invoice_from_attachment(self, attachment, message_dict=None):
+            imported.append(attachment)
+            return self.env["account.move"]
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(
+            MailThread,
+            "create_invoice_from_attachment",
+            autospec=True,
+            side_effect=_create_invoice_from_attachment,
+        ), patch.object(self.env.cr, "commit"):
+            entries._process_pending()
+        return entries, imported
+
+    def test_streamed_invoice_is_imported_with_its_content(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "fetchmail.pec.stream.threshold", 65536
+        )
+        invoice = b"<FatturaElettronica>%s</FatturaElettronica>" % (b"<!-- padding -->" * 5000)
+
+        entries, imported = self._import_invoice_messages(
+            _invoice_message("<1@sdi>", [("IT01234567890_abcde.xml", invoice)])
+        )
+
+        self.assertGreater(entries.size, 65536)
+        self.assertEqual(entries.state, "done")
+        self.assertEqual(
+            [(attachment.name, attachment.raw) for attachment in imported],
+            [("IT01234567890_abcde.xml", invoice)],
+        )
+
+    def test_streamed_payload_already_in_filestore_is_reused(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "fetchmail.pec.stream.threshold", 65536
+        )
+        invoice = b"<FatturaElettronica>%s</FatturaElettronica>" % (b"<!-- resent -->" * 5000)
+        attachments = [("IT01234567890_abcde.xml", invoice)]
+
+        # The same invoice delivered again: its payload is already stored
+        entries, imported = self._import_invoice_messages(
+            _invoice_message("<1@sdi>", attachments),
+            _invoice_message("<2@sdi>", attachments),
+        )
+
+        self.assertEqual(entries.mapped("state"), ["done", "done"])
+        self.assertEqual([attachment.raw for attachment in imported], [invoice, invoice])
+
+    def test_spool_quarantines_and_parks_failing_messages(self):
+        server = self.env["fetchmail.server"].create(
+            {
+                "name": "PEC",
+                "server_type": "imap",
+                "server": "imap.example.com",
+                "is_l10n_it_edi_pec": True,
+            }
+        )
+        self.env["ir.config_parameter"].sudo().set_param(
+            "fetchmail.pec.quarantine.max_attempts", 2
+        )
+        raw = b"From: sdi01@pec.fatturapa.it\r\nMessage-Id: <bad@sdi>\r\n\r\nbody"
+        Spool = self.env["fetchmail.pec.spool"]
+        entry = Spool._spool_message(server, raw, {"Message-Id": "<bad@sdi>"})
+
+        MailThread = type(self.env["mail.thread"])
+        with patch.object(
+            MailThread, "message_process", side_effect=ValueError("malformed")
+        ) as message_process, patch.object(self.env.cr, "commit"), patch.object(
+            type(server), "notify_or_log"
+        ) as notify_or_log:
+            Spool._cron_process(server_ids=server.ids)
+            self.assertEqual(entry.state, "error")
+            self.assertEqual(entry.attempts, 1)
+            self.assertGreater(entry.next_attempt, fields.Datetime.now())
+            notify_or_log.assert_not_called()
+
+            # Not due yet
+            Spool._cron_process(server_ids=server.ids)
+            self.assertEqual(message_process.call_count, 1)
+
+            entry.action_reprocess()
+            self.assertEqual(entry.state, "parked")
+            notify_or_log.assert_called_once()
+
+            Spool._cron_process(server_ids=server.ids)
+            self.assertEqual(message_process.call_count, 2)
+
+        self.assertEqual(
+            Spool._spooled_message_ids(server, ["<bad@sdi>", "<other@sdi>"]),
+            {"<bad@sdi>"},
+        )
+
+    def test_nested_eml_unwrapped_from_parsed_message_without_reparsing(self):
+        postacert = EmailMessage()
+        postacert["Subject"] = "Invio File IT01234567890_abcde.xml"
+        postacert.set_content("notification")
+        postacert.add_attachment(
+            b"<RicevutaConsegna/>",
+            maintype="application",
+            subtype="xml",
+            filename="IT01234567890_abcde_RC_001.xml",
+        )
+        message_dict = {
+            "subject": "POSTA CERTIFICATA: Invio File",
+            "attachments": [SimpleNamespace(fname="postacert.eml", content=postacert)],
+        }
+        MailThread = self.env["mail.thread"]
+        with patch.object(
+            type(MailThread), "_extract_pec_attachments_from_eml_bytes"
+        ) as parse_bytes:
+            MailThread._maybe_unwrap_pec_nested_eml(message_dict)
+
+        parse_bytes.assert_not_called()
+        self.assertEqual(message_dict["subject"], "Invio File IT01234567890_abcde.xml")
+        self.assertEqual(
+            [att.fname for att in message_dict["attachments"]],
+            ["postacert.eml", "IT01234567890_abcde_RC_001.xml"],
+        )
+
+    def test_nested_messages_are_unwrapped_two_levels_deep(self):
+        notification = EmailMessage()
+        notification.set_content("notification")
+        notification.add_attachment(
+            b"<RicevutaConsegna/>",
+            maintype="application",
+            subtype="xml",
+            filename="IT01234567890_abcde_RC_001.xml",
+        )
+
+        def _wrap(message, levels):
+            for level in range(levels):
+                envelope = EmailMessage()
+                envelope["Subject"] = "envelope %d" % level
+                envelope.set_content("envelope")
+                envelope.add_attachment(message)
+                message = envelope
+            return message
+
+        MailThread = self.env["mail.thread"]
+        for levels, fnames in (
+            (2, ["IT01234567890_abcde_RC_001.xml"]),
+            (3, []),
+            (2000, []),
+        ):
+            __, extracted = MailThread._extract_pec_attachments_from_message(
+                _wrap(notification, levels)
+            )
+            self.assertEqual([attachment.fname for attachment in extracted], fnames)
+
+    def test_pec_attachment_accepts_every_attachment_shape(self):
+        xml = b"<RicevutaConsegna/>"
+        p7m = b"\x30\x80\x06\x09\x2a\x86\x48"
+        attachments = [
+            {"fname": "IT01234567890_abcde_RC_001.xml", "content": base64.b64encode(xml)},
+            ("IT01234567890_abcde.xml", xml.decode()),
+            SimpleNamespace(fname="IT01234567890_abcde.xml.p7m", content=p7m),
+            PecAttachment("IT01234567890_ABCDE_RC_001.xml", xml),
+            ("empty.xml", b""),
+        ]
+        converted = [pec_attachment(att) for att in attachments]
+
+        self.assertEqual(
+            [att.kind for att in converted],
+            ["notification", "invoice", "invoice", "notification", "other"],
+        )
+        self.assertEqual(converted[0].payload, xml)
+        self.assertEqual(converted[1].payload, xml)
+        self.assertEqual(converted[2].payload, p7m)
+        self.assertIs(converted[3], attachments[3])
+        self.assertEqual(converted[3].key, "it01234567890_abcde_rc_001.xml")
+        # Duplicated names and empty payloads are not posted
+        self.assertEqual(
+            pec_post_attachments(attachments),
+            [
+                ("IT01234567890_abcde_RC_001.xml", xml),
+                ("IT01234567890_abcde.xml", xml),
+                ("IT01234567890_abcde.xml.p7m", p7m),
+            ],
+        )
+
+    def test_strip_invoice_allegati_decodes_payloads_to_files(self):
+        pdf = b"%PDF-1.4 " + os.urandom(200000)
+        xml = (
+            b"<?xml version='1.0' encoding='UTF-8'?>"
+            b"<p:FatturaElettronica xmlns:p="
+            b'"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">'
+            b"<FatturaElettronicaBody><DatiGenerali><Causale>A &amp; B</Causale></DatiGenerali>"
+            b"<Allegati><NomeAttachment>fattura.pdf</NomeAttachment>"
+            b"<FormatoAttachment>PDF</FormatoAttachment>"
+            b"<Attachment>" + base64.encodebytes(pdf) + b"</Attachment></Allegati>"
+            b"</FatturaElettronicaBody></p:FatturaElettronica>"
+        )
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryFile() as source:
+            source.write(xml)
+            source.seek(0)
+            slim_xml, parts = _strip_invoice_allegati(source, directory, chunk_size=4096)
+            try:
+                self.assertEqual([part.fname for part in parts], ["fattura.pdf"])
+                with open(parts[0].path, "rb") as part_file:
+                    self.assertEqual(part_file.read(), pdf)
+            finally:
+                for part in parts:
+                    part.discard()
+
+        self.assertNotIn(b"Allegati", slim_xml)
+        self.assertIn(b"<Causale>A &amp; B</Causale>", slim_xml)
+
+    def test_zip_invoices_are_expanded_member_by_member(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("IT01234567890_00001.xml", b"<FatturaElettronica/>")
+            zip_file.writestr("lotto/IT01234567890_00002.xml.p7m", b"\x30\x80signed")
+            zip_file.writestr("leggimi.txt", b"not an invoice")
+
+        files = list(
+            self.env["mail.thread"]._pec_iter_invoice_files(
+                [
+                    ("IT01234567890_abcde.zip", archive.getvalue()),
+                    ("IT01234567890_00003.xml", b"<FatturaElettronica/>"),
+                ]
+            )
+        )
+
+        self.assertEqual(
+            [(invoice.fname, received.fname) for invoice, received in files],
+            [
+                ("IT01234567890_00001.xml", "IT01234567890_abcde.zip"),
+                ("IT01234567890_00002.xml.p7m", "IT01234567890_abcde.zip"),
+                ("IT01234567890_00003.xml", "IT01234567890_00003.xml"),
+            ],
+        )
+        self.assertEqual(files[1][0].payload, b"\x30\x80signed")
+
+    def test_zip_invoices_are_imported_with_their_content(self):
+        invoice = b"<FatturaElettronica>member</FatturaElettronica>"
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("IT01234567890_00001.xml", invoice)
+
+        entries, imported = self._import_invoice_messages(
+            _invoice_message("<1@sdi>", [("IT01234567890_abcde.zip", archive.getvalue())])
+        )
+
+        self.assertEqual(entries.state, "done")
+        self.assertEqual(
+            [(attachment.name, attachment.raw) for attachment in imported],
+            [("IT01234567890_00001.xml", invoice)],
+        )
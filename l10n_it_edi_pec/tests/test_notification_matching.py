@@ -1,11 +1,25 @@
 from unittest.mock import patch
 import base64
+import io
+import os
 
 from lxml import etree
 
 from odoo.tests import tagged
 
 from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.addons.l10n_it_edi_pec.models.account_move import (
+    PecMoveUpdates,
+    fatturapa_transmission_header,
+)
+from odoo.addons.l10n_it_edi_pec.models.mail_thread import (
+    PecMatchCache,
+    pec_attachments,
+    pec_filename_key,
+    pec_message_id,
+    pec_receipt,
+    sdi_notification,
+)
 
 
 @tagged("post_install", "-at_install")
@@ -19,6 +33,53 @@ class TestPecSdiMatching(AccountTestInvoicingCommon):
             "IT12345670017_1000U.xml",
         )
 
+    def test_filename_key_classifies_invoice_and_notification_files(self):
+        invoice_key = pec_filename_key("IT12345670017_1000U.xml.p7m")
+        self.assertEqual(
+            tuple(invoice_key), ("IT12345670017", "1000U", "", "xml", True)
+        )
+        self.assertTrue(invoice_key.is_invoice)
+        self.assertFalse(invoice_key.is_notification)
+
+        notification_key = pec_filename_key("IT12345670017_1000U_NS_001.xml")
+        self.assertEqual(notification_key.notification_type, "NS")
+        self.assertTrue(notification_key.is_notification)
+        self.assertEqual(notification_key.invoice_filename, "IT12345670017_1000U.xml")
+
+        # A subject tail still identifies the invoice
+        tail_key = pec_filename_key("IT12345670017_1000U.xml ricevuta")
+        self.assertEqual(tail_key.invoice_filename, "IT12345670017_1000U.xml")
+        self.assertFalse(tail_key.is_invoice)
+
+        self.assertIsNone(pec_filename_key("daticert.xml"))
+        self.assertIs(pec_filename_key("IT12345670017_1000U.xml.p7m"), invoice_key)
+
+    def test_sdi_notification_reads_namespaced_root_in_one_record(self):
+        root = etree.fromstring(
+            b'<types:NotificaScarto versione="1.0" xmlns:types='
+            b'"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/messaggi/v1.0">'
+            b"<IdentificativoSdI>111</IdentificativoSdI>"
+            b"<NomeFile>IT12345670017_1000U.xml</NomeFile>"
+            b"<ListaErrori>"
+            b"<Errore><Codice>00200</Codice><Descrizione>File non conforme</Descrizione></Errore>"
+            b"<Errore><Codice>00404</Codice><Descrizione>Fattura duplicata</Descrizione></Errore>"
+            b"</ListaErrori>"
+            b"</types:NotificaScarto>"
+        )
+        notification = sdi_notification(root)
+        self.assertEqual(notification.type, "NS")
+        self.assertEqual(notification.identificativo_sdi, "111")
+        self.assertEqual(notification.nome_file, "IT12345670017_1000U.xml")
+        self.assertEqual(
+            notification.descriptions, ("File non conforme", "Fattura duplicata")
+        )
+
+        # Without a known root the content tells the type
+        root = etree.fromstring(
+            b"<Notifica><Descrizione>Mancata consegna</Descrizione></Notifica>"
+        )
+        self.assertEqual(sdi_notification(root).type, "MC")
+
     def test_find_invoice_by_xml_filename_with_progressive_only_attachment(self):
         company = self.env.company
         company.partner_id.vat = "IT12345670017"
@@ -52,6 +113,38 @@ class TestPecSdiMatching(AccountTestInvoicingCommon):
         self.assertEqual(found, move)
         self.assertEqual(move.l10n_it_edi_attachment_id, attachment)
 
+    def test_find_invoice_by_xml_filename_falls_back_when_key_lookup_misses(self):
+        company = self.env.company
+        company.partner_id.vat = "IT12345670017"
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move = self.init_invoice(
+            "out_invoice",
+            partner=partner,
+            products=product,
+            taxes=self.tax_sale_a,
+        )
+        self.env["ir.attachment"].create(
+            {
+                "name": "IT12345670017_1000U.xml",
+                "type": "binary",
+                "mimetype": "application/xml",
+                "raw": b"<xml/>",
+                "res_model": "account.move",
+                "res_id": move.id,
+                "res_field": "l10n_it_edi_attachment_file",
+                "company_id": company.id,
+            }
+        )
+        move.invalidate_recordset(fnames=["l10n_it_edi_attachment_id"])
+        # The key is the one of another file of the invoice
+        move._l10n_it_edi_pec_set_key("IT12345670017_0999A.xml")
+
+        found = self.env["mail.thread"]._find_invoice_by_xml_filename(
+            "IT12345670017_1000U.xml"
+        )
+        self.assertEqual(found, move)
+
     def test_find_invoice_by_xml_filename_uses_filename_prefix_before_progressive(self):
         company = self.env.company
         company.partner_id.vat = "IT12345670017"
@@ -188,6 +281,162 @@ class TestPecSdiMatching(AccountTestInvoicingCommon):
 
         move._l10n_it_edi_pec_normalize_attachment_filename(attachment)
         self.assertEqual(attachment.name, "IT12345670017_1000U.xml")
+        self.assertEqual(move.l10n_it_edi_pec_key, "it12345670017_1000u")
+
+    def test_find_invoice_by_xml_filename_uses_stored_key(self):
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move = self.init_invoice(
+            "out_invoice",
+            partner=partner,
+            products=product,
+            taxes=self.tax_sale_a,
+        )
+        # No attachment at all: only the key identifies the invoice
+        move._l10n_it_edi_pec_set_key("IT12345670017_1000U.xml")
+
+        self.assertEqual(
+            self.env["mail.thread"]._find_invoice_by_xml_filename(
+                "IT12345670017_1000U_RC_001.xml"
+            ),
+            move,
+        )
+
+    def test_later_notification_is_matched_by_sdi_id(self):
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move = self.init_invoice(
+            "out_invoice",
+            partner=partner,
+            products=product,
+            taxes=self.tax_sale_a,
+        )
+        move.l10n_it_edi_pec_sdi_id = "98765"
+
+        xml = (
+            b"<NotificaDecorrenzaTermini><IdentificativoSdI>98765</IdentificativoSdI>"
+            b"<NomeFile>IT99999999999_00001.xml</NomeFile>"
+            b"</NotificaDecorrenzaTermini>"
+        )
+        message_dict = {
+            # Neither the subject nor the file names lead to the invoice
+            "subject": "POSTA CERTIFICATA: Notifica",
+            "attachments": [
+                {"fname": "IT99999999999_00001_DT_001.xml", "content": xml},
+            ],
+        }
+
+        with patch.object(
+            type(self.env["mail.thread"]), "_find_invoice_by_xml_filename"
+        ) as find_by_filename:
+            self.env["mail.thread"].manage_pec_sdi_notification({}, message_dict)
+
+        find_by_filename.assert_not_called()
+        self.assertEqual(move.l10n_it_edi_state, "accepted_by_pa_partner_after_expiry")
+        self.assertEqual(move.l10n_it_edi_pec_sdi_id, "98765")
+
+    def test_prefetched_matches_resolve_a_run_without_queries(self):
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move = self.init_invoice(
+            "out_invoice",
+            partner=partner,
+            products=product,
+            taxes=self.tax_sale_a,
+        )
+        move._l10n_it_edi_pec_set_key("IT12345670017_1000U.xml")
+        move.l10n_it_edi_pec_sdi_id = "555"
+
+        cache = PecMatchCache()
+        MailThread = self.env["mail.thread"].with_context(pec_match_cache=cache)
+        match_keys = [
+            MailThread._pec_subject_match_keys("POSTA CERTIFICATA: Notifica di esito 555"),
+            MailThread._pec_subject_match_keys(
+                "POSTA CERTIFICATA: Invio fattura IT12345670017_1000U.xml"
+            ),
+            MailThread._pec_subject_match_keys("POSTA CERTIFICATA: Notifica di scarto 777"),
+        ]
+        self.assertEqual(match_keys[0].sdi_ids, {"555"})
+        self.assertFalse(match_keys[0].invoice_keys)
+        MailThread._pec_prefetch_matches(match_keys)
+
+        self.assertEqual(cache.invoice_keys[False, "it12345670017_1000u"], move.id)
+        self.assertEqual(cache.sdi_ids["555"], move.id)
+        self.assertFalse(cache.sdi_ids["777"])
+        ne_xml = b"<NotificaEsito><IdentificativoSdI>555</IdentificativoSdI></NotificaEsito>"
+        attachments = pec_attachments([("IT99999999999_00001_NE_001.xml", ne_xml)])
+        with self.assertQueryCount(0):
+            self.assertEqual(MailThread._find_invoice_by_sdi_id(attachments), move)
+            self.assertEqual(
+                MailThread._find_invoice_by_xml_filename("IT12345670017_1000U.xml"), move
+            )
+
+    def test_pec_receipt_reads_headers_or_daticert(self):
+        self.assertEqual(
+            pec_receipt(
+                {
+                    "X-Ricevuta": "avvenuta-consegna",
+                    "X-Riferimento-Message-ID": "<1.2.3@example.com>",
+                }
+            ),
+            ("avvenuta-consegna", "<1.2.3@example.com>"),
+        )
+        daticert = (
+            b'<postacert tipo="accettazione" errore="nessuno"><dati>'
+            b"<msgid>&lt;1.2.3@example.com&gt;</msgid>"
+            b"</dati></postacert>"
+        )
+        attachments = pec_attachments([("daticert.xml", daticert)])
+        self.assertEqual(
+            pec_receipt({}, attachments), ("accettazione", "<1.2.3@example.com>")
+        )
+        # The certification of a plain PEC message is no receipt
+        attachments = pec_attachments(
+            [("daticert.xml", daticert.replace(b"accettazione", b"posta-certificata"))]
+        )
+        self.assertIsNone(pec_receipt({}, attachments))
+
+    def test_receipt_is_matched_by_sent_message_id(self):
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move = self.init_invoice(
+            "out_invoice",
+            partner=partner,
+            products=product,
+            taxes=self.tax_sale_a,
+        )
+        move.l10n_it_edi_pec_message_id = pec_message_id("example.com")
+        receipt = pec_receipt(
+            {
+                "X-Ricevuta": "avvenuta-consegna",
+                "X-Riferimento-Message-ID": move.l10n_it_edi_pec_message_id,
+            }
+        )
+
+        MailThread = self.env["mail.thread"]
+        self.assertEqual(MailThread._find_invoice_by_pec_receipt(receipt), move)
+        # The subject alone does not tell the receipt type
+        MailThread.manage_pec_sdi_response(
+            move, {"subject": "POSTA CERTIFICATA: fattura", "attachments": []}, receipt=receipt
+        )
+        self.assertEqual(move.l10n_it_edi_pec_state, "delivered")
+
+    def test_transmission_header_stops_before_invoice_body(self):
+        xml = (
+            b"<p:FatturaElettronica xmlns:p="
+            b'"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">'
+            b"<FatturaElettronicaHeader><DatiTrasmissione>"
+            b"<IdTrasmittente><IdPaese>IT</IdPaese><IdCodice>12345670017</IdCodice></IdTrasmittente>"
+            b"<ProgressivoInvio>1000U</ProgressivoInvio>"
+            b"</DatiTrasmissione></FatturaElettronicaHeader>"
+            b"<FatturaElettronicaBody><Allegati><Attachment>"
+            # Never reached: the body is not parsed
+            b"<not-well-formed"
+        )
+        self.assertEqual(
+            fatturapa_transmission_header(io.BytesIO(xml)),
+            ("IT", "12345670017", "1000U"),
+        )
 
     def test_parse_pec_notification_rc_updates_state_and_attaches_xml(self):
         company = self.env.company
@@ -230,6 +479,7 @@ class TestPecSdiMatching(AccountTestInvoicingCommon):
         self.assertEqual(notification_data["type"], "RC")
         self.assertEqual(move.l10n_it_edi_state, "forwarded")
         self.assertEqual(move.l10n_it_edi_pec_state, "delivered")
+        self.assertEqual(move.l10n_it_edi_pec_sdi_id, "12345")
 
         messages = move.message_ids.sorted("id")
         self.assertTrue(messages)
@@ -273,6 +523,118 @@ class TestPecSdiMatching(AccountTestInvoicingCommon):
         self.assertIn("Risposta SdI NS", last.body)
         self.assertEqual(len(last.attachment_ids), 1)
 
+    def test_notifications_of_a_run_are_merged_per_invoice(self):
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move = self.init_invoice(
+            "out_invoice",
+            partner=partner,
+            products=product,
+            taxes=self.tax_sale_a,
+        )
+        move_updates = PecMoveUpdates()
+        run_move = move.with_context(pec_move_updates=move_updates)
+        messages_before = len(move.message_ids)
+
+        def notification_data(notification_type, root, fname):
+            xml = (
+                f"<{root}><IdentificativoSdI>777</IdentificativoSdI></{root}>"
+            ).encode()
+            return {
+                "type": notification_type,
+                "xml": etree.fromstring(xml),
+                "msg_attachments": [(fname, xml)],
+            }
+
+        run_move._l10n_it_edi_apply_pec_receipt(
+            {"subject": "ACCETTAZIONE: fattura", "attachments": []}
+        )
+        run_move._process_sdi_notification(
+            notification_data(
+                "DT", "NotificaDecorrenzaTermini", "IT12345670017_1000U_DT_001.xml"
+            )
+        )
+        # Out of order: the delivery receipt does not undo the expiry
+        run_move._process_sdi_notification(
+            notification_data("RC", "RicevutaConsegna", "IT12345670017_1000U_RC_001.xml")
+        )
+        self.assertFalse(move.l10n_it_edi_pec_state)
+
+        move_updates.flush(self.env)
+
+        self.assertEqual(move.l10n_it_edi_state, "accepted_by_pa_partner_after_expiry")
+        self.assertEqual(move.l10n_it_edi_pec_state, "delivered")
+        self.assertEqual(len(move.message_ids), messages_before + 1)
+        last = move.message_ids.sorted("id")[-1]
+        self.assertIn("Accettazione PEC", last.body)
+        self.assertIn("Risposta SdI DT", last.body)
+        self.assertIn("Risposta SdI RC", last.body)
+        self.assertEqual(len(last.attachment_ids), 2)
+
+    def test_failed_updates_are_reported_by_source(self):
+        partner = self.env.ref("base.res_partner_1")
+        product = self.env.ref("product.product_product_10")
+        move, failing_move = (
+            self.init_invoice(
+                "out_invoice", partner=partner, products=product, taxes=self.tax_sale_a
+            )
+            for _i in range(2)
+        )
+        move_updates = PecMoveUpdates()
+        for source, invoice in (("a", move), ("b", failing_move), ("c", move)):
+            move_updates.mark(source)
+            invoice.with_context(pec_move_updates=move_updates)._l10n_it_edi_pec_update(
+                "forwarded", body="RC"
+            )
+        # The updates of a message whose routing failed are not reported
+        mark = move_updates.mark("d")
+        failing_move.with_context(pec_move_updates=move_updates)._l10n_it_edi_pec_update(
+            "rejected", body="NS"
+        )
+        move_updates.discard(mark)
+
+        AccountMove = type(self.env["account.move"])
+        apply_updates = AccountMove._l10n_it_edi_pec_apply_updates
+
+        def _apply_updates(self, updates):
+            if any(update.move_id == failing_move.id for update in updates):
+                raise ValueError("locked")
+            return apply_updates(self, updates)
+
+        with patch.object(
+            AccountMove, "_l10n_it_edi_pec_apply_updates", autospec=True, side_effect=_apply_updates
+        ):
+            self.assertEqual(move_updates.flush(self.env), {"b": "locked"})
+
+        self.assertEqual(move.l10n_it_edi_state, "forwarded")
+        self.assertFalse(failing_move.l10n_it_edi_state)
+        self.assertFalse(move_updates.updates)
+
+    def test_streamed_allegati_are_stored_with_their_content(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "fetchmail.pec.stream.threshold", 65536
+        )
+        pdf = b"%PDF-1.4 " + os.urandom(100000)
+        xml = (
+            b"<?xml version='1.0' encoding='UTF-8'?>"
+            b"<p:FatturaElettronica xmlns:p="
+            b'"http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">'
+            b"<FatturaElettronicaBody><Allegati><NomeAttachment>fattura.pdf</NomeAttachment>"
+            b"<Attachment>" + base64.encodebytes(pdf) + b"</Attachment></Allegati>"
+            b"</FatturaElettronicaBody></p:FatturaElettronica>"
+        )
+        attachment = self.env["ir.attachment"].create(
+            {"name": "IT01234567890_abcde.xml", "raw": xml, "mimetype": "application/xml"}
+        )
+
+        with patch.object(type(self.env["account.move"]), "_extend_with_attachments"):
+            move = self.env["mail.thread"].create_invoice_from_attachment(attachment)
+
+        allegati = self.env["ir.attachment"].search(
+            [("res_model", "=", "account.move"), ("res_id", "=", move.id), ("name", "=", "fattura.pdf")]
+        )
+        self.assertEqual(allegati.raw, pdf)
+
     def test_pec_export_uses_random_progressivo_and_keeps_xml_consistent(self):
         company = self.env.company
         company.partner_id.write(